@@ -0,0 +1,598 @@
+import glob
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+
+import numpy as np
+
+from tx_store import encode_tx, txid_from_url
+
+MAINNET_MAGIC = b"\xf9\xbe\xb4\xd9"
+# Number of completed block files indexed together (= held in memory while they are indexed), per segment of the
+# indexes. Lookups go through every segment.
+FILES_PER_SEGMENT = 16
+BASE58_ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+BECH32_ALPHABET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+
+_indexes = dict()  # blocks_dir -> BlockFileIndex, shared by every parser of the process (see get_block_index)
+_indexes_lock = threading.Lock()
+
+
+def sha256d(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+def hash160(data):
+    return hashlib.new('ripemd160', hashlib.sha256(data).digest()).digest()
+
+
+def read_varint(data, pos):
+    """
+    Reads a Bitcoin variable length integer.
+    :param data: Bytes to read from
+    :param pos: Position of the integer in data
+    :return: Tuple (integer, position right after it)
+    """
+    first = data[pos]
+    if first < 0xfd:
+        return first, pos + 1
+    if first == 0xfd:
+        return struct.unpack_from("<H", data, pos + 1)[0], pos + 3
+    if first == 0xfe:
+        return struct.unpack_from("<I", data, pos + 1)[0], pos + 5
+    return struct.unpack_from("<Q", data, pos + 1)[0], pos + 9
+
+
+def parse_transaction(data, pos):
+    """
+    Parses the serialized transaction starting at data[pos].
+    :param data: Bytes to read from
+    :param pos: Position of the transaction in data
+    :return: Tuple (txid (bytes, internal byte order), inputs = list of outpoints (prev txid, vout), outputs = list of
+    (value in satoshis, scriptPubKey), is_coinbase, position right after the transaction)
+    """
+    start = pos
+    pos += 4  # Version
+    segwit = data[pos] == 0 and data[pos + 1] != 0
+    if segwit:
+        pos += 2  # Marker and flag
+    inputs_start = pos
+
+    nb_inputs, pos = read_varint(data, pos)
+    inputs = []
+    for _ in range(nb_inputs):
+        prev_txid = bytes(data[pos:pos + 32])
+        vout = struct.unpack_from("<I", data, pos + 32)[0]
+        script_len, pos = read_varint(data, pos + 36)
+        pos += script_len + 4  # Script and sequence
+        inputs.append((prev_txid, vout))
+
+    nb_outputs, pos = read_varint(data, pos)
+    outputs = []
+    for _ in range(nb_outputs):
+        value = struct.unpack_from("<Q", data, pos)[0]
+        script_len, pos = read_varint(data, pos + 8)
+        outputs.append((value, bytes(data[pos:pos + script_len])))
+        pos += script_len
+    outputs_end = pos
+
+    if segwit:  # Witnesses are not part of the txid
+        for _ in range(nb_inputs):
+            nb_items, pos = read_varint(data, pos)
+            for _ in range(nb_items):
+                item_len, pos = read_varint(data, pos)
+                pos += item_len
+    pos += 4  # Locktime
+
+    if segwit:
+        txid = sha256d(bytes(data[start:start + 4]) + bytes(data[inputs_start:outputs_end]) +
+                       bytes(data[pos - 4:pos]))
+    else:
+        txid = sha256d(bytes(data[start:pos]))
+    is_coinbase = nb_inputs == 1 and inputs[0] == (b"\x00" * 32, 0xffffffff)
+    return txid, inputs, outputs, is_coinbase, pos
+
+
+def base58check(version, payload):
+    data = bytes([version]) + payload
+    data += sha256d(data)[:4]
+    number = int.from_bytes(data, "big")
+    encoded = ""
+    while number:
+        number, remainder = divmod(number, 58)
+        encoded = BASE58_ALPHABET[remainder] + encoded
+    nb_zeros = len(data) - len(data.lstrip(b"\x00"))
+    return "1" * nb_zeros + encoded
+
+
+def _bech32_polymod(values):
+    generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+    checksum = 1
+    for value in values:
+        top = checksum >> 25
+        checksum = (checksum & 0x1ffffff) << 5 ^ value
+        for i in range(5):
+            checksum ^= generator[i] if ((top >> i) & 1) else 0
+    return checksum
+
+
+def segwit_address(witness_version, program, hrp="bc"):
+    """
+    Encodes a segwit output as a bech32 (v0) or bech32m (v1+) address (BIP 173 / BIP 350).
+    """
+    data, acc, bits = [witness_version], 0, 0
+    for byte in program:  # Converts 8-bit bytes into 5-bit groups
+        acc = (acc << 8) | byte
+        bits += 8
+        while bits >= 5:
+            bits -= 5
+            data.append((acc >> bits) & 31)
+    if bits:
+        data.append((acc << (5 - bits)) & 31)
+    constant = 1 if witness_version == 0 else 0x2bc830a3
+    expanded_hrp = [ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp]
+    polymod = _bech32_polymod(expanded_hrp + data + [0] * 6) ^ constant
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + "1" + "".join(BECH32_ALPHABET[d] for d in data + checksum)
+
+
+def script_to_address(script):
+    """
+    :param script: scriptPubKey of an output
+    :return: Address of the output, None if it is not a standard output (OP_RETURN, multisig...)
+    """
+    if len(script) == 25 and script[:3] == b"\x76\xa9\x14" and script[23:] == b"\x88\xac":  # P2PKH
+        return base58check(0x00, script[3:23])
+    if len(script) == 23 and script[:2] == b"\xa9\x14" and script[22] == 0x87:  # P2SH
+        return base58check(0x05, script[2:22])
+    if len(script) in (22, 34) and script[0] == 0 and script[1] == len(script) - 2:  # P2WPKH, P2WSH
+        return segwit_address(0, script[2:])
+    if len(script) == 34 and script[0] == 0x51 and script[1] == 32:  # P2TR
+        return segwit_address(1, script[2:])
+    if len(script) in (35, 67) and script[0] == len(script) - 2 and script[-1] == 0xac:  # P2PK
+        try:
+            return base58check(0x00, hash160(script[1:-1]))
+        except ValueError:  # RIPEMD-160 not available in this OpenSSL build
+            return None
+    return None
+
+
+def block_file_number(path):
+    """
+    :param path: Path of a block file (blkNNNNN.dat)
+    :return: Number of the block file (int)
+    """
+    return int(os.path.basename(path)[3:-4])
+
+
+def txid_key(txid):
+    """
+    :param txid: Transaction id (bytes, internal byte order)
+    :return: Key of the transaction in the memory-mapped indexes (its first 8 bytes, as an integer)
+    """
+    return int.from_bytes(txid[:8], "little")
+
+
+class MmapIndex:
+    def __init__(self, path):
+        """
+        Read-only index stored on disk as sorted uint64 keys and rows of uint32 values (one .npy file each), that are
+        memory-mapped: a lookup is a binary search, which only reads a few pages of the files.
+        Several rows can share the same key, as keys are only made of the first bytes of txids.
+        :param path: Path of the index, without extension
+        """
+        self.keys = np.load(f"{path}.keys.npy", mmap_mode="r")
+        self.rows = np.load(f"{path}.rows.npy", mmap_mode="r")
+
+    @staticmethod
+    def write(path, keys, rows, nb_columns):
+        """
+        Sorts and writes an index to disk.
+        :param path: Path of the index, without extension
+        :param keys: array.array('Q') of keys
+        :param rows: array.array('I') of the values of the rows, flattened
+        :param nb_columns: Number of values per row
+        :return: None
+        """
+        keys = np.frombuffer(keys, dtype=np.uint64)
+        rows = np.frombuffer(rows, dtype=np.uint32).reshape(-1, nb_columns)
+        order = np.argsort(keys, kind="stable")
+        np.save(f"{path}.keys.npy", keys[order])
+        np.save(f"{path}.rows.npy", rows[order])
+
+    def lookup(self, key):
+        """
+        :param key: Key to look for
+        :return: Array of the rows stored under that key
+        """
+        start = np.searchsorted(self.keys, key, side="left")
+        end = np.searchsorted(self.keys, key, side="right")
+        return self.rows[start:end]
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class BlockFileIndex:
+    def __init__(self, blocks_dir, index_dir="block_index"):
+        """
+        Index of the transactions stored in the raw block files (blk*.dat) of a Bitcoin Core node.
+        Two memory-mapped indexes are built:
+        - txid -> position of the transaction in the block files
+        - spent output (txid, vout) -> position of the transaction spending it (= next_tx of that output)
+        Both are split in segments of FILES_PER_SEGMENT block files, each one built once. The last block file (the
+        one the node is writing to, that keeps growing) has its own segment, indexed again whenever it has grown:
+        only new and grown files are indexed at start up.
+        Transactions themselves are parsed again from the block files when needed.
+        :param blocks_dir: Directory containing the blk*.dat files (e.g. ~/.bitcoin/blocks)
+        :param index_dir: Directory where the indexes are stored
+        """
+        self.blocks_dir = blocks_dir
+        self.index_dir = index_dir
+        # Block file number -> path (numbers are kept if the node prunes its oldest files)
+        self.block_files = {block_file_number(path): path
+                            for path in sorted(glob.glob(os.path.join(blocks_dir, "blk*.dat")))}
+        xor_path = os.path.join(blocks_dir, "xor.dat")  # Block files are obfuscated since Bitcoin Core 28
+        self.xor_key = b""
+        if os.path.exists(xor_path):
+            with open(xor_path, "rb") as f:
+                self.xor_key = f.read()
+        if not self.xor_key.strip(b"\x00"):
+            self.xor_key = b""
+
+        self._mmaps = dict()  # File number -> mmap of the block file
+        self._mmaps_lock = threading.Lock()
+
+        os.makedirs(index_dir, exist_ok=True)
+        self._meta_path = os.path.join(index_dir, "meta.json")
+        meta = dict()
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                meta = json.load(f)
+        if meta.get('blocks_dir') != os.path.abspath(blocks_dir):
+            meta = dict()
+        # Segment name -> list of [block file name, size] it has been built from
+        self._segment_files = meta.get('segments', dict())
+
+        segments = dict()  # Segment name -> numbers of its block files
+        numbers = sorted(self.block_files)
+        for number in numbers[:-1]:
+            segments.setdefault(f"segment_{number // FILES_PER_SEGMENT:05d}", []).append(number)
+        if numbers:
+            segments["tail"] = numbers[-1:]
+        for name, file_numbers in sorted(segments.items()):
+            files = [[os.path.basename(self.block_files[number]), os.path.getsize(self.block_files[number])]
+                     for number in file_numbers]
+            if self._segment_files.get(name) != files:
+                self.build(name, file_numbers)
+                self._segment_files[name] = files
+                self._save_meta()
+        self._remove_other_segments(segments)
+
+        # Rows of the tx indexes: file number, position. Rows of the spend indexes: vout, file number, position
+        self.segments = [(MmapIndex(os.path.join(index_dir, f"{name}.tx_index")),
+                          MmapIndex(os.path.join(index_dir, f"{name}.spend_index"))) for name in sorted(segments)]
+
+    def _save_meta(self):
+        """
+        Saves the block files each segment has been built from (replaced atomically).
+        :return: None
+        """
+        tmp_path = self._meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({'blocks_dir': os.path.abspath(self.blocks_dir), 'segments': self._segment_files}, f)
+        os.replace(tmp_path, self._meta_path)
+
+    def _remove_other_segments(self, segments):
+        """
+        Deletes the index files that are not part of segments (block files pruned by the node, older index format).
+        :param segments: Names of the current segments
+        :return: None
+        """
+        for name in list(self._segment_files):
+            if name not in segments:
+                del self._segment_files[name]
+                self._save_meta()
+        for path in glob.glob(os.path.join(self.index_dir, "*.npy")):
+            if os.path.basename(path).split(".")[0] not in segments:
+                os.remove(path)
+
+    def _read_file(self, file_nb):
+        """
+        :param file_nb: Number of the block file
+        :return: Content of the file, de-obfuscated
+        """
+        with open(self.block_files[file_nb], "rb") as f:
+            data = f.read()
+        if self.xor_key:
+            key = np.frombuffer(self.xor_key, dtype=np.uint8)
+            data = (np.frombuffer(data, dtype=np.uint8) ^ np.resize(key, len(data))).tobytes()
+        return data
+
+    def _read(self, file_nb, pos, size):
+        """
+        Reads (at most) size bytes of a block file, without loading the whole file.
+        :param file_nb: Number of the block file
+        :param pos: Position of the bytes to read
+        :param size: Number of bytes to read
+        :return: De-obfuscated bytes
+        """
+        with self._mmaps_lock:
+            if file_nb not in self._mmaps:
+                with open(self.block_files[file_nb], "rb") as f:
+                    self._mmaps[file_nb] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self._mmaps[file_nb][pos:pos + size]
+        if self.xor_key:  # The key is applied from the beginning of the file
+            key = np.roll(np.frombuffer(self.xor_key, dtype=np.uint8), -(pos % len(self.xor_key)))
+            data = (np.frombuffer(data, dtype=np.uint8) ^ np.resize(key, len(data))).tobytes()
+        return data
+
+    def _parse_at(self, file_nb, pos):
+        """
+        :param file_nb: Number of the block file
+        :param pos: Position of the transaction in that file
+        :return: Same as parse_transaction
+        """
+        size = 1 << 16
+        while True:
+            data = self._read(file_nb, pos, size)
+            try:
+                tx = parse_transaction(data, 0)
+                if tx[-1] <= len(data):
+                    return tx
+            except (IndexError, struct.error):  # The transaction is bigger than what we have read
+                pass
+            if len(data) < size:
+                raise ValueError(f"Could not parse the transaction at {self.block_files[file_nb]}:{pos}")
+            size *= 4
+
+    def build(self, name, file_numbers):
+        """
+        Goes through every block of some block files to index their transactions and the outputs they spend, and
+        writes both indexes of that segment to index_dir.
+        :param name: Name of the segment
+        :param file_numbers: Numbers of the block files of the segment
+        :return: None
+        """
+        t_0 = time.time()
+        tx_keys, tx_rows = array("Q"), array("I")
+        spend_keys, spend_rows = array("Q"), array("I")
+        for file_nb in file_numbers:
+            data = self._read_file(file_nb)
+            pos = 0
+            while pos + 8 <= len(data) and data[pos:pos + 4] == MAINNET_MAGIC:
+                block_size = struct.unpack_from("<I", data, pos + 4)[0]
+                block_end = pos + 8 + block_size
+                if block_end > len(data):  # Block being written by the node
+                    break
+                nb_tx, tx_pos = read_varint(data, pos + 8 + 80)  # Skips the block header
+                for _ in range(nb_tx):
+                    txid, inputs, _, is_coinbase, next_pos = parse_transaction(data, tx_pos)
+                    tx_keys.append(txid_key(txid))
+                    tx_rows.extend((file_nb, tx_pos))
+                    if not is_coinbase:
+                        for prev_txid, vout in inputs:
+                            spend_keys.append(txid_key(prev_txid))
+                            spend_rows.extend((vout, file_nb, tx_pos))
+                    tx_pos = next_pos
+                pos = block_end
+
+        MmapIndex.write(os.path.join(self.index_dir, f"{name}.tx_index"), tx_keys, tx_rows, 2)
+        MmapIndex.write(os.path.join(self.index_dir, f"{name}.spend_index"), spend_keys, spend_rows, 3)
+        print(f"Indexed {len(tx_keys)} transactions and {len(spend_keys)} spent outputs from {len(file_numbers)} "
+              f"block file(s) ({name}) in {time.time() - t_0:.1f}sec")
+
+    def get_transaction(self, txid):
+        """
+        :param txid: Transaction id (bytes, internal byte order)
+        :return: Same as parse_transaction, None if the transaction is not in the block files
+        """
+        key = txid_key(txid)
+        for tx_index, _ in self.segments:
+            for file_nb, pos in tx_index.lookup(key):
+                tx = self._parse_at(int(file_nb), int(pos))
+                if tx[0] == txid:  # Other transactions can share the first bytes of the txid
+                    return tx
+        return None
+
+    def get_spending_txid(self, txid, vout):
+        """
+        :param txid: Transaction id (bytes, internal byte order)
+        :param vout: Index of the output in the transaction
+        :return: txid of the transaction spending that output (bytes), None if it is not spent in the block files
+        """
+        key = txid_key(txid)
+        for _, spend_index in self.segments:
+            for spent_vout, file_nb, pos in spend_index.lookup(key):
+                if spent_vout == vout:
+                    spending_tx = self._parse_at(int(file_nb), int(pos))
+                    if (txid, vout) in spending_tx[1]:
+                        return spending_tx[0]
+        return None
+
+    def may_contain(self, txid):
+        """
+        Only looks the txid up in the indexes, without reading the block files: a transaction sharing the first bytes
+        of the txid is enough to give True (see txid_key).
+        :param txid: Transaction id (bytes, internal byte order)
+        :return: False if the transaction is not in the block files, True if it is most probably there
+        """
+        key = txid_key(txid)
+        return any(len(tx_index.lookup(key)) > 0 for tx_index, _ in self.segments)
+
+    def contains(self, txid):
+        """
+        :param txid: Transaction id (bytes, internal byte order)
+        :return: True if the transaction is in the block files
+        """
+        return self.get_transaction(txid) is not None
+
+    def tx_page(self, txid):
+        """
+        Builds the same content as the WalletExplorer API page of a transaction (without the wallet labels, that are
+        not part of the chain), so that it can be parsed by ChainParser.
+        :param txid: Transaction id (hex string, as displayed)
+        :return: Content of the page, None if the transaction or one of the transactions it spends is not indexed
+        """
+        tx_hash = bytes.fromhex(txid)[::-1]
+        tx = self.get_transaction(tx_hash)
+        if tx is None:
+            return None
+        _, inputs, outputs, is_coinbase, _ = tx
+
+        tx_inputs = []
+        if not is_coinbase:
+            for prev_txid, vout in inputs:
+                prev_tx = self.get_transaction(prev_txid)
+                if prev_tx is None:
+                    return None
+                value, script = prev_tx[2][vout]
+                address = script_to_address(script)
+                tx_inputs.append({'address': address, 'amount': value / 1e8, 'next_tx': prev_txid[::-1].hex(),
+                                  'is_standard': address is not None})
+
+        tx_outputs = []
+        for vout, (value, script) in enumerate(outputs):
+            address = script_to_address(script)
+            output = {'address': address, 'amount': value / 1e8, 'is_standard': address is not None}
+            spending_txid = self.get_spending_txid(tx_hash, vout)
+            if spending_txid is not None:
+                output['next_tx'] = spending_txid[::-1].hex()
+            tx_outputs.append(output)
+
+        return {'found': True, 'txid': txid, 'is_coinbase': is_coinbase, 'in': tx_inputs, 'out': tx_outputs}
+
+
+def get_block_index(blocks_dir, index_dir="block_index"):
+    """
+    Returns the index of the block files of blocks_dir, loading (or building) it the first time it is requested in
+    the process.
+    :param blocks_dir: Directory containing the blk*.dat files
+    :param index_dir: Directory where the indexes are stored
+    :return: BlockFileIndex
+    """
+    blocks_dir = os.path.abspath(os.path.expanduser(blocks_dir))
+    with _indexes_lock:
+        if blocks_dir not in _indexes:
+            _indexes[blocks_dir] = BlockFileIndex(blocks_dir, index_dir)
+    return _indexes[blocks_dir]
+
+
+class BlockFileBackend:
+    def __init__(self, block_index, fallback):
+        """
+        Data backend answering the transaction pages requested by ChainParser from local block files, with no
+        network at all. Can be used in place of a FetchEngine: every other page (wallet pages, transactions that are
+        not in the block files) is requested to the fallback engine.
+        :param block_index: BlockFileIndex
+        :param fallback: FetchEngine used for the pages that cannot be built locally
+        """
+        self.block_index = block_index
+        self.fallback = fallback
+
+    @property
+    def on_pause(self):
+        return self.fallback.on_pause
+
+    @on_pause.setter
+    def on_pause(self, value):
+        self.fallback.on_pause = value
+
+    def is_local(self, url):
+        """
+        :param url: URL of a WalletExplorer API page
+        :return: True if the page is a transaction page and that transaction is most probably in the block files
+        (only looked up in the index, see BlockFileIndex.may_contain: local_page can still return None)
+        """
+        txid = txid_from_url(url)
+        try:
+            return txid is not None and self.block_index.may_contain(bytes.fromhex(txid)[::-1])
+        except ValueError:  # Invalid txid
+            return False
+
+    def local_page(self, url):
+        """
+        :param url: URL of a WalletExplorer API page
+        :return: Content of the page built from the block files, None if it cannot be built locally
+        """
+        return self.block_index.tx_page(txid_from_url(url)) if self.is_local(url) else None
+
+    def _split(self, url_list):
+        """
+        :param url_list: List of URLs
+        :return: Tuple (dict URL -> content of the pages built locally, list of the other URLs)
+        """
+        local_pages = dict()
+        remote_urls = []
+        for url in url_list:
+            content = self.local_page(url)
+            if content is None:
+                remote_urls.append(url)
+            else:
+                local_pages[url] = content
+        return local_pages, remote_urls
+
+    def partition_cached(self, url_list):
+        """
+        Same as FetchEngine.partition_cached, pages that can be built locally are considered as cached (only looked up
+        in the index, the block files are read once the pages are requested).
+        """
+        local_urls, other_urls = [], []
+        for url in url_list:
+            (local_urls if self.is_local(url) else other_urls).append(url)
+        cached_urls, uncached_urls = self.fallback.partition_cached(other_urls)
+        return local_urls + cached_urls, uncached_urls
+
+    def get_many_encoded(self, url_list):
+        """
+        Same as FetchEngine.get_many_encoded, plus the pages that can be built locally, so that they are selected by
+        batches as well (see ChainParser.replay_selected).
+        """
+        local_pages, remote_urls = self._split(url_list)
+        encoded_txs = self.fallback.get_many_encoded(remote_urls)
+        encoded_txs.update((content['txid'], encode_tx(content)) for content in local_pages.values())
+        return encoded_txs
+
+    def _serve(self, url_list, callback, fallback_fct):
+        """
+        Calls callback with the pages built locally, and hands the other URLs to fallback_fct.
+        """
+        t_0 = time.time()
+        local_pages, remote_urls = self._split(url_list)
+        request_time = (time.time() - t_0) / len(url_list) if url_list else 0
+        for url, content in local_pages.items():
+            callback(url, content, request_time)
+        if remote_urls:
+            return fallback_fct(remote_urls, callback)
+        return [], None
+
+    def replay(self, url_list, callback):
+        """
+        Same as FetchEngine.replay
+        """
+        return self._serve(url_list, callback, self.fallback.replay)
+
+    def fetch_all(self, url_list, callback, cached=False):
+        """
+        Same as FetchEngine.fetch_all
+        """
+        return self._serve(url_list, callback, lambda urls, fct: self.fallback.fetch_all(urls, fct, cached))
+
+    def fetch_one(self, url):
+        """
+        Same as FetchEngine.fetch_one
+        """
+        content = self.local_page(url)
+        return content if content is not None else self.fallback.fetch_one(url)
+
+    def prefetch(self, url):
+        """
+        Same as FetchEngine.prefetch (pages that can be built locally are not prefetched)
+        """
+        if not self.is_local(url):
+            self.fallback.prefetch(url)
@@ -0,0 +1,298 @@
+import argparse
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from fetch_engine import load_stored_response, take_response_accesses
+from tx_store import txid_from_url
+
+CACHE_MAX_BYTES = 2 * 1024 ** 3  # Maximum size of the caches (parser_cache + transaction store), None = no limit
+CACHE_MAX_ENTRIES = None  # Maximum number of pages in the caches, None = no limit
+CACHE_JANITOR_INTERVAL = 10 * 60  # Number of seconds between two passes of the janitor
+
+_janitor = None
+_janitor_lock = threading.Lock()
+
+
+def database_usage(con):
+    """
+    :param con: Connection to a SQLite database
+    :return: Tuple (number of bytes used by the data, number of bytes of free pages)
+    """
+    page_size = con.execute("PRAGMA page_size").fetchone()[0]
+    page_count = con.execute("PRAGMA page_count").fetchone()[0]
+    freelist_count = con.execute("PRAGMA freelist_count").fetchone()[0]
+    return (page_count - freelist_count) * page_size, freelist_count * page_size
+
+
+def uses_incremental_vacuum(con):
+    """
+    :param con: Connection to a SQLite database
+    :return: True if the free pages of the database can be given back by small steps
+    """
+    return con.execute("PRAGMA auto_vacuum").fetchone()[0] == 2  # 2 = INCREMENTAL
+
+
+def compact_database(con, step_pages=1024, pause=0.05):
+    """
+    Gives the free pages of a database back to the file system, by small steps so that the other connections are not
+    blocked for long. Databases that do not use incremental vacuum are left as they are: they have to be converted
+    once, while no parser is running (see convert_database).
+    :param con: Connection to a SQLite database
+    :param step_pages: Number of pages freed at each step
+    :param pause: Number of seconds to wait between two steps
+    :return: Number of bytes given back
+    """
+    _, free_bytes = database_usage(con)
+    if free_bytes == 0 or not uses_incremental_vacuum(con):
+        return 0
+    while database_usage(con)[1] > 0:
+        # execute() would only run the 1st step of the pragma (= free 1 page): executescript() runs it to the end
+        con.executescript(f"PRAGMA incremental_vacuum({step_pages})")
+        time.sleep(pause)
+    if con.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+        con.execute("PRAGMA wal_checkpoint(TRUNCATE)")  # The WAL file keeps its size otherwise
+    return free_bytes
+
+
+def convert_database(path):
+    """
+    Converts a database to incremental vacuum, so that the janitor can compact it. Rewrites the whole file (VACUUM)
+    and locks the database meanwhile: only meant to be run offline, once (see main).
+    :param path: Path of the SQLite database
+    :return: False if the database was already using incremental vacuum, True otherwise
+    """
+    con = sqlite3.connect(path, timeout=30)
+    try:
+        if uses_incremental_vacuum(con):
+            return False
+        con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        con.execute("VACUUM")
+        return True
+    finally:
+        con.close()
+
+
+class CacheJanitor:
+    def __init__(self, session, tx_store, max_bytes=CACHE_MAX_BYTES, max_entries=CACHE_MAX_ENTRIES,
+                 interval=CACHE_JANITOR_INTERVAL):
+        """
+        Keeps the caches of the parsers (the SQLite cache of the session and the transaction store) within a size and
+        number of pages budget, and compacts their files, from a background thread.
+        When the budget is exceeded, pages are evicted in that order:
+        - expired pages of the session cache, then its other pages (address pages, that change over time), least
+        recently used first. Transaction pages found there (cached before the transaction store existed) are moved to
+        the store instead of being lost.
+        - transactions of the store (confirmed transactions never change), least recently used first.
+        :param session: requests_cache.CachedSession (with a SQLite backend)
+        :param tx_store: TxStore, or None
+        :param max_bytes: Maximum number of bytes of data in the caches, None = no limit
+        :param max_entries: Maximum number of pages in the caches, None = no limit
+        :param interval: Number of seconds between two passes
+        """
+        self.session = session
+        self.tx_store = tx_store
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.interval = interval
+        self.low_watermark = 0.9  # Evicts pages until the caches are below 90% of the budget, not to evict at each pass
+        self.batch_size = 500
+
+        self.responses = session.cache.responses
+        self.redirects = getattr(session.cache, 'redirects', None)
+        self.access_table = "response_access"  # Last access time of the responses (see record_response_access)
+        with self._responses_connection() as con:
+            con.execute(f"CREATE TABLE IF NOT EXISTS {self.access_table} (key TEXT PRIMARY KEY, "
+                        f"last_access INTEGER NOT NULL)")
+        self._stop = threading.Event()
+        self._thread = None
+
+    @contextlib.contextmanager
+    def _responses_connection(self):
+        """
+        :return: Context manager of a connection to the session cache, committed (or rolled back) then closed at exit
+        """
+        con = sqlite3.connect(self.responses.db_path, timeout=30)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def usage(self, count_entries=True):
+        """
+        :param count_entries: False not to count the pages (= go through the tables)
+        :return: Tuple (number of bytes of data, number of pages or None) in the caches
+        """
+        with self._responses_connection() as con:
+            used_bytes = database_usage(con)[0]
+            nb_entries = con.execute(f"SELECT COUNT(*) FROM {self.responses.table_name}").fetchone()[0] \
+                if count_entries else None
+        if self.tx_store is not None:
+            used_bytes += database_usage(self.tx_store.connection())[0]
+            if count_entries:
+                nb_entries += len(self.tx_store)
+        return used_bytes, nb_entries
+
+    def _flush_accesses(self):
+        """
+        Writes the last access times recorded by the fetch engines (and the transaction store) since the last pass.
+        :return: None
+        """
+        accesses = take_response_accesses()
+        if accesses:
+            with self._responses_connection() as con:
+                con.executemany(f"INSERT OR REPLACE INTO {self.access_table} (key, last_access) VALUES (?, ?)",
+                                accesses.items())
+        if self.tx_store is not None:
+            self.tx_store.flush_accesses()
+
+    def _delete_responses(self, con, rows):
+        """
+        Deletes responses of the session cache, with their redirects and access times. Transaction pages are moved to
+        the transaction store.
+        :param con: Connection to the session cache
+        :param rows: List of tuples (key, serialized response)
+        :return: None
+        """
+        tx_pages = dict()
+        for _, value in rows:
+            try:
+                response = load_stored_response(self.responses.serializer, value)
+                txid = txid_from_url(response['url'])
+                if txid is not None and response['status_code'] == 200:
+                    tx_pages[txid] = json.loads(response['_content'])
+            except Exception:  # Not readable anymore, simply deleted
+                pass
+        if tx_pages and self.tx_store is not None:
+            self.tx_store.put_many(tx_pages)
+        keys = [(row[0],) for row in rows]
+        con.executemany(f"DELETE FROM {self.responses.table_name} WHERE key = ?", keys)
+        con.executemany(f"DELETE FROM {self.access_table} WHERE key = ?", keys)
+        if self.redirects is not None:  # Redirects map other keys to the key of a response
+            con.executemany(f"DELETE FROM {self.redirects.table_name} WHERE value = ?", keys)
+
+    def _evict_expired(self):
+        """
+        Deletes a batch of the expired responses of the session cache (only if the cache keeps the expiration time of
+        its responses in a column, as requests_cache >= 1.1 does).
+        :return: Number of responses deleted
+        """
+        table = self.responses.table_name
+        with self._responses_connection() as con:
+            if 'expires' not in [row[1] for row in con.execute(f"PRAGMA table_info({table})")]:
+                return 0
+            rows = con.execute(f"SELECT key, value FROM {table} WHERE expires IS NOT NULL AND expires <= ? LIMIT ?",
+                               (int(time.time()), self.batch_size)).fetchall()
+            self._delete_responses(con, rows)
+        return len(rows)
+
+    def _evict_responses(self):
+        """
+        Deletes a batch of the least recently used responses of the session cache. Responses never accessed since the
+        janitor has been recording accesses go first, oldest first (the rowid of a response increases every time it
+        is saved).
+        :return: Number of responses deleted
+        """
+        table = self.responses.table_name
+        with self._responses_connection() as con:
+            rows = con.execute(f"SELECT r.key, r.value FROM {table} AS r "
+                               f"LEFT JOIN {self.access_table} AS a ON a.key = r.key "
+                               f"ORDER BY COALESCE(a.last_access, 0), r.rowid LIMIT ?",
+                               (self.batch_size,)).fetchall()
+            self._delete_responses(con, rows)
+        return len(rows)
+
+    def _over_budget(self, ratio=1.):
+        """
+        :param ratio: Ratio of the budget to compare the usage with
+        :return: True if the caches use more than ratio * budget
+        """
+        if self.max_bytes is None and self.max_entries is None:
+            return False
+        used_bytes, nb_entries = self.usage(count_entries=self.max_entries is not None)
+        return (self.max_bytes is not None and used_bytes > self.max_bytes * ratio) or \
+            (self.max_entries is not None and nb_entries > self.max_entries * ratio)
+
+    def run_once(self):
+        """
+        Evicts pages if the caches exceed their budget, then compacts the cache files.
+        :return: None
+        """
+        self._flush_accesses()
+        if self._over_budget():
+            deleted = 0
+            while self._over_budget(self.low_watermark):
+                nb_deleted = self._evict_expired() or self._evict_responses()
+                if nb_deleted == 0 and self.tx_store is not None:
+                    nb_deleted = self.tx_store.evict(self.batch_size)
+                if nb_deleted == 0:
+                    break
+                deleted += nb_deleted
+            print(f"cache_janitor - Evicted {deleted} page(s) to stay within the cache budget.")
+
+        with self._responses_connection() as con:
+            compact_database(con)
+        if self.tx_store is not None:
+            compact_database(self.tx_store.connection())
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as err:  # The janitor must never stop the parsers
+                print(f"cache_janitor - Error while cleaning the cache: {err}")
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """
+        Starts the background thread running a pass every self.interval seconds.
+        :return: None
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="cache_janitor", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+def start_cache_janitor(session, tx_store, **kwargs):
+    """
+    Starts the janitor of the caches of the process, if it is not already running (= only the parameters of the
+    first call are used). Does nothing if the session does not use a SQLite backend.
+    :param session: requests_cache.CachedSession shared by the parsers
+    :param tx_store: TxStore shared by the parsers, or None
+    :param kwargs: Parameters of CacheJanitor (max_bytes, max_entries, interval)
+    :return: CacheJanitor, None if the session does not use a SQLite backend
+    """
+    global _janitor
+    if not hasattr(session.cache.responses, 'db_path'):
+        return None
+    with _janitor_lock:
+        if _janitor is None:
+            _janitor = CacheJanitor(session, tx_store, **kwargs)
+            _janitor.start()
+    return _janitor
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Converts the cache databases of the parsers to incremental vacuum, "
+                                                 "so that the cache janitor can compact them in the background. "
+                                                 "Rewrites the whole files: only run it while no parser is running.")
+    parser.add_argument("databases", nargs="*", default=["parser_cache.sqlite", "tx_store.sqlite"],
+                        help="Paths of the databases (default: parser_cache.sqlite tx_store.sqlite)")
+    args = parser.parse_args()
+    for path in args.databases:
+        if not os.path.exists(path):
+            print(f"cache_janitor - {path} not found, skipping it.")
+            continue
+        converted = convert_database(path)
+        print(f"cache_janitor - {path} {'converted' if converted else 'already uses incremental vacuum'}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,83 +1,114 @@
+import itertools
 import json
 import math
 import os
-from concurrent.futures import ThreadPoolExecutor
 import time
-from datetime import timedelta
-from functools import partial
-import requests_cache
 
 from django.template.loader import render_to_string
 
+from block_files import BlockFileBackend, get_block_index
+from cache_janitor import start_cache_janitor
+from fetch_engine import FetchEngine, InvalidRequest, get_session
 from graph_visualisation import GraphVisualisation
-from request_limit_reached import RequestLimitReached
+from rate_limiter import TokenBucket
 from tqdm import tqdm
 import numpy as np
 
 import matplotlib
 import matplotlib.pyplot as plt
 
-from transaction import Transaction, find_transaction
+import tx_selection
+from transaction import RootCandidates, Transaction, TransactionLists, find_transaction
+from tx_store import decode_tx, get_tx_store, txid_from_url
 from web_scraper import Scraper
 
 FILE_DIR = os.path.dirname(os.path.abspath(__file__))  # PATH to BTC_tracker
+SELECT_POOL_MIN_PAGES = 5000  # Minimum number of cached tx pages of a layer for it to be selected by worker processes
+SELECT_BATCH_SIZE = 1000  # Number of cached tx pages selected together when the layer is selected in the process
 
 
 class ChainParser:
-    def __init__(self, address, backward_layers=0, rto_threshold=0.1, cache_expire=-1,
-                 forward_layers=0, send_fct=None):
+    def __init__(self, address, backward_layers=0, rto_threshold=0.1, cache_expire=None,
+                 forward_layers=0, send_fct=None, requests_per_second=2, max_requests_in_flight=4,
+                 base_url="https://www.walletexplorer.com", blocks_dir=None, select_workers=0, web_scraper=True):
         self.cache_expire = cache_expire
+        self.base_url = base_url.rstrip("/")  # Can point to a local stand-in of the API (see walletexplorer_server.py)
 
+        self.rate_limiter = TokenBucket(rate=requests_per_second)  # WalletExplorer API is limited to 2 req/sec
+
+        self.nb_layers = backward_layers
+        self.forward_nb_layers = forward_layers
+        self.forward_parsing = forward_layers != 0  # True if we want to parse forward, False otherwise
+        self.tot_nb_layers = self.nb_layers + self.forward_nb_layers
+        self.initial_rto_threshold = rto_threshold  # In percentage of the total address received amount
+
+        self.session = get_session()  # Shared by every parser of the process
+        tx_store = get_tx_store()  # Transaction pages are stored in a compact form
+        self.fetch_engine = FetchEngine(self.session, self.rate_limiter,
+                                        max_requests_in_flight=max_requests_in_flight,
+                                        expire_after=cache_expire,  # None = per-endpoint policies of the session
+                                        tx_store=tx_store)
+        start_cache_janitor(self.session, tx_store)  # Keeps the caches within their budget (see cache_janitor.py)
+        if blocks_dir is not None:  # Transaction pages are built from the local block files instead
+            self.fetch_engine = BlockFileBackend(get_block_index(blocks_dir), fallback=self.fetch_engine)
+
+        print("PAAAAAAATTTTHHHHH: ", self.session.cache.db_path)
+        self.pipelining = False  # True if next layer pages can be requested before the current layer is done
+        # Number of worker processes decoding and selecting the cached tx pages of huge layers (0 = disabled)
+        self.select_workers = select_workers
+
+        self.send_fct = send_fct  # Takes 2 arg = message to send to the socket and message_type (optional)
+        if self.send_fct is not None:
+            self.fetch_engine.on_pause = self._notify_pause
+
+        # The scraper contacts bitcoinabuse.com as soon as it is created: web_scraper=False for offline and batch runs
+        self.web_scraper = Scraper(address, self.send_fct) if web_scraper else None
+
+        self.reset(address)
+
+    def reset(self, address):
+        """
+        Forgets the current analysis, to analyse another address with the same parameters. The fetch engine (and the
+        pages it has prefetched), the rate limiter and the web scraper are kept.
+        :param address: Address to analyse
+        :return: None
+        """
         self.address = address
+        if self.web_scraper is not None:
+            self.web_scraper.address = address
+            self.web_scraper.result_dict = dict()
 
         self.root_value = 0
         self.forward_root_value = 0
 
-        self.nb_layers = backward_layers
-        self.forward_nb_layers = forward_layers
+        self.transaction_lists = TransactionLists({i: [] for i in range(self.nb_layers)})  # Indexed by txid
 
-        self.transaction_lists = {i: [] for i in range(backward_layers)}
-
-        self.forward_parsing = forward_layers != 0  # True if we want to parse forward, False otherwise
         self.forward_layer_counter = 0
         if self.forward_parsing:
             # self.forward_transaction_lists = {i: [] for i in range(forward_nb_layers)}
-            for i in range(forward_layers):
-                self.transaction_lists[backward_layers + i] = []
+            for i in range(self.forward_nb_layers):
+                self.transaction_lists[self.nb_layers + i] = []
 
             self.unspent_tx_counter = 1
 
-        self.tot_nb_layers = self.nb_layers + self.forward_nb_layers
-
-        self.wallet_url = f"https://www.walletexplorer.com/api/1/address?address={address}" \
-                          f"&from=0&count=100&caller=3"
+        self.wallet_url = self._wallet_page_url(0)  # First page of the wallet, also used to get its number of tx
 
-        self.session = requests_cache.CachedSession('parser_cache',
-                                                    # use_cache_dir=True,  # Save files in the default user cache dir
-                                                    cache_control=True,
-                                                    # Use Cache-Control headers for expiration, if available
-                                                    expire_after=cache_expire,
-                                                    # Otherwise never expire responses
-                                                    )
-
-        print("PAAAAAAATTTTHHHHH: ", self.session.cache.db_path)
         self.layer_counter = 0
         self.added_before = []
-        self.rto_threshold = rto_threshold  # here, rto_threshold is in percentage of the total address received amount
-        self.forward_rto_threshold = rto_threshold
+        self.rto_threshold = self.initial_rto_threshold  # Converted to an amount once layer 0 is retrieved
+        self.forward_rto_threshold = self.initial_rto_threshold
 
         self.input_addresses = dict()
+        # Transactions of the wallet above the RTO threshold, filled while layer 0 is retrieved
+        self._root_candidates = None
+        self._forward_root_candidates = None
         self.transaction_tags = {'backward': dict(), 'forward': dict()}  # Dict where keys are tags and values are RTO
 
-        self.send_fct = send_fct  # Takes 2 arg = message to send to the socket and message_type (optional)
-
-        self.web_scraper = Scraper(self.address, self.send_fct)
-
         self.time_stat_dict = {key: {j: [] for j in range(self.tot_nb_layers)} for key in
                                ['request', 'find_tx', 'select_input', 'adding_addresses', 'overall']}
 
         self.analysis_time = 0
-        self.nb_tx_removed = {i: 0 for i in range(backward_layers)}
+        self.nb_tx_removed = {i: 0 for i in range(self.nb_layers)}
         self.nb_tx_low_RTO = {i: 0 for i in range(self.nb_layers)}
         self.tot_nb_tx = {i: 0 for i in range(self.nb_layers)}
 
@@ -85,13 +116,16 @@ class ChainParser:
 
         print(self.wallet_url)
 
-    def thread_pool(self, function, url_list):
+    def thread_pool(self, function, url_list, forward=None, merge=None):
         """
-        :param function: Either self._get_input_addresses or self._retrieve_txids_from_wallet
+        :param function: Either self._get_input_addresses or self._retrieve_txids_from_wallet, called with every page
+        as soon as it has arrived
         :param url_list: List of URLs to parse
+        :param forward: For tx pages, True if the layer is a forward one, False otherwise (None for wallet pages)
+        :param merge: Function called with what function returned for each page (unless None), in the order of
+        url_list, once every page has arrived
         :return: None
         """
-        sec_to_wait = 30
         print("Starting threads...")
         counter = 0
         if self.send_fct is not None:
@@ -103,13 +137,15 @@ class ChainParser:
                             f'"total": "{len(url_list)}"' + '}'
             self.send_fct(message=message, message_type='progress_bar_start')
 
-        cached_urls = []
-        all_cached_urls = list(self.session.cache.urls)
-        for i in range(len(url_list) - 1, -1, -1):
-            url = url_list[i]
-            if url in all_cached_urls:
-                cached_urls.append(url)
-                url_list.pop(i)
+        # Pages arrive in any order (cache first, then as requests complete) and are handled straight away, but what
+        # function returns is only merged into the layers once every page has arrived, in the order of url_list: the
+        # layers built are the same from one run to another, whatever the cache holds
+        positions = dict()
+        for position, url in enumerate(url_list):
+            positions.setdefault(url, []).append(position)
+        results = dict()  # Position in url_list -> what function returned for that page
+
+        cached_urls, url_list = self.fetch_engine.partition_cached(url_list)
         print(f"Length of cached urls: {len(cached_urls)}")
         print(f"Length of not-cached urls: {len(url_list)}")
         if self.send_fct is not None:
@@ -118,74 +154,105 @@ class ChainParser:
                                   f"|- Number of uncached urls: {len(url_list)}")
         with tqdm(total=len(url_list) + len(cached_urls),
                   desc=f"Retrieving transactions for the layer {self.layer_counter}") as p_bar:
-            fn = partial(function, p_bar)
+            def callback(link, content, request_time):
+                if self.send_fct is not None:
+                    self.send_fct(1, message_type="progress_bar_update")
+                p_bar.update(1)
+                results[positions[link].pop(0)] = function(link, content, request_time)
 
             if cached_urls:
                 time_cache = time.time()
-                with ThreadPoolExecutor(max_workers=8) as executor:
-                    # Makes requests if they are already cached (bc we don't have any rate limit)
-                    executor.map(fn, cached_urls)
-                    # for result in executor.map(fn, cached_urls):
-                    #     # print(result)
-                    #     pass
-                    # Wait for the futures to be finished
+                # Reads the pages that are already cached straight from the cache (bc we don't have any rate limit)
+                if forward is not None:  # Tx pages, whose selections are made by batches
+                    failed_urls, _ = self.replay_selected(cached_urls, callback, forward)
+                else:
+                    failed_urls, _ = self.fetch_engine.replay(cached_urls, callback)
+                url_list.extend(failed_urls)  # If something went wrong, we make these requests again
                 self.cached_time += time.time() - time_cache
-            # Requests that have not been cached
-            finished = False
-            nb_tries = 5
-            req_counter = 0
-            pause_required = False
+            # Requests that have not been cached (each one is retried by the fetch engine if it fails)
             if url_list:
-                while not finished:
-                    try:
-                        url = url_list[req_counter]
-                        fn(url)
-                    except RequestLimitReached:
-                        if nb_tries == 0:
-                            if self.send_fct is not None:
-                                self.send_fct(message="Error while making requests. Number of tries exceeded."
-                                                      " Please start the parsing again.")
-                            raise err
-                        else:
-                            nb_tries -= 1
-                            reason = "Request Limit reached"
-                            p_bar.write(f"Reason is: {reason} (in else statement, nb_tries={nb_tries})")
-                            pause_required = True
-                        pass
-                    except Exception as err:
-                        if nb_tries == 0:
-                            if self.send_fct is not None:
-                                self.send_fct(message="Error while making requests. Number of tries exceeded."
-                                                      " Please start the parsing again.")
-                            raise err
-                        else:
-                            nb_tries -= 1
-                            p_bar.write(f"Requests failed. ({err})\n {nb_tries} tries left.")
-                            reason = str(err)
-                            pause_required = True
-
-                    if pause_required:  # If the request did not go through, we pause
-                        p_bar.write("PAAAAAUSE")
-                        p_bar.write(f"Error while making requests ({reason}). Retrying in {sec_to_wait}sec... "
-                                    f"({nb_tries} attempts left)")
-                        if self.send_fct is not None:
-                            self.send_fct(f"Error while making requests ({reason}). Retrying in {sec_to_wait}sec... "
-                                          f"({nb_tries} attempt(s) left)")
-                            self.send_fct(sec_to_wait, message_type='waiting_bar')
-
-                        self.session.close()
-                        waiting_bar(sec_to_wait)  # Waiting for the limit to fade
-                        self.session = requests_cache.CachedSession('parser_cache',
-                                                                    cache_control=True,
-                                                                    expire_after=timedelta(days=self.cache_expire),
-                                                                    )
-                        pause_required = False
-                    else:  # Otherwise, if it did go through, it means we can go to the next request
-                        req_counter += 1
-                        if req_counter == len(url_list):  # End condition
-                            finished = True
-                        else:
-                            time.sleep(0.7)  # Limited by the API to 2 req/sec
+                url_list, err = self.fetch_engine.fetch_all(url_list, callback)
+            if merge is not None:
+                for position in sorted(results):  # Pages that could not be retrieved are not waited for
+                    if results[position] is not None:
+                        merge(results[position])
+            if url_list:
+                # 429 errors are retried until they go through: these pages failed every try for another reason
+                if not isinstance(err, InvalidRequest):  # The API is unreachable, we cannot build the layer
+                    if self.send_fct is not None:
+                        self.send_fct(message="Error while making requests. Number of tries exceeded."
+                                              " Please start the parsing again.")
+                    raise err
+                # Pages rejected by the API (e.g. invalid txid) won't ever go through, we just skip them
+                p_bar.write(f"{len(url_list)} page(s) could not be retrieved and have been skipped. ({err})")
+                if self.send_fct is not None:
+                    self.send_fct(f"{len(url_list)} page(s) could not be retrieved and have been skipped. ({err})")
+
+    def replay_selected(self, url_list, callback, forward):
+        """
+        Same as FetchEngine.replay for the tx pages of a layer, except that the pages found in the TxStore (or built
+        from the block files, see BlockFileBackend.get_many_encoded) are decoded and selected by batches (see
+        tx_selection.select_batch): by worker processes, which only send back the selection, for huge layers (if
+        select_workers > 0), in this process otherwise.
+        Pages are handed to callback in the order of url_list.
+        :param url_list: List of cached tx URLs
+        :param callback: Function called with every page that was found in the cache
+        :param forward: True if the layer is a forward one, False otherwise
+        :return: List of URLs that could not be read from the cache, and None (no request error)
+        """
+        if forward:
+            layer = self.nb_layers + self.forward_layer_counter - 1
+            rto_threshold = self.forward_rto_threshold
+        else:
+            layer = self.layer_counter - 1
+            rto_threshold = self.rto_threshold
+        encoded_txs = self.fetch_engine.get_many_encoded(url_list)
+
+        urls, jobs = [], []
+        for url in url_list:
+            txid = txid_from_url(url)
+            if txid not in encoded_txs:
+                continue
+            # The observed tx does not change until every page of the layer has been handled (see thread_pool)
+            i = find_transaction(self.transaction_lists, txid, layer=layer)
+            observed_addresses, observed_rto = [], 0
+            if i != -1:
+                observed_tx = self.transaction_lists[layer][i]
+                observed_addresses = list(observed_tx.input_addresses if forward else observed_tx.output_addresses)
+                observed_rto = observed_tx.rto
+            urls.append(url)
+            jobs.append((txid, encoded_txs[txid], forward, observed_addresses, observed_rto, rto_threshold))
+
+        if jobs:
+            # Each batch of the layer is selected at once (see tx_selection.select_layer)
+            if self.select_workers > 0 and len(jobs) >= SELECT_POOL_MIN_PAGES:
+                batch_size = max(1, len(jobs) // (self.select_workers * 8))
+                select_batches = tx_selection.get_process_pool(self.select_workers).map
+            else:
+                batch_size = SELECT_BATCH_SIZE
+                select_batches = map  # Lazy: a batch is selected once the previous one has been handled
+            batches = [jobs[i:i + batch_size] for i in range(0, len(jobs), batch_size)]
+            results = itertools.chain.from_iterable(select_batches(tx_selection.select_batch, batches))
+            t_0 = time.time()
+            for url, job, content in zip(urls, jobs, results):
+                content['encoded'] = job[1]  # In case the selection has to be made again (see _full_content)
+                request_time = time.time() - t_0
+                callback(url, content, request_time)
+                t_0 = time.time()
+
+        missing_urls = [url for url in url_list if txid_from_url(url) not in encoded_txs]
+        if missing_urls:  # Pages cached before the TxStore existed (or engine without TxStore)
+            return self.fetch_engine.replay(missing_urls, callback)
+        return [], None
+
+    def _notify_pause(self, seconds):
+        """
+        Called by the fetch engine when the request limit has been reached, to display the waiting bar in the UI.
+        :param seconds: Number of seconds before requests are resumed
+        :return: None
+        """
+        self.send_fct(f"Request limit reached. Retrying in {math.ceil(seconds)}sec...")
+        self.send_fct(math.ceil(seconds), message_type='waiting_bar')
 
     def get_wallet_transactions(self):
         """
@@ -195,12 +262,12 @@ class ChainParser:
         """
         print(f"--------- RETRIEVING TXIDS FROM WALLET ---------\n")
         try:
-            req = self.session.get(self.wallet_url)
-            req.raise_for_status()
+            t_0 = time.time()
+            content = self.fetch_engine.fetch_one(self.wallet_url)
+            request_time = time.time() - t_0
         except Exception as err:
             print(f'get_wallet_transactions - Error occurred: {err}')
         else:
-            content = req.json()
             if 'txs_count' not in content:
                 if self.send_fct is not None:
                     self.send_fct("Error, this address doesn't seem to exist.", message_type='error')
@@ -208,7 +275,7 @@ class ChainParser:
                     print(f"Error, this address doesn't seem to exist.")
                 return False
 
-            nb_tx = req.json()["txs_count"]
+            nb_tx = content["txs_count"]
             if nb_tx == "0":
                 if self.send_fct is not None:
                     self.send_fct("Error, this address has not made any transaction yet.", message_type='error')
@@ -216,27 +283,29 @@ class ChainParser:
                     print(f"Error, this address doesn't seem to exist.")
                 return False
             nb_req = nb_tx // 100 if nb_tx % 100 == 0 else nb_tx // 100 + 1
-            tot_url_list = [f"https://www.walletexplorer.com/api/1/address?address={self.address}"
-                            f"&from={i * 100}&count=100&caller=paulo" for i in range(nb_req)]
+            self._root_candidates = RootCandidates(self.rto_threshold)
+            self._forward_root_candidates = RootCandidates(self.forward_rto_threshold)
+            # The first page has already been retrieved, we parse it while the other ones are being requested
+            self._add_root_candidates(self._retrieve_txids_from_wallet(self.wallet_url, content, request_time))
+            tot_url_list = [self._wallet_page_url(i) for i in range(1, nb_req)]
 
             print(f"Length of url_list: {len(tot_url_list)}")
-            self.thread_pool(self._retrieve_txids_from_wallet, tot_url_list)
+            if tot_url_list:
+                self.thread_pool(self._retrieve_txids_from_wallet, tot_url_list, merge=self._add_root_candidates)
 
             if self.nb_layers > 0:
                 # Once everything is done, increase layer counter
                 self.layer_counter += 1
-                self.transaction_lists[0].sort(key=lambda x: x.amount, reverse=True)  # Ordering tx acc. to their amount
 
                 # Initializing values
-                self.root_value = sum([tx.amount for tx in self.transaction_lists[0]])
-                self.rto_threshold = self.root_value * (self.rto_threshold / 100)
-
-                # Need to remove the tx from layer 0 whose RTO is too low
-                for i, tx in reversed(list(enumerate(self.transaction_lists[0]))):
-                    if tx.rto < self.rto_threshold:
-                        self.nb_tx_low_RTO[0] += 1
-                        # print(f"Tx {tx.txid}'s RTO is too low! ({tx.rto} RTO)")
-                        self.transaction_lists[0].pop(i)
+                self.root_value = self._root_candidates.root_value
+                self.rto_threshold = self._root_candidates.threshold()
+
+                # Only the tx of layer 0 whose RTO is high enough are created, ordered acc. to their amount
+                survivors = self._root_candidates.survivors()
+                self.nb_tx_low_RTO[0] += self._root_candidates.nb_added - len(survivors)
+                self.transaction_lists[0] = [Transaction(txid, output_addresses=[self.address],
+                                                         amount=amount, rto=amount) for txid, amount in survivors]
                 print(f"Root value: {self.root_value}")
                 print(f"RTO VALUE LAYER 0: {sum([tx.rto for tx in self.transaction_lists[0]])}")
 
@@ -244,65 +313,108 @@ class ChainParser:
             if self.forward_parsing:
                 # Once everything is done, increase layer counter
                 self.forward_layer_counter += 1
-                self.transaction_lists[self.nb_layers].sort(key=lambda x: x.amount, reverse=True)
 
                 # Initializing values
-                self.forward_root_value = sum([tx.amount for tx in self.transaction_lists[self.nb_layers]])
-                self.forward_rto_threshold = self.forward_root_value * (self.forward_rto_threshold / 100)
+                self.forward_root_value = self._forward_root_candidates.root_value
+                self.forward_rto_threshold = self._forward_root_candidates.threshold()
 
-                # Need to remove the tx from layer 0 whose RTO is too low
-                for i, tx in reversed(list(enumerate(self.transaction_lists[self.nb_layers]))):
-                    if tx.rto < self.forward_rto_threshold:
-                        # print(f"Removing: {tx.__dict__}")
-                        self.transaction_lists[self.nb_layers].pop(i)
-
-                # print(f"Length of layer 0: {len(self.transaction_lists[self.nb_layers])}")
-                # print(f"Size of layer 0: {sys.getsizeof(self.transaction_lists[self.nb_layers])}")
+                self.transaction_lists[self.nb_layers] = [Transaction(txid, input_addresses=[self.address],
+                                                                      amount=amount, rto=amount)
+                                                          for txid, amount in self._forward_root_candidates.survivors()]
+            self._root_candidates = self._forward_root_candidates = None
             print()
             return True
 
-    def _retrieve_txids_from_wallet(self, p_bar, link):
+    def get_root_transaction(self, txid):
         """
-        Function called by get_wallet_transactions to get the transaction ids from the wallet in input.
-        Stores everything in self.transaction_lists[0] (and self.transaction_lists[self.nb_layers] for forward parsing).
-        :param p_bar: tqdm progress bar, to print without messing the bar display
-        :param link: url to make the request to
-        :return: None
+        Starts the analysis from a single transaction instead of a wallet: layer 0 only contains txid, whose outputs
+        (backward parsing) or inputs (forward parsing) are all observed.
+        :param txid: Transaction ID
+        :return: True if the transaction page could be retrieved, False otherwise
         """
-        t_0 = time.time()
+        print(f"--------- RETRIEVING ROOT TRANSACTION {txid} ---------\n")
         try:
-            req = self.session.get(link)
-            # If the response was successful, no Exception will be raised
-            req.raise_for_status()
+            content = self.fetch_engine.fetch_one(self._tx_url(txid))
         except Exception as err:
-            if "429 Client Error" in str(err):
-                raise RequestLimitReached(f"Request limit reached. ({err})")
-            else:
-                print(f'retrieve_txids_from_wallet - Error occurred: {err}')
-                raise Exception(f"Error occurred: {err}")
-        else:
-            if self.send_fct is not None:
-                self.send_fct(1, message_type="progress_bar_update")
-            p_bar.update(1)
-            content = req.json()
-            for tx in content['txs']:
-                if self.nb_layers > 0 and tx["amount_received"] > 0 and tx["amount_sent"] == 0:
-                    # If it is a received transaction and not a sent one, and if it's not a payment that he did,
-                    # re-using his address (change-address = input address)
-                    self.transaction_lists[self.layer_counter].append(Transaction(tx['txid'],
-                                                                                  output_addresses=[self.address],
-                                                                                  amount=tx["amount_received"],
-                                                                                  rto=tx["amount_received"]))
-                elif self.forward_nb_layers > 0 and tx["amount_sent"] > 0:  # tx["amount_received"] == 0
-                    # If it is a sent transaction and not a received one, and if it's not a payment that he did,
-                    # re-using his address (change-address = input address)
-                    self.transaction_lists[self.nb_layers + self.forward_layer_counter] \
-                        .append(Transaction(tx['txid'],
-                                            input_addresses=[self.address],
-                                            amount=tx["amount_sent"],
-                                            rto=tx["amount_sent"]))
-            self.time_stat_dict['request'][self.layer_counter].append(time.time() - t_0)
-            return link
+            print(f'get_root_transaction - Error occurred: {err}')
+            return False
+        if 'in' not in content or 'out' not in content:
+            print(f"Error, this transaction doesn't seem to exist.")
+            return False
+
+        # Non-standard entries (e.g. OP_RETURN outputs) have no address to follow
+        outputs = [add for add in content['out'] if add.get('is_standard') is not False and add.get('address')]
+        inputs = [add for add in content['in'] if add.get('is_standard') is not False and add.get('address')]
+        if self.nb_layers > 0:
+            self.root_value = sum([add['amount'] for add in outputs])
+            self.rto_threshold = self.root_value * (self.rto_threshold / 100)
+            self.transaction_lists[0].append(Transaction(txid,
+                                                         output_addresses=[add['address'] for add in outputs],
+                                                         amount=self.root_value,
+                                                         rto=self.root_value))
+            self.layer_counter += 1
+
+        if self.forward_parsing:
+            self.forward_root_value = sum([add['amount'] for add in inputs])
+            self.forward_rto_threshold = self.forward_root_value * (self.forward_rto_threshold / 100)
+            self.transaction_lists[self.nb_layers].append(Transaction(txid,
+                                                                      input_addresses=[add['address']
+                                                                                       for add in inputs],
+                                                                      amount=self.forward_root_value,
+                                                                      rto=self.forward_root_value))
+            self.forward_layer_counter += 1
+        print()
+        return True
+
+    def _retrieve_txids_from_wallet(self, link, content, request_time):
+        """
+        Function called by get_wallet_transactions to parse the transaction ids of a page of the wallet in input.
+        :param link: url of the page
+        :param content: Decoded content of the page
+        :param request_time: Time taken by the request (in seconds)
+        :return: Tuple (list of (txid, amount) received, list of (txid, amount) sent) of the transactions of the page
+        that can be part of layer 0 (see _add_root_candidates)
+        """
+        received, sent = [], []
+        for tx in content['txs']:
+            if self.nb_layers > 0 and tx["amount_received"] > 0 and tx["amount_sent"] == 0:
+                # If it is a received transaction and not a sent one, and if it's not a payment that he did,
+                # re-using his address (change-address = input address)
+                received.append((tx['txid'], tx["amount_received"]))
+            elif self.forward_nb_layers > 0 and tx["amount_sent"] > 0:  # tx["amount_received"] == 0
+                # If it is a sent transaction and not a received one, and if it's not a payment that he did,
+                # re-using his address (change-address = input address)
+                sent.append((tx['txid'], tx["amount_sent"]))
+        self.time_stat_dict['request'][self.layer_counter].append(request_time)
+        return received, sent
+
+    def _add_root_candidates(self, candidates):
+        """
+        Adds the transactions of a page of the wallet to the candidates of self.transaction_lists[0] (and
+        self.transaction_lists[self.nb_layers] for forward parsing). The pages are added in order, as the amounts
+        kept depend on the sum of the previous ones.
+        :param candidates: Tuple returned by _retrieve_txids_from_wallet
+        :return: None
+        """
+        received, sent = candidates
+        for txid, amount in received:
+            self._root_candidates.add(txid, amount)
+        for txid, amount in sent:
+            self._forward_root_candidates.add(txid, amount)
+
+    def _wallet_page_url(self, page):
+        """
+        :param page: Index of the page (100 transactions per page)
+        :return: URL of the API page of the wallet of self.address
+        """
+        return f"{self.base_url}/api/1/address?address={self.address}&from={page * 100}&count=100&caller=paulo"
+
+    def _tx_url(self, txid):
+        """
+        :param txid: Transaction id
+        :return: URL of the API page of the transaction txid
+        """
+        return f"{self.base_url}/api/1/tx?txid={txid}&caller=paulo"
 
     def get_input_addresses_from_txid(self):
         """
@@ -311,10 +423,10 @@ class ChainParser:
         :return: None
         """
         print(f"\n\n\n--------- RETRIEVING ADDRESSES FROM TXID LAYER {self.layer_counter}---------\n")
-        tot_url_list = [f"https://www.walletexplorer.com/api/1/tx?txid={tx.txid}&caller=paulo"
+        tot_url_list = [self._tx_url(tx.txid)
                         for tx in self.transaction_lists[self.layer_counter - 1] if not tx.is_manually_deleted]
 
-        self.thread_pool(self._get_input_addresses, tot_url_list)
+        self.thread_pool(self._get_input_addresses, tot_url_list, forward=False, merge=self._add_input_addresses)
 
         # print(f"\n\nTransactions added before: {self.added_before}\n\n")
         # print(f"Tx of layer {self.layer_counter}:")
@@ -323,100 +435,94 @@ class ChainParser:
         # print("...")
         self.layer_counter += 1
 
-    def _get_input_addresses(self, p_bar, link):
+    def _get_input_addresses(self, link, tx_content, request_time):
         """
-        Called by get_input_addresses_from_txid.
-        Only used to parse the page at the indicated link. Retrieves BTC input address of a transaction as well as its
-        associated txid.
-        :param p_bar: tqdm progress bar, to print without messing the bar display
-        :param link: Url to make the request to
-        :return:
+        Called by get_input_addresses_from_txid as soon as the page at the indicated link has arrived. Selects the
+        inputs of the transaction to follow, from the state of the layers before the current layer was parsed (the
+        selected inputs are only added to the layers once every page of the layer has been handled, see
+        _add_input_addresses).
+        :param link: Url of the page
+        :param tx_content: Decoded content of the page
+        :param request_time: Time taken by the request (in seconds)
+        :return: Tuple (txid, selected inputs) to add to the next layer, None if no input is followed
         """
         t_0 = time.time()
+        txid = link[link.find("txid="):].split("&")[0][5:]
+        selection = None
+
+        if tx_content["is_coinbase"]:  # If it's mined bitcoins
+            i = find_transaction(self.transaction_lists, txid, layer=self.layer_counter - 1,
+                                 stop_index=self.nb_layers)
+            self.transaction_lists[self.layer_counter - 1][i].tag = "Mined"
+        elif "label" in tx_content:  # If the input address has been identified, we add the tag
+            # to the tx it comes from
+            i = find_transaction(self.transaction_lists, txid, layer=self.layer_counter - 1,
+                                 stop_index=self.nb_layers)
+            self.transaction_lists[self.layer_counter - 1][i].tag = tx_content['label']
+            # We don't need to go through the inputs of this tx as we've already found out where the BTC are from.
+        elif self.layer_counter < self.nb_layers:
+            # We select the inputs that we want to keep
+            t_input = time.time()
+            # To manage the case with OPCODE (see notes)
+            selected_inputs = [add for add in self.select_inputs(tx_content, txid) if add['is_standard']]
+            if self.pipelining:  # The tx not found yet will be parsed in the next layer, we can request them already
+                for add in selected_inputs:
+                    if find_transaction(self.transaction_lists, add["next_tx"], stop_index=self.nb_layers)[1] == -1:
+                        self.fetch_engine.prefetch(self._tx_url(add['next_tx']))
+            selection = txid, selected_inputs
+
+            self.time_stat_dict['request'][self.layer_counter].append(request_time)
+            self.time_stat_dict['select_input'][self.layer_counter].append(time.time() - t_input)
+        if self.layer_counter < self.nb_layers:
+            self.time_stat_dict['overall'][self.layer_counter].append(time.time() - t_0 + request_time)
+        return selection
+
+    def _add_input_addresses(self, selection):
+        """
+        Called by get_input_addresses_from_txid once every page of the layer has been handled, in the order of the
+        layer. Adds the selected inputs of a transaction to the next layer, or to the transaction they come from if it
+        has already been found.
+        :param selection: Tuple (txid, selected inputs) returned by _get_input_addresses
+        :return: None
+        """
+        txid, selected_inputs = selection
+        t_adding = time.time()
+        t_tx = []
+        for add in selected_inputs:
+            t_0_tx = time.time()
+            pot_layer, i = find_transaction(self.transaction_lists, add["next_tx"], stop_index=self.nb_layers)
+            t_tx.append(time.time() - t_0_tx)
+            if i == -1:  # Means we have not added that txid to the next layer yet
+                self.transaction_lists[self.layer_counter].append(
+                    Transaction(txid=add['next_tx'], prev_txid=[(txid, self.layer_counter - 1)],
+                                amount=add['amount'],
+                                rto=add['rto'],
+                                output_addresses=[add['address']]))
+                self.transaction_lists.add_link((txid, self.layer_counter - 1), (add['next_tx'], self.layer_counter))
 
-        try:
-            req = self.session.get(link)
-            # If the response was successful, no Exception will be raised
-            req.raise_for_status()
-        except Exception as err:
-            if "429 Client Error" in str(err):
-                raise RequestLimitReached(f"Request limit reached. ({err})")
             else:
-                print(f'retrieve_txids_from_wallet - Error occurred: {err}')
-                raise Exception(f"Error occurred: {err}")
-        else:
-            t_request = time.time()
-            if self.send_fct is not None:
-                self.send_fct(1, message_type="progress_bar_update")
-            p_bar.update(1)
-            tx_content = req.json()
-            txid = link[link.find("txid="):].split("&")[0][5:]
-
-            if tx_content["is_coinbase"]:  # If it's mined bitcoins
-                i = find_transaction(self.transaction_lists, txid, layer=self.layer_counter - 1,
-                                     stop_index=self.nb_layers)
-                self.transaction_lists[self.layer_counter - 1][i].tag = "Mined"
-            elif "label" in tx_content:  # If the input address has been identified, we add the tag
-                # to the tx it comes from
-                i = find_transaction(self.transaction_lists, txid, layer=self.layer_counter - 1,
-                                     stop_index=self.nb_layers)
-                self.transaction_lists[self.layer_counter - 1][i].tag = tx_content['label']
-                # We don't need to go through the inputs of this tx as we've already found out where the BTC are from.
-            elif self.layer_counter < self.nb_layers:
-                # We select the inputs that we want to keep
-                t_input = time.time()
-                selected_inputs = self.select_inputs(tx_content, txid)
-
-                t_adding = time.time()
-                t_tx = []
-                for add in selected_inputs:
-                    if add['is_standard']:  # To manage the case with OPCODE (see notes)
-                        t_0_tx = time.time()
-                        pot_layer, i = find_transaction(self.transaction_lists, add["next_tx"],
-                                                        stop_index=self.nb_layers)
-                        t_tx.append(time.time() - t_0_tx)
-                        if i == -1:  # Means we have not added that txid to the next layer yet
-                            self.transaction_lists[self.layer_counter].append(
-                                Transaction(txid=add['next_tx'], prev_txid=[(txid, self.layer_counter - 1)],
-                                            amount=add['amount'],
-                                            rto=add['rto'],
-                                            output_addresses=[add['address']]))
-
-                        else:
-                            self.added_before.append(add['next_tx'])
-                            # print("ADDED BEFORE")
-                            if add['address'] not in self.transaction_lists[pot_layer][i].output_addresses:
-                                # If the address is already in the list, it means that we ended up on a loop
-                                self.transaction_lists[pot_layer][i].amount += add['amount']
-                                self.transaction_lists[pot_layer][i].prev_txid.append((txid, self.layer_counter - 1))
-                                self.transaction_lists[pot_layer][i].output_addresses.append(add['address'])
-                                self.transaction_lists[pot_layer][i].rto += add['rto']
-
-                t_tx_avg = np.mean(t_tx) if t_tx else 0
-                self.time_stat_dict['request'][self.layer_counter].append(t_request - t_0)
-                self.time_stat_dict['select_input'][self.layer_counter].append(t_adding - t_input)
-                self.time_stat_dict['adding_addresses'][self.layer_counter].append(time.time() - t_adding)
-                self.time_stat_dict['find_tx'][self.layer_counter].append(t_tx_avg)
-            if self.layer_counter < self.nb_layers:
-                self.time_stat_dict['overall'][self.layer_counter].append(time.time() - t_0)
-            return link
+                self.added_before.append(add['next_tx'])
+                # print("ADDED BEFORE")
+                if add['address'] not in self.transaction_lists[pot_layer][i].output_addresses:
+                    # If the address is already in the list, it means that we ended up on a loop
+                    self.transaction_lists[pot_layer][i].amount += add['amount']
+                    self.transaction_lists[pot_layer][i].prev_txid.append((txid, self.layer_counter - 1))
+                    self.transaction_lists.add_link((txid, self.layer_counter - 1), (add['next_tx'], pot_layer))
+                    self.transaction_lists[pot_layer][i].output_addresses.append(add['address'])
+                    self.transaction_lists[pot_layer][i].rto += add['rto']
+
+        self.time_stat_dict['adding_addresses'][self.layer_counter].append(time.time() - t_adding)
+        self.time_stat_dict['find_tx'][self.layer_counter].append(np.mean(t_tx) if t_tx else 0)
 
     def select_inputs(self, tx_content, txid):
         """
-        Selects inputs that we will continue to investigate. Refer to the decision tree to have a better understanding
-        on how we decided to handle the different cases
+        Selects inputs that we will continue to investigate (see tx_selection.select_inputs), and updates the stats
+        of the layer.
         :param txid: Transaction ID
-        :param tx_content: Content of the transaction that we are currently looking.
+        :param tx_content: Content of the transaction that we are currently looking. If it has been selected by a
+        worker process (see replay_selected), the selection is used as long as the observed tx has not changed since.
         :return: selected input addresses
         """
-
-        # We sort in and out lists as it will be necessary in a further step
-        tx_content['in'].sort(key=lambda x: x['amount'])
-        tx_content['out'].sort(key=lambda x: x['amount'])
-        input_values = [add['amount'] for add in tx_content['in']]
-        output_values = [add['amount'] for add in tx_content['out']]
-
-        self.tot_nb_tx[self.layer_counter] += len(tx_content['in'])
         # We get the previous transaction, from which tx_content comes from. (So, from the previous layer)
         # This transaction is unique.
         try:
@@ -426,71 +532,51 @@ class ChainParser:
             print(f"Exception: {e}")
             return
         if tx_index == -1:  # This case should never happen in theory
+            tx_content = self._full_content(tx_content)
+            self.tot_nb_tx[self.layer_counter] += len(tx_content['in'])
             print(f"Error, something went wrong. Selecting all inputs by default.")
             self.set_rto(tx_content['in'], -1)
             return tx_content['in']
-        else:
-            observed_addresses = self.transaction_lists[self.layer_counter - 1][tx_index].output_addresses
-            observed_rto = self.transaction_lists[self.layer_counter - 1][tx_index].rto
-            observed_outputs = [add for add in tx_content['out'] if add['address'] in observed_addresses]
-
-        if len(input_values) > 1:
-            # First, we calculate the tx fee by adding all the input values and subtracting the output values
-            tx_fee = sum(input_values) - sum(output_values)
-            # print(f"tx_fee for {txid}: {tx_fee}")
-            # Then, 1st check: input_values match with output_values AND that we have the same number of input/outputs
-            for i in range(len(output_values)):
-                output_values[i] += tx_fee
-                output_values.sort()  # Need to sort output values, or we may change the order by adding the tx_fee
-                if input_values == output_values:
-                    # Only ONE input value matches our output value(s) (two by two)
-                    # - there can be multiple output addresses to look at
-                    used_indexes = set()
-                    for add in observed_outputs:
-                        if add['amount'] in input_values and output_values.index(add['amount']) not in used_indexes:
-                            used_indexes.add(input_values.index(add['amount']))
-                    if len(used_indexes) == len(observed_addresses):  # If it's the case:
-                        selected_inputs = [tx_content['in'][i] for i in used_indexes]
-                        # print(f"FINALLY")
-                        # self.transaction_lists[self.layer_counter - 1][tx_index].is_pruned = True
-                    else:
-                        selected_inputs = tx_content['in']
-
-                    self.nb_tx_removed[self.layer_counter] += len(tx_content['in']) - len(selected_inputs)
-                    self.set_rto(selected_inputs, observed_rto)  # We set the RTO to all the selected transactions
-                    return selected_inputs
-
-            # Second check: there is a sublist of input values whose sum equals our output values (two by two)
-            # - Again, there can be multiple output values to look at
-            # Complexity of n*2^n, so we decided not to implement it
-
-            if input_values[-1] / sum(input_values) > 0.95:  # If one input value represents more than 95% of the tot.
-                selected_inputs = [tx_content['in'][-1]]
-
-            else:
-                # We also want to prune tx if a number -let's say 20%- of tx represents more than 80% of the total
-                nb_tx = math.ceil(len(input_values) * 0.2)
-                if sum(input_values[-1 - nb_tx:]) / sum(input_values) > 0.80:
-                    selected_inputs = tx_content['in'][-1 - nb_tx:]
-
-                elif len(input_values) > 50:  # If too many transactions, we prune them and only take the 10 biggest
-                    selected_inputs = tx_content['in'][-1 - 10:]
-                else:
-                    selected_inputs = tx_content['in']
-
-        else:
-            # Need to add the rto to the only input transaction (= to previous rto)
-            selected_inputs = tx_content['in']
-
-        if len(selected_inputs) != len(tx_content['in']):
-            self.transaction_lists[self.layer_counter - 1][tx_index].is_pruned = True
-
-        self.nb_tx_removed[self.layer_counter] += len(tx_content['in']) - len(selected_inputs)
-        self.set_rto(selected_inputs, observed_rto)  # We set the RTO to all the selected transactions
-        # and remove low ones
 
+        observed_tx = self.transaction_lists[self.layer_counter - 1][tx_index]
+        selected_inputs, stats = self._precomputed_selection(tx_content, observed_tx.output_addresses, observed_tx.rto)
+        if selected_inputs is None:
+            selected_inputs, stats = tx_selection.select_inputs(self._full_content(tx_content),
+                                                                observed_tx.output_addresses, observed_tx.rto,
+                                                                self.rto_threshold)
+        self.tot_nb_tx[self.layer_counter] += stats['nb_inputs']
+        if stats['is_pruned']:
+            observed_tx.is_pruned = True
+        self.nb_tx_removed[self.layer_counter] += stats['nb_removed']
+        self.nb_tx_low_RTO[self.layer_counter] += stats['nb_low_rto']
         return selected_inputs
 
+    @staticmethod
+    def _precomputed_selection(tx_content, observed_addresses, observed_rto):
+        """
+        :param tx_content: Content of a transaction page, possibly selected by a worker process (see replay_selected)
+        :param observed_addresses: Current addresses of the observed transaction
+        :param observed_rto: Current RTO of the observed transaction
+        :return: Tuple (selected entries, stats) computed by the worker, (None, None) if there is none or if the
+        observed transaction has changed since it was sent to the worker
+        """
+        if 'selection' not in tx_content:
+            return None, None
+        (worker_addresses, worker_rto), selected, stats = tx_content['selection']
+        if list(worker_addresses) != list(observed_addresses) or worker_rto != observed_rto:
+            return None, None
+        return selected, stats
+
+    @staticmethod
+    def _full_content(tx_content):
+        """
+        :param tx_content: Content of a transaction page, possibly compacted by a worker process (see replay_selected)
+        :return: Whole content of the page
+        """
+        if 'encoded' in tx_content:
+            return decode_tx(tx_content['txid'], tx_content['encoded'])
+        return tx_content
+
     def set_rto(self, input_list, rto, forward=False):
         """
         Set rto to each of the tx that are in input_list according to their value
@@ -499,18 +585,10 @@ class ChainParser:
         :param rto: rto of the current transaction to share between the next transactions
         :return: None
         """
-
-        sum_value = sum([float(tx['amount']) for tx in input_list])
-
-        for i in range(len(input_list) - 1, -1, -1):
-            input_list[i]['rto'] = min(input_list[i]['amount'], (float(input_list[i]['amount']) / sum_value) * rto)
-
-            # We only keep transactions with RTOs > threshold
-            if forward and input_list[i]['rto'] < self.forward_rto_threshold:
-                input_list.pop(i)
-            elif not forward and input_list[i]['rto'] < self.rto_threshold:
-                self.nb_tx_low_RTO[self.layer_counter] += 1
-                input_list.pop(i)
+        if forward:
+            tx_selection.set_rto(input_list, rto, self.forward_rto_threshold)
+        else:
+            self.nb_tx_low_RTO[self.layer_counter] += tx_selection.set_rto(input_list, rto, self.rto_threshold)
 
     def terminal_manual_analysis(self, display_partial_graph=False):
         worked = True
@@ -581,15 +659,24 @@ class ChainParser:
             self.analysis_time += time.time() - t_0
             return True  # Not sure that we use this output
 
-    def start_analysis(self, display_partial_graph=False):
+    def start_analysis(self, display_partial_graph=False, root_txid=None):
         """ Method to start the analysis of the root address. Builds every layer.
         If manual is set to True, start_analysis is going to build every layer but one at a time,
         stopping at every layer. If self.layer_counter > self.nb_layers, display final stats
         :param display_partial_graph: Bool to display or not the graph in between each layer
+        :param root_txid: If given, the analysis starts from that transaction instead of the wallet of the address
         :return True if layer analysis didn't encounter any error, False otherwise"""
         t_0 = time.time()
-
-        result = self.get_wallet_transactions()  # Counter gets increased in that method
+        # No transaction can be pruned in between layers: every tx added to a layer gets parsed, so its page can be
+        # requested as soon as it is found, while the rest of the current layer is being parsed.
+        # Inputs/outputs selection still waits for the whole layer to be parsed, as the RTO of a tx can increase until
+        # all of its parents have been parsed.
+        self.pipelining = True
+
+        if root_txid is not None:
+            result = self.get_root_transaction(root_txid)  # Counter gets increased in that method
+        else:
+            result = self.get_wallet_transactions()  # Counter gets increased in that method
         if self.send_fct is not None:
             self.send_fct(f"|--> Layer 0 done!\n")
 
@@ -693,22 +780,20 @@ class ChainParser:
     def delete_transactions(self, tx_to_del, layer):
         """
         Takes a list of tx indexes to delete and mark them as "deleted", plus deletes their next transactions in the
-        next layer.
+        following layers (the ones that only come from deleted transactions, and so on), so that they are not parsed.
         """
+        orphans = set()
         for i in tx_to_del:  # Go through all the tx indices to stop the parsing with
             if i >= len(self.transaction_lists[layer]):
-                pass
+                continue
             self.transaction_lists[layer][i].is_manually_deleted = True
 
-            txid = self.transaction_lists[layer][i].txid
-            # We also need to delete its kids
-            for j in range(len(self.transaction_lists[layer + 1]) - 1, - 1, -1):
-                tx = self.transaction_lists[layer + 1][j]
-                for k in range(len(tx.prev_txid) - 1, -1, -1):
-                    if tx.prev_txid[k][0] == txid:
-                        self.transaction_lists[layer + 1][j].prev_txid.pop(k)
-                if not tx.prev_txid:
-                    self.transaction_lists[layer + 1].pop(j)
+            # We also need to delete its kids (and their own kids if they don't come from another tx)
+            orphans |= self.transaction_lists.remove_links((self.transaction_lists[layer][i].txid, layer))
+
+        for orphan_layer in {elt[1] for elt in orphans}:  # Each layer is only rebuilt once
+            self.transaction_lists[orphan_layer] = [tx for tx in self.transaction_lists[orphan_layer]
+                                                    if (tx.txid, orphan_layer) not in orphans]
 
     def print_final_results(self):
         print(f"\n\n\n--------- FINAL RESULTS ---------\n")
@@ -1046,14 +1131,13 @@ class ChainParser:
         """
         Helper function of find_transactions.
         """
-        for layer in range(len(self.transaction_lists)):
-            for tx in self.transaction_lists[layer]:
-                if tx.txid == txid:
-                    if layer >= self.nb_layers:
-                        layer_return = f"f-{layer - self.nb_layers}"
-                    else:
-                        layer_return = f"b-{layer}"
-                    return layer_return, tx
+        layer, i = find_transaction(self.transaction_lists, txid)
+        if i != -1:
+            if layer >= self.nb_layers:
+                layer_return = f"f-{layer - self.nb_layers}"
+            else:
+                layer_return = f"b-{layer}"
+            return layer_return, self.transaction_lists[layer][i]
         return None, None
 
     def check_duplicates(self):
@@ -1072,11 +1156,11 @@ class ChainParser:
         :return: None
         """
         print(f"\n\n\n--------- RETRIEVING ADDRESSES FROM TXID FORWARD LAYER {self.forward_layer_counter}---------\n")
-        tot_url_list = [f"https://www.walletexplorer.com/api/1/tx?txid={tx.txid}&caller=paulo"
+        tot_url_list = [self._tx_url(tx.txid)
                         for tx in self.transaction_lists[self.nb_layers + self.forward_layer_counter - 1]
                         if not tx.is_manually_deleted and tx.tag is None and "unspent_tx" not in tx.txid]
 
-        self.thread_pool(self._get_output_addresses, tot_url_list)
+        self.thread_pool(self._get_output_addresses, tot_url_list, forward=True, merge=self._add_output_addresses)
 
         print(f"\n\nTransactions added before: {self.added_before}\n\n")
         # print(f"Tx of layer {self.layer_counter}:")
@@ -1085,200 +1169,126 @@ class ChainParser:
         # print("...")
         self.forward_layer_counter += 1
 
-    def _get_output_addresses(self, p_bar, link):
+    def _get_output_addresses(self, link, tx_content, request_time):
         """
-        Called by get_output_addresses_from_txid.
-        Only used to parse the page at the indicated link. Retrieves BTC output address of a transaction as well as its
-        associated txid.
-        :param p_bar: tqdm progress bar, to print without messing the bar display
-        :param link: Url to make the request to
-        :return: link in input (used for self.threadpool)
+        Called by get_output_addresses_from_txid as soon as the page at the indicated link has arrived. Selects the
+        outputs of the transaction to follow, from the state of the layers before the current layer was parsed (see
+        _get_input_addresses).
+        :param link: Url of the page
+        :param tx_content: Decoded content of the page
+        :param request_time: Time taken by the request (in seconds)
+        :return: Tuple (txid, selected outputs) to add to the next layer, None if no output is followed
         """
         t_0 = time.time()
-        try:
-            req = self.session.get(link)
-            # If the response was successful, no Exception will be raised
-            req.raise_for_status()
-        except Exception as err:
-            if "429 Client Error" in str(err):
-                raise RequestLimitReached(f"Request limit reached. ({err})")
-            else:
-                print(f'retrieve_txids_from_wallet - Error occurred: {err}')
-                raise Exception(f"Error occurred: {err}")
-        else:
-            t_request = time.time()
-            if self.send_fct is not None:
-                self.send_fct(1, message_type="progress_bar_update")
-            p_bar.update(1)
-            tx_content = req.json()
-            txid = link[link.find("txid="):].split("&")[0][5:]
-            if "label" in tx_content:  # If the transaction address has been identified, we add the tag
-                # to the tx it comes from --> Can only happen in layer 0 (when counter is at 1),
-                # since tags are displayed in the tx output info
-                i = find_transaction(self.transaction_lists, txid,
-                                     layer=self.nb_layers + self.forward_layer_counter - 1)
-                self.transaction_lists[self.nb_layers + self.forward_layer_counter - 1][i].tag = tx_content['label']
-                # We don't need to go through the outputs of this tx as we've already found out where the BTC are from.
-            elif self.forward_layer_counter < self.forward_nb_layers:
-                # We select the outputs that we want to keep
-                t_input = time.time()
-                selected_outputs = self.select_outputs(tx_content, txid)
-
-                t_adding = time.time()
-                t_tx = []
+        txid = link[link.find("txid="):].split("&")[0][5:]
+        layer = self.nb_layers + self.forward_layer_counter
+        selection = None
+        if "label" in tx_content:  # If the transaction address has been identified, we add the tag
+            # to the tx it comes from --> Can only happen in layer 0 (when counter is at 1),
+            # since tags are displayed in the tx output info
+            i = find_transaction(self.transaction_lists, txid, layer=layer - 1)
+            self.transaction_lists[layer - 1][i].tag = tx_content['label']
+            # We don't need to go through the outputs of this tx as we've already found out where the BTC are from.
+        elif self.forward_layer_counter < self.forward_nb_layers:
+            # We select the outputs that we want to keep
+            t_input = time.time()
+            # To manage the case with OPCODE (see notes)
+            selected_outputs = [add for add in self.select_outputs(tx_content, txid) if add['is_standard']]
+            if self.pipelining:  # The tx not found yet will be parsed in the next layer, we can request them already
                 for add in selected_outputs:
-                    if add['is_standard']:  # To manage the case with OPCODE (see notes)
-                        t_0_tx = time.time()
-                        if "next_tx" not in add:  # No next_txid when btc has not been spent yet
-                            add['next_tx'] = f"unspent_tx_{self.unspent_tx_counter}"
-                            self.unspent_tx_counter += 1
-
-                        if "label" in add:
-                            tag = add['label']
-                        else:
-                            tag = None
-
-                        tx_layer, i = find_transaction(self.transaction_lists, add["next_tx"],
-                                                       start_index=self.nb_layers)
-                        t_tx.append(time.time() - t_0_tx)
-                        if i == -1:  # Means we have not added that txid to the next layer yet
-                            self.transaction_lists[self.nb_layers + self.forward_layer_counter].append(
-                                Transaction(txid=add['next_tx'],
-                                            prev_txid=[(txid, self.nb_layers + self.forward_layer_counter - 1)],
-                                            amount=add['amount'],
-                                            rto=add['rto'],
-                                            input_addresses=[add['address']],
-                                            tag=tag))
-
-                        else:
-                            self.added_before.append(add['next_tx'])
-                            if self.transaction_lists[tx_layer][i].prev_txid:
-                                prev_txid_list = [elt[0] for elt in self.transaction_lists[tx_layer][i].prev_txid]
-                            else:
-                                prev_txid_list = []
-                            if txid not in prev_txid_list:
-                                # If the txid is already in the list, it means that we ended up on a loop
-                                self.transaction_lists[tx_layer][i].amount += add['amount']
-                                self.transaction_lists[tx_layer][i] \
-                                    .prev_txid.append((txid, self.nb_layers + self.forward_layer_counter - 1))
-                                self.transaction_lists[tx_layer][i].input_addresses.append(add['address'])
-                                self.transaction_lists[tx_layer][i].rto += add['rto']
-
-                t_tx_avg = np.mean(t_tx) if t_tx else 0
-                self.time_stat_dict['request'][self.nb_layers + self.forward_layer_counter].append(t_request - t_0)
-                self.time_stat_dict['select_input'][self.nb_layers + self.forward_layer_counter] \
-                    .append(t_adding - t_input)
-                self.time_stat_dict['adding_addresses'][self.nb_layers + self.forward_layer_counter] \
-                    .append(time.time() - t_adding)
-                self.time_stat_dict['find_tx'][self.nb_layers + self.forward_layer_counter].append(t_tx_avg)
-
-            if self.layer_counter < self.nb_layers:
-                self.time_stat_dict['overall'][self.nb_layers + self.forward_layer_counter].append(time.time() - t_0)
-            return link
+                    if "next_tx" not in add or "label" in add:  # Unspent or tagged: not parsed
+                        continue
+                    if find_transaction(self.transaction_lists, add["next_tx"], start_index=self.nb_layers)[1] == -1:
+                        self.fetch_engine.prefetch(self._tx_url(add['next_tx']))
+            selection = txid, selected_outputs
+
+            self.time_stat_dict['request'][layer].append(request_time)
+            self.time_stat_dict['select_input'][layer].append(time.time() - t_input)
+
+        if self.layer_counter < self.nb_layers:
+            self.time_stat_dict['overall'][layer].append(time.time() - t_0 + request_time)
+        return selection
+
+    def _add_output_addresses(self, selection):
+        """
+        Called by get_output_addresses_from_txid once every page of the layer has been handled, in the order of the
+        layer. Adds the selected outputs of a transaction to the next layer, or to the transaction they go to if it
+        has already been found.
+        :param selection: Tuple (txid, selected outputs) returned by _get_output_addresses
+        :return: None
+        """
+        txid, selected_outputs = selection
+        layer = self.nb_layers + self.forward_layer_counter
+        t_adding = time.time()
+        t_tx = []
+        for add in selected_outputs:
+            t_0_tx = time.time()
+            if "next_tx" not in add:  # No next_txid when btc has not been spent yet
+                add['next_tx'] = f"unspent_tx_{self.unspent_tx_counter}"
+                self.unspent_tx_counter += 1
+
+            if "label" in add:
+                tag = add['label']
+            else:
+                tag = None
+
+            tx_layer, i = find_transaction(self.transaction_lists, add["next_tx"], start_index=self.nb_layers)
+            t_tx.append(time.time() - t_0_tx)
+            if i == -1:  # Means we have not added that txid to the next layer yet
+                self.transaction_lists[layer].append(
+                    Transaction(txid=add['next_tx'],
+                                prev_txid=[(txid, layer - 1)],
+                                amount=add['amount'],
+                                rto=add['rto'],
+                                input_addresses=[add['address']],
+                                tag=tag))
+                self.transaction_lists.add_link((txid, layer - 1), (add['next_tx'], layer))
+
+            else:
+                self.added_before.append(add['next_tx'])
+                if self.transaction_lists[tx_layer][i].prev_txid:
+                    prev_txid_list = [elt[0] for elt in self.transaction_lists[tx_layer][i].prev_txid]
+                else:
+                    prev_txid_list = []
+                if txid not in prev_txid_list:
+                    # If the txid is already in the list, it means that we ended up on a loop
+                    self.transaction_lists[tx_layer][i].amount += add['amount']
+                    self.transaction_lists[tx_layer][i].prev_txid.append((txid, layer - 1))
+                    self.transaction_lists.add_link((txid, layer - 1), (add['next_tx'], tx_layer))
+                    self.transaction_lists[tx_layer][i].input_addresses.append(add['address'])
+                    self.transaction_lists[tx_layer][i].rto += add['rto']
+
+        self.time_stat_dict['adding_addresses'][layer].append(time.time() - t_adding)
+        self.time_stat_dict['find_tx'][layer].append(np.mean(t_tx) if t_tx else 0)
 
     def select_outputs(self, tx_content, txid):
         """
-        Selects outputs that we will continue to investigate. Refer to the decision tree to have a better understanding
-        on how we decided to handle the different cases
+        Selects outputs that we will continue to investigate (see tx_selection.select_outputs).
         :param txid: Transaction ID
-        :param tx_content: Content of the transaction that we are currently looking.
+        :param tx_content: Content of the transaction that we are currently looking. If it has been selected by a
+        worker process (see replay_selected), the selection is used as long as the observed tx has not changed since.
         :return: selected output addresses
         """
-
-        # We sort in and out lists as it will be necessary in a further step
-        tx_content['in'].sort(key=lambda x: x['amount'])
-        tx_content['out'].sort(key=lambda x: x['amount'])
-
         # We get the previous transaction, from which tx_content comes from. (So, from the previous layer)
         # This transaction is unique.
         tx_index = find_transaction(self.transaction_lists, txid, layer=self.nb_layers + self.forward_layer_counter - 1)
         if tx_index == -1:  # This case should never happen in theory
+            tx_content = self._full_content(tx_content)
             print(f"Error, something went wrong. Selecting all inputs by default.")
             self.set_rto(tx_content['out'], -1, forward=True)
             return tx_content['out']
-        else:
-            observed_addresses = self.transaction_lists[
-                self.nb_layers + self.forward_layer_counter - 1][tx_index].input_addresses
-            observed_rto = self.transaction_lists[self.nb_layers + self.forward_layer_counter - 1][tx_index].rto
-            observed_inputs = [add for add in tx_content['in'] if add['address'] in observed_addresses]
-
-            # Remove "out" transactions that go to a change address
-            for i in range(len(tx_content['out']) - 1, -1, -1):
-                if tx_content['out'][i]['address'] in observed_addresses \
-                        or tx_content['out'][i]['is_standard'] is False:  # or \
-                    # tx_content['wallet_id'] == tx_content['out'][i]['wallet_id']:
-                    tx_content['out'].pop(i)
-
-        input_values = [add['amount'] for add in tx_content['in']]
-        output_values = [add['amount'] for add in tx_content['out']]
-
-        if len(output_values) > 1:
-            # First, we calculate the tx fee by adding all the input values and subtracting the output values
-            tx_fee = sum(input_values) - sum(output_values)
-
-            # Then, 1st check: output_values match with input_values AND that we have the same number of input/outputs
-            for i in range(len(input_values)):
-                input_values[i] -= tx_fee  # Subtracts the tx_fee to each input_value to see whether it works or not
-                input_values.sort()
-                if input_values == output_values:
-                    # Only ONE input value matches our output value(s) (two by two)
-                    # - there can be multiple output addresses to look at
-                    used_indexes = set()
-                    for add in observed_inputs:
-                        if add['amount'] in input_values and output_values.index(add['amount']) not in used_indexes:
-                            used_indexes.add(input_values.index(add['amount']))
-                    if len(used_indexes) == len(observed_addresses):  # If it's the case:
-                        selected_outputs = [tx_content['out'][i] for i in used_indexes]
-                        print(f"FINALLY")
-                    else:
-                        selected_outputs = tx_content['out']
-
-                    # We set the RTO to all the selected transactions
-                    self.set_rto(selected_outputs, observed_rto, forward=True)
-                    return selected_outputs
-
-            # Second check: there is a sublist of input values whose sum equals our input values (two by two)
-            # - Again, there can be multiple output values to look at
-            # TODO: Implement that part, complexity of n! so we need to find another way.
-
-            # Third check: if one output value represents more than 95% of the tot.
-            if output_values[-1] / sum(
-                    output_values) > 0.95:
-                selected_outputs = [tx_content['out'][-1]]
 
-            else:
-                # We also want to prune tx if a number -let's say 20%- of tx represents more than 80% of the total
-                nb_tx = math.ceil(len(output_values) * 0.2)
-                if sum(output_values[-1 - nb_tx:]) / sum(output_values) > 0.80:
-                    selected_outputs = tx_content['out'][-1 - nb_tx:]
-
-                elif len(output_values) > 50:  # If too many transactions, we prune them and only take the 10 biggest
-                    selected_outputs = tx_content['out'][-1 - 10:]
-                else:  # If none of the above conditions hold, we take all the outputs
-                    selected_outputs = tx_content['out']
-
-        else:
-            # Need to add the rto to the only input transaction (= to previous rto)
-            selected_outputs = tx_content['out']
-
-        if len(selected_outputs) != len(tx_content['out']):
-            self.transaction_lists[self.nb_layers + self.forward_layer_counter - 1][tx_index].is_pruned = True
-
-        self.set_rto(selected_outputs, observed_rto, forward=True)  # We set the RTO to all the selected transactions
-        # and remove low ones
+        observed_tx = self.transaction_lists[self.nb_layers + self.forward_layer_counter - 1][tx_index]
+        selected_outputs, stats = self._precomputed_selection(tx_content, observed_tx.input_addresses, observed_tx.rto)
+        if selected_outputs is None:
+            selected_outputs, stats = tx_selection.select_outputs(self._full_content(tx_content),
+                                                                  observed_tx.input_addresses, observed_tx.rto,
+                                                                  self.forward_rto_threshold)
+        if stats['is_pruned']:
+            observed_tx.is_pruned = True
         return selected_outputs
 
 
-def waiting_bar(seconds):
-    """
-    Loading bar waiting for "seconds" sec
-    :param seconds: number of seconds to wait
-    :return:
-    """
-    for _ in tqdm(range(seconds)):
-        time.sleep(1)
-
-
 def sub_array_sum(arr, sum_):
     curr_sum = arr[0]
     start = 0
@@ -0,0 +1,617 @@
+import asyncio
+import copy
+import json
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests_cache
+from requests_cache import NEVER_EXPIRE
+from requests import HTTPError, Request
+from requests.adapters import HTTPAdapter
+from requests_cache.serializers.cattrs import CattrStage
+
+from rate_limiter import AdaptiveConcurrency
+from request_limit_reached import RequestLimitReached
+from tx_store import create_database, txid_from_url
+
+SESSION_POOL_SIZE = 32  # Maximum number of connections kept alive by the shared session (per host)
+
+# Expiration times of the cached pages, per endpoint of the WalletExplorer API. Set once on the shared session.
+TX_PAGE_EXPIRE_AFTER = NEVER_EXPIRE  # Transaction pages never change once the transaction is confirmed
+ADDRESS_PAGE_EXPIRE_AFTER = timedelta(hours=1)  # Address pages change with every new transaction of the wallet
+UNKNOWN_ADDRESS_EXPIRE_AFTER = timedelta(minutes=10)  # Negative caching of the addresses the API does not know
+CACHE_POLICIES = {
+    '*/api/1/tx': TX_PAGE_EXPIRE_AFTER,
+    '*/api/1/address': ADDRESS_PAGE_EXPIRE_AFTER,
+}
+
+_loop = None
+_loop_lock = threading.Lock()
+_session = None
+_session_lock = threading.Lock()
+_in_flight = dict()  # URL -> _Flight of the request being made for that URL (only used from the event loop)
+# Cache key -> last time a response of the session cache has been read or saved, not written to the cache yet: the
+# janitor writes them at each pass (see CacheJanitor), so that reading the cache does not turn into writes
+_response_accesses = dict()
+_response_accesses_lock = threading.Lock()
+
+
+def get_event_loop():
+    """
+    Returns the event loop shared by every FetchEngine of the process. It runs forever in a background thread, so that
+    synchronous code (ChainParser, websocket consumers) can schedule coroutines on it.
+    :return: asyncio event loop
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            # Blocking calls made by the engines (= requests_cache calls) run on this executor
+            _loop.set_default_executor(ThreadPoolExecutor(max_workers=32, thread_name_prefix="fetch_engine"))
+            threading.Thread(target=_loop.run_forever, name="fetch_engine_loop", daemon=True).start()
+    return _loop
+
+
+def get_session(pool_size=SESSION_POOL_SIZE):
+    """
+    Returns the requests_cache session shared by every FetchEngine of the process. It is never closed, so that its
+    keep-alive connections and its cache connection are reused across layers, rate limit pauses and parsers.
+    The expiration time of the cached pages depends on their endpoint (see CACHE_POLICIES).
+    :param pool_size: Size of the connection pool of the session (only used when the session is created)
+    :return: requests_cache.CachedSession
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            create_database('parser_cache.sqlite')  # Before requests_cache creates it (see cache_janitor)
+            _session = requests_cache.CachedSession('parser_cache',
+                                                    # use_cache_dir=True,  # Save files in the default user cache dir
+                                                    cache_control=True,
+                                                    # Use Cache-Control headers for expiration, if available
+                                                    urls_expire_after=CACHE_POLICIES,
+                                                    )
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+    return _session
+
+
+def load_stored_response(serializer, value):
+    """
+    Deserializes a response stored in the SQLite cache of a requests_cache session into a dict (url, _content,
+    expires...), without building the CachedResponse.
+    :param serializer: Serializer of the cache (session.cache.responses.serializer)
+    :param value: Serialized response, as stored in the responses table
+    :return: Dict of the attributes of the response
+    """
+    for stage in reversed(serializer.stages):
+        if isinstance(stage, CattrStage):  # Last stage, used to build the CachedResponse
+            break
+        value = stage.loads(value)
+    return value
+
+
+def record_response_access(keys):
+    """
+    Records that the responses stored under keys in the session cache have just been used.
+    :param keys: Iterable of cache keys
+    :return: None
+    """
+    now = int(time.time())
+    with _response_accesses_lock:
+        for key in keys:
+            _response_accesses[key] = now
+
+
+def take_response_accesses():
+    """
+    :return: Dict cache key -> time of the last access, of the accesses recorded since the last call
+    """
+    global _response_accesses
+    with _response_accesses_lock:
+        accesses, _response_accesses = _response_accesses, dict()
+    return accesses
+
+
+def parse_retry_after(value):
+    """
+    Parses the Retry-After header of a response, which is either a number of seconds or an HTTP date.
+    :param value: Value of the header (or None)
+    :return: Number of seconds to wait (float), None if the header is missing or invalid
+    """
+    if value is None:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0., (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_unknown_address_page(url, content):
+    """
+    :param url: URL of a WalletExplorer API page
+    :param content: Decoded content of the page
+    :return: True if url is an address page and the API does not know the address (or it has no transaction yet)
+    """
+    if not urlsplit(url).path.endswith("/api/1/address"):
+        return False
+    return not content.get('found', True) or content.get('txs_count', 0) == 0
+
+
+class _Flight:
+    def __init__(self):
+        """
+        Request shared by every coroutine asking for the same URL while it is in flight (see FetchEngine.fetch).
+        """
+        self.task = None  # asyncio Task making the request
+        self.nb_requesters = 0
+        self.started = False  # True once the request has been handed to the executor (it cannot be stopped anymore)
+
+
+def _end_flight(url, task):
+    """
+    Called once the request of a flight is over: later requests for url will be made again (or read from the cache).
+    :param url: URL of the flight
+    :param task: Task of the flight
+    :return: None
+    """
+    if url in _in_flight and _in_flight[url].task is task:  # Not a flight started after this one was abandoned
+        del _in_flight[url]
+    if not task.cancelled():
+        task.exception()  # Retrieved here, in case every requester of the flight has been cancelled in the meantime
+
+
+class InvalidRequest(Exception):
+    """
+    Raised when the server rejected a request for a reason that retrying won't change (4xx error other than 429).
+    """
+    pass
+
+
+class FetchEngine:
+    def __init__(self, session, rate_limiter, max_requests_in_flight=4, max_cached_in_flight=8, max_tries=5,
+                 expire_after=None, tx_store=None):
+        """
+        Makes the requests of a ChainParser from the shared asyncio event loop. Only fetches and decodes the pages:
+        the content of each page is then handed to a callback, which does not need to know anything about HTTP.
+        :param session: requests_cache.CachedSession used to make the requests (keeps the cache semantics)
+        :param rate_limiter: TokenBucket used to stay within the API rate limit for uncached requests
+        :param max_requests_in_flight: Maximum number of uncached requests running at the same time
+        :param max_cached_in_flight: Maximum number of cached requests running at the same time
+        :param max_tries: Number of times a request is tried before giving up on that URL
+        :param expire_after: Expiration time of the address pages saved by this engine (same values as requests_cache's
+        expire_after, -1 = never expire). If None, the policies of the session are used (see CACHE_POLICIES).
+        Transaction pages never expire.
+        :param tx_store: Optional TxStore. If given, transaction pages are stored there instead of the session cache.
+        """
+        self.session = session
+        self.expire_after = expire_after
+        self.tx_store = tx_store
+        self.rate_limiter = rate_limiter
+        self.max_requests_in_flight = max_requests_in_flight
+        self.max_cached_in_flight = max_cached_in_flight
+        self.max_tries = max_tries
+        self.loop = get_event_loop()
+
+        # Number of uncached requests in flight, adapted to the rate limit errors we get
+        self.concurrency = AdaptiveConcurrency(max_requests_in_flight)
+        self._cached_semaphore = None  # Created from the event loop thread (see _semaphore)
+
+        self.backoff_base = 1  # Seconds to wait before the first retry of a failed request (doubled at every try)
+        self.backoff_cap = 60  # Maximum number of seconds to wait before retrying a failed request
+        self.paused_until = 0  # No uncached request is started before that time (after a 429 error)
+        self.on_pause = None  # Optional function called with the number of seconds of every new pause
+
+        self._prefetched = dict()  # URL -> concurrent.futures.Future of a page requested in advance (see prefetch)
+        self._prefetch_lock = threading.Lock()
+
+    def _semaphore(self):
+        """
+        Returns the semaphore limiting the number of cached requests in flight. Must be called from the loop.
+        """
+        if self._cached_semaphore is None:
+            self._cached_semaphore = asyncio.Semaphore(self.max_cached_in_flight)
+        return self._cached_semaphore
+
+    def cache_key(self, url):
+        """
+        Computes the key under which the session caches the GET request made to url (without making the request).
+        :param url: URL to compute the key of
+        :return: Cache key (str)
+        """
+        request, settings = self._prepare(url)
+        return self.session.cache.create_key(request, verify=settings['verify'])
+
+    def _prepare(self, url):
+        """
+        Prepares the GET request to url the same way session.get would.
+        :param url: URL to request
+        :return: Tuple (prepared request, settings to send it with)
+        """
+        request = self.session.prepare_request(Request('GET', url))
+        # The key depends on the 'verify' setting, which can be overridden by environment variables (REQUESTS_CA_BUNDLE)
+        settings = self.session.merge_environment_settings(request.url, {}, None, None, None)
+        return request, settings
+
+    def _select_by_keys(self, columns, keys):
+        """
+        Generator going through the rows of the SQLite responses table whose key is in keys. Keys are looked up by
+        batches on the primary key of the table instead of going through every cached response.
+        :param columns: Columns to select (str, e.g. "key, value")
+        :param keys: List of cache keys
+        :return: Selected rows
+        """
+        responses = self.session.cache.responses
+        batch_size = 500  # SQLite limits the number of variables in a query
+        with responses.connection() as con:
+            for i in range(0, len(keys), batch_size):
+                batch = keys[i:i + batch_size]
+                query = f"SELECT {columns} FROM {responses.table_name} WHERE key IN ({','.join(['?'] * len(batch))})"
+                yield from con.execute(query, batch)
+
+    def _cached_keys(self, keys):
+        """
+        Returns the subset of keys that are stored in the cache.
+        :param keys: Set of cache keys
+        :return: Set of cached keys
+        """
+        if not hasattr(self.session.cache.responses, 'connection'):  # Not a SQLite backend
+            return {key for key in keys if self.session.cache.contains(key=key)}
+        return {row[0] for row in self._select_by_keys("key", list(keys))}
+
+    def partition_cached(self, url_list):
+        """
+        Splits url_list into the URLs that are already cached and those that need to be requested, in
+        O(len(url_list)) whatever the size of the cache.
+        :param url_list: List of URLs
+        :return: Tuple (list of cached URLs, list of uncached URLs), both in the order of url_list
+        """
+        stored_txids = self._stored_txids(url_list)
+        keys = {url: self.cache_key(url) for url in url_list if txid_from_url(url) not in stored_txids}
+        cached_keys = self._cached_keys(set(keys.values()))
+        cached_urls = [url for url in url_list if url not in keys or keys[url] in cached_keys]
+        uncached_urls = [url for url in url_list if url in keys and keys[url] not in cached_keys]
+        # Pages prefetched in the meantime are now in the cache, we won't need their future anymore
+        self._discard_prefetched(cached_urls)
+        return cached_urls, uncached_urls
+
+    def is_cached(self, url):
+        """
+        :param url: URL to look for
+        :return: True if the page at url is in the cache (or in the transaction store), False otherwise
+        """
+        return bool(self._stored_txids([url]) or self._cached_keys({self.cache_key(url)}))
+
+    def _stored_txids(self, url_list):
+        """
+        :param url_list: List of URLs
+        :return: Set of the txids of the transaction pages of url_list that are in the transaction store
+        """
+        if self.tx_store is None:
+            return set()
+        return self.tx_store.contains_many({txid_from_url(url) for url in url_list} - {None})
+
+    def get_many_encoded(self, url_list):
+        """
+        :param url_list: List of URLs
+        :return: Dict txid -> encoded transaction (see tx_store.encode_tx), for the transaction pages of url_list that
+        are in the transaction store
+        """
+        if self.tx_store is None:
+            return dict()
+        return self.tx_store.get_many_encoded({txid_from_url(url) for url in url_list} - {None})
+
+    def _get(self, url):
+        """
+        Blocking request to url (served from the cache if possible), run on the loop executor.
+        :param url: URL to request
+        :return: Decoded JSON content of the page
+        """
+        txid = txid_from_url(url) if self.tx_store is not None else None
+        if txid is not None:
+            stored_tx = self.tx_store.get_many([txid])
+            if stored_tx:
+                return stored_tx[txid]
+        try:
+            request, settings = self._prepare(url)
+            cache_key = self.session.cache.create_key(request, verify=settings['verify'])
+            # The page goes to the transaction store, no need to cache the whole response (unless the store could not
+            # take it, see below)
+            if txid is not None and not self.session.cache.contains(key=cache_key):
+                request.headers['Cache-Control'] = 'no-store'
+            # Only address pages can be given another expiration time than the one of the session policies
+            expire_after = self.expire_after if txid_from_url(url) is None else None
+            req = self.session.send(request, expire_after=expire_after, **settings)
+            # If the response was successful, no Exception will be raised
+            req.raise_for_status()
+        except HTTPError as err:
+            if err.response.status_code == 429:
+                raise RequestLimitReached(f"Request limit reached. ({err})",
+                                          retry_after=parse_retry_after(err.response.headers.get('Retry-After')))
+            print(f'fetch_engine - Error occurred: {err}')
+            if 400 <= err.response.status_code < 500:
+                raise InvalidRequest(f"Error occurred: {err}")
+            raise Exception(f"Error occurred: {err}")
+        except Exception as err:
+            print(f'fetch_engine - Error occurred: {err}')
+            raise Exception(f"Error occurred: {err}")
+        content = req.json()
+        from_cache = getattr(req, 'from_cache', False)
+        if txid is not None and not from_cache:
+            if self.tx_store.put(txid, content):
+                return content
+            # The page cannot be stored without losing information (see TxStore.put_many): the whole response is
+            # cached instead, so that it is not requested again at the next run (tx pages never expire)
+            self.session.cache.save_response(req, cache_key=cache_key)
+        record_response_access([cache_key])  # Least recently used pages are evicted first (see CacheJanitor)
+        if txid is None and not from_cache and is_unknown_address_page(url, content):
+            # Negative caching: asked again sooner than the other address pages, as the address may get transactions
+            self.session.cache.save_response(req, cache_key=cache_key,
+                                             expires=datetime.utcnow() + UNKNOWN_ADDRESS_EXPIRE_AFTER)
+        return content
+
+    def _backoff(self, attempt):
+        """
+        :param attempt: Number of tries already made for the request (starting at 0)
+        :return: Number of seconds to wait before retrying (exponential backoff with full jitter)
+        """
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def _pause(self, seconds):
+        """
+        Prevents any new uncached request from being started during the next few seconds.
+        :param seconds: Duration of the pause
+        :return: None
+        """
+        if time.time() + seconds > self.paused_until:
+            print(f"fetch_engine - Request limit reached. Pausing requests for {seconds:.1f}sec...")
+            self.paused_until = time.time() + seconds
+            if self.on_pause is not None:  # Not called from the loop thread, as it may block (e.g. websocket send)
+                self.loop.run_in_executor(None, self.on_pause, seconds)
+
+    async def _wait_for_pause(self):
+        """
+        Coroutine returning once the current pause (if any) is over.
+        """
+        while self.paused_until > time.time():
+            await asyncio.sleep(self.paused_until - time.time())
+
+    async def fetch(self, url, cached=False):
+        """
+        Coroutine fetching a single page. Concurrent requests for the same URL (from any engine of the process, e.g.
+        the same tx reached from several parents, or two parsers tracing overlapping cases) share a single request.
+        Each requester then gets its own copy of the content, as the parsers modify the pages they are given.
+        :param url: URL to request
+        :param cached: True if we know that the URL is cached (= no need to respect the rate limit)
+        :return: Tuple (decoded content of the page, time taken by the request in seconds)
+        """
+        flight = _in_flight.get(url)
+        if flight is None:
+            flight = _Flight()
+            flight.task = asyncio.ensure_future(self._fetch(url, cached, flight))
+            _in_flight[url] = flight
+            # Registered before any requester awaits the task, so that no one can join the flight once it is over
+            flight.task.add_done_callback(lambda task: _end_flight(url, task))
+        flight.nb_requesters += 1
+        # Shielded: a requester being cancelled (e.g. a discarded prefetch) does not cancel the request of the others
+        try:
+            content, request_time = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            flight.nb_requesters -= 1
+            if flight.nb_requesters == 0 and not flight.started:
+                # No one needs the page anymore and it is still waiting for a slot: the request is not made. Requests
+                # already made are left to finish, so that they keep their slot and their page gets cached.
+                del _in_flight[url]
+                flight.task.cancel()
+            raise
+        if flight.nb_requesters > 1:
+            content = copy.deepcopy(content)
+        return content, request_time
+
+    async def _fetch(self, url, cached=False, flight=None):
+        """
+        Coroutine fetching a single page. Uncached requests wait for the rate limiter before being made, and are
+        retried if they fail: after the delay given by the Retry-After header for 429 errors (which pauses every
+        other request as well), for as long as the API asks us to wait; after an exponential backoff otherwise, up to
+        max_tries times.
+        :param url: URL to request
+        :param cached: True if we know that the URL is cached (= no need to respect the rate limit)
+        :param flight: _Flight of the request, if it is shared (see fetch)
+        :return: Tuple (decoded content of the page, time taken by the request in seconds)
+        """
+        if cached:
+            async with self._semaphore():
+                if flight is not None:
+                    flight.started = True
+                t_0 = time.time()
+                content = await self.loop.run_in_executor(None, self._get, url)
+                return content, time.time() - t_0
+
+        attempt = 0  # Rate-limit pauses don't count against max_tries: the API only asks us to wait
+        nb_limits = 0  # Number of 429 errors, for the length of the pauses without a Retry-After header
+        while True:
+            await self._wait_for_pause()
+            await self.concurrency.acquire()
+            t_0 = time.time()
+            try:
+                await self._wait_for_pause()  # A 429 error may have occurred while we were waiting for a slot
+                await self.rate_limiter.acquire_async()
+                if flight is not None:
+                    flight.started = True
+                t_0 = time.time()
+                content = await self.loop.run_in_executor(None, self._get, url)
+            except RequestLimitReached as err:
+                self.concurrency.on_limit_reached(t_0)
+                self._pause(err.retry_after if err.retry_after is not None else self._backoff(nb_limits))
+                nb_limits += 1
+                continue  # The next try waits for the end of the pause
+            except InvalidRequest:
+                raise
+            except Exception:
+                attempt += 1
+                if attempt == self.max_tries:
+                    raise
+            else:
+                self.concurrency.on_success()
+                return content, time.time() - t_0
+            finally:
+                await self.concurrency.release()
+            await asyncio.sleep(self._backoff(attempt - 1))
+
+    async def _fetch_batch(self, url_list, cached, results):
+        """
+        Fetches every URL of url_list concurrently and puts (url, content, request_time, error) tuples in results.
+        """
+        async def fetch_one(url):
+            with self._prefetch_lock:
+                prefetched = self._prefetched.pop(url, None)
+            try:
+                result = None
+                if prefetched is not None:  # If the page has already been requested in advance, we use that result
+                    result = await asyncio.wrap_future(prefetched)
+                if result is None:
+                    result = await self.fetch(url, cached)
+            except Exception as err:
+                results.put((url, None, 0, err))
+            else:
+                results.put((url, result[0], result[1], None))
+
+        await asyncio.gather(*[fetch_one(url) for url in url_list])
+
+    def fetch_all(self, url_list, callback, cached=False):
+        """
+        Fetches every URL of url_list from the event loop and calls callback(url, content, request_time) from the
+        calling thread as soon as each page arrives. Callbacks are therefore never run concurrently.
+        :param url_list: List of URLs to fetch
+        :param callback: Function called with every page that was successfully fetched
+        :param cached: True if every URL of url_list is cached
+        :return: List of URLs that have not gone through (even after retrying them), and the last error encountered.
+        InvalidRequest is only returned if every URL failed because of such an error.
+        """
+        results = queue.Queue()
+        batch = asyncio.run_coroutine_threadsafe(self._fetch_batch(url_list, cached, results), self.loop)
+
+        failed_urls = []
+        last_err = None
+        try:
+            for _ in range(len(url_list)):
+                url, content, request_time, err = results.get()
+                if content is not None:
+                    callback(url, content, request_time)
+                else:
+                    failed_urls.append(url)
+                    if last_err is None or isinstance(last_err, InvalidRequest):
+                        last_err = err
+        except BaseException:
+            batch.cancel()
+            raise
+        return failed_urls, last_err
+
+    def fetch_one(self, url):
+        """
+        Fetches a single page and waits for the result.
+        :param url: URL to request
+        :return: Decoded content of the page
+        """
+        content, _ = asyncio.run_coroutine_threadsafe(self.fetch(url), self.loop).result()
+        return content
+
+    async def _prefetch(self, url):
+        """
+        Coroutine requesting an uncached page in advance, so that it is (being) fetched by the time we need it.
+        Prefetches queue behind the other requests for a request slot, and are not started during a pause.
+        :param url: URL to request
+        :return: Same as fetch, or None if the page has not been requested (cached page or pause)
+        """
+        if time.time() < self.paused_until or await self.loop.run_in_executor(None, self.is_cached, url):
+            return None
+        return await self.fetch(url)
+
+    def prefetch(self, url):
+        """
+        Starts requesting url in the background (if it is not already being prefetched). Its result is used by
+        fetch_all when the URL is requested, or simply read from the cache if the request has finished by then.
+        :param url: URL to request
+        :return: None
+        """
+        with self._prefetch_lock:
+            if url not in self._prefetched:
+                self._prefetched[url] = asyncio.run_coroutine_threadsafe(self._prefetch(url), self.loop)
+
+    def _discard_prefetched(self, url_list):
+        """
+        Forgets (and cancels if still running) the prefetches of the URLs in url_list.
+        :param url_list: List of URLs
+        :return: None
+        """
+        with self._prefetch_lock:
+            for url in url_list:
+                prefetched = self._prefetched.pop(url, None)
+                if prefetched is not None:
+                    prefetched.cancel()
+
+    def _decode_stored_response(self, value):
+        """
+        Decodes the JSON body of a response stored in the SQLite cache, without rebuilding the whole CachedResponse
+        (headers, cookies, dates...) as the session would do.
+        :param value: Serialized response, as stored in the responses table
+        :return: Decoded content of the page, None if the response has expired
+        """
+        value = load_stored_response(self.session.cache.responses.serializer, value)
+        if value.get('expires') and datetime.fromisoformat(value['expires']) < datetime.utcnow():
+            return None
+        return json.loads(value['_content'])
+
+    def replay(self, url_list, callback):
+        """
+        Reads the pages of cached URLs straight from the cache, by batches of keys, and calls
+        callback(url, content, request_time) for each of them (in the order of url_list), from the calling thread.
+        :param url_list: List of cached URLs
+        :param callback: Function called with every page that was found in the cache
+        :return: List of URLs that could not be read from the cache (e.g. expired), and None (no request error)
+        """
+        if not hasattr(self.session.cache.responses, 'connection') \
+                or not hasattr(self.session.cache.responses.serializer, 'stages'):
+            return self.fetch_all(url_list, callback, cached=True)
+
+        failed_urls = []
+        batch_size = 500
+        for i in range(0, len(url_list), batch_size):
+            t_0 = time.time()
+            batch = url_list[i:i + batch_size]
+            stored_txs = self.tx_store.get_many({txid_from_url(url) for url in batch} - {None}) \
+                if self.tx_store is not None else dict()
+            keys = {url: self.cache_key(url) for url in batch if txid_from_url(url) not in stored_txs}
+            contents = {}
+            for key, value in self._select_by_keys("key, value", list(set(keys.values()))):
+                try:
+                    contents[key] = self._decode_stored_response(value)
+                except Exception as err:
+                    print(f'fetch_engine - Could not read cached response: {err}')
+            request_time = (time.time() - t_0) / len(batch)
+            record_response_access([key for key, content in contents.items() if content is not None])
+
+            if self.tx_store is not None:  # Transaction pages cached before the store existed are moved to the store
+                self.tx_store.put_many({txid_from_url(url): contents[keys[url]] for url in keys
+                                        if txid_from_url(url) is not None and contents.get(keys[url]) is not None})
+
+            for url in batch:
+                if url in keys:
+                    content = contents.get(keys[url])
+                else:
+                    content = stored_txs[txid_from_url(url)]
+                if content is None:
+                    failed_urls.append(url)
+                else:
+                    callback(url, content, request_time)
+        return failed_urls, None
@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import re
+import time
+from datetime import timedelta
+
+from chain_parser import ChainParser
+
+TXID_PATTERN = re.compile(r"^[0-9a-fA-F]{64}$")
+# Expiration time of the address pages saved by the prefetch: they must still be cached when the case is analysed
+# (e.g. the next morning), whereas interactive runs only keep them for an hour (see fetch_engine.CACHE_POLICIES)
+PREFETCH_ADDRESS_EXPIRE_AFTER = timedelta(hours=36)
+
+
+def read_entries(path):
+    """
+    Reads the addresses and txids to prefetch, one per line. Empty lines and lines starting with # are ignored.
+    :param path: Path of the file
+    :return: List of entries (str), without duplicates, in the order of the file
+    """
+    entries, seen = [], set()
+    with open(path) as f:
+        for line in f:
+            entry = line.strip()
+            if entry and not entry.startswith("#") and entry not in seen:
+                entries.append(entry)
+                seen.add(entry)
+    return entries
+
+
+class PrefetchState:
+    def __init__(self, path):
+        """
+        Entries that have already been prefetched, saved after every entry so that an interrupted run can be resumed.
+        :param path: Path of the JSON file the state is saved in
+        """
+        self.path = path
+        self.done = dict()  # Entry -> Parameters it has been prefetched with
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done = json.load(f).get('done', dict())
+
+    def is_done(self, entry, params):
+        """
+        :param entry: Address or txid
+        :param params: Parameters of the run (depth, threshold...)
+        :return: True if entry has already been prefetched with the same parameters
+        """
+        return self.done.get(entry) == params
+
+    def mark_done(self, entry, params):
+        """
+        Records that entry has been prefetched, and saves the state.
+        :param entry: Address or txid
+        :param params: Parameters of the run
+        :return: None
+        """
+        self.done[entry] = params
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({'done': self.done}, f, indent=1)
+        os.replace(tmp_path, self.path)  # The state is never left half-written if the run is interrupted
+
+
+def prefetch(entries, state, backward_layers=0, forward_layers=0, rto_threshold=0.1,
+             address_expire_after=PREFETCH_ADDRESS_EXPIRE_AFTER, **parser_kwargs):
+    """
+    Runs the analysis of every entry that has not been prefetched yet, so that every page the analysis needs ends up
+    in the cache. Layers are expanded with the same selection as an interactive run (select_inputs/select_outputs),
+    so the next run with the same parameters is served from the cache.
+    :param entries: List of addresses and txids
+    :param state: PrefetchState
+    :param backward_layers: Number of backward layers to prefetch
+    :param forward_layers: Number of forward layers to prefetch
+    :param rto_threshold: RTO threshold of the analysis (in percentage of the root value)
+    :param address_expire_after: Expiration time of the address pages saved (transaction pages never expire)
+    :param parser_kwargs: Other arguments given to ChainParser (requests_per_second, base_url...)
+    :return: List of the entries that could not be prefetched
+    """
+    params = {'backward_layers': backward_layers, 'forward_layers': forward_layers, 'rto_threshold': rto_threshold}
+    failed = []
+    parser = None  # Created for the 1st entry, then reset for the next ones (see ChainParser.reset)
+    for i, entry in enumerate(entries):
+        progress = f"[{i + 1}/{len(entries)}]"
+        if state.is_done(entry, params):
+            print(f"prefetch - {progress} {entry} already prefetched, skipping it.")
+            continue
+        print(f"prefetch - {progress} Prefetching {entry}...")
+        t_0 = time.time()
+        is_txid = TXID_PATTERN.match(entry) is not None
+        try:
+            if parser is None:
+                parser = ChainParser(entry, backward_layers=backward_layers, forward_layers=forward_layers,
+                                     rto_threshold=rto_threshold, cache_expire=address_expire_after,
+                                     web_scraper=False, **parser_kwargs)
+            else:
+                parser.reset(entry)
+            res = parser.start_analysis(root_txid=entry if is_txid else None)
+        except Exception as err:
+            print(f"prefetch - {progress} {entry} failed: {err}")
+            res = False
+        if not res:
+            failed.append(entry)
+            continue
+        state.mark_done(entry, params)
+        nb_txs = sum(len(tx_list) for tx_list in parser.transaction_lists.values())
+        print(f"prefetch - {progress} {entry} done in {time.time() - t_0:.1f}sec ({nb_txs} transactions, "
+              f"{len(entries) - i - 1} entries left)")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fills the parser cache with the pages needed to analyse a batch of "
+                                                 "addresses and transactions. Can be stopped and started again: "
+                                                 "entries already prefetched are skipped.")
+    parser.add_argument("entries", help="File with one address or txid per line")
+    parser.add_argument("-b", "--backward", type=int, default=0, help="Number of backward layers")
+    parser.add_argument("-f", "--forward", type=int, default=0, help="Number of forward layers")
+    parser.add_argument("--rto-threshold", type=float, default=0.1, help="RTO threshold (in %% of the root value)")
+    parser.add_argument("--rps", type=float, default=2, help="Maximum number of requests per second")
+    parser.add_argument("--max-in-flight", type=int, default=4, help="Maximum number of requests in flight")
+    parser.add_argument("--base-url", default="https://www.walletexplorer.com")
+    parser.add_argument("--address-expire-hours", type=float,
+                        default=PREFETCH_ADDRESS_EXPIRE_AFTER.total_seconds() / 3600,
+                        help="Number of hours the address pages stay cached (-1 = never expire)")
+    parser.add_argument("--state", default=None,
+                        help="File in which the progress is saved (default: ENTRIES.prefetch.json)")
+    args = parser.parse_args()
+
+    entries = read_entries(args.entries)
+    state = PrefetchState(args.state if args.state is not None else args.entries + ".prefetch.json")
+    failed = prefetch(entries, state, backward_layers=args.backward, forward_layers=args.forward,
+                      rto_threshold=args.rto_threshold, requests_per_second=args.rps,
+                      address_expire_after=-1 if args.address_expire_hours < 0
+                      else timedelta(hours=args.address_expire_hours),
+                      max_requests_in_flight=args.max_in_flight, base_url=args.base_url)
+    print(f"prefetch - {len(entries) - len(failed)}/{len(entries)} entries prefetched.")
+    if failed:
+        print(f"prefetch - Failed entries (run the command again to retry them): {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate=2, capacity=1):
+        """
+        Thread-safe token bucket used to spread requests over time so that we never exceed the API rate limit, while
+        letting several requests be in flight at the same time.
+        :param rate: Number of tokens added to the bucket every second (= number of requests allowed per second)
+        :param capacity: Maximum number of tokens that can be stored (= maximum burst of requests)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        """
+        Adds the tokens generated since the last refill. Must be called with self.lock held.
+        :return: None
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        """
+        Blocks until a token is available, and consumes it.
+        :return: None
+        """
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time_to_wait = (1 - self.tokens) / self.rate
+            time.sleep(time_to_wait)
+
+    async def acquire_async(self):
+        """
+        Same as acquire, but waits without blocking the event loop it is called from.
+        :return: None
+        """
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time_to_wait = (1 - self.tokens) / self.rate
+            await asyncio.sleep(time_to_wait)
+
+
+class AdaptiveConcurrency:
+    def __init__(self, max_limit, min_limit=1, decrease_factor=0.5):
+        """
+        Limits the number of requests in flight, and adapts that limit AIMD-style: it is divided by 2 when the rate
+        limit is reached, and increased by 1 for every window of requests that went through (= slow ramp up).
+        Must only be used from a single event loop.
+        :param max_limit: Maximum number of requests in flight
+        :param min_limit: Minimum number of requests in flight
+        :param decrease_factor: Factor applied to the limit when the rate limit is reached
+        """
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.decrease_factor = decrease_factor
+        self.limit = max_limit  # Float, only its integer part is used
+        self.in_flight = 0
+        self.last_decrease = 0
+        self._condition = None  # Created from the event loop (see acquire)
+
+    def _can_start(self):
+        return self.in_flight < max(self.min_limit, int(self.limit))
+
+    async def acquire(self):
+        """
+        Waits until the number of requests in flight is below the current limit, and takes a slot.
+        :return: None
+        """
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(self._can_start)
+            self.in_flight += 1
+
+    async def release(self):
+        """
+        Frees a slot taken by acquire.
+        :return: None
+        """
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        """
+        Additive increase, called every time a request went through.
+        :return: None
+        """
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def on_limit_reached(self, request_start):
+        """
+        Multiplicative decrease, called when a request hit the rate limit. Requests that had started before the last
+        decrease were already in flight when it happened, so they don't decrease the limit again.
+        :param request_start: Time at which the request was started
+        :return: None
+        """
+        if request_start >= self.last_decrease:
+            self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+            self.last_decrease = time.time()
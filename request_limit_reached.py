@@ -1,6 +1,7 @@
 class RequestLimitReached(Exception):
-    def __init__(self, message):
+    def __init__(self, message, retry_after=None):
         self.message = message
+        self.retry_after = retry_after  # Number of seconds to wait before retrying, if given by the server
 
     def __str__(self):
         return self.message
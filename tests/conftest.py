@@ -0,0 +1,170 @@
+import os
+import random
+import sys
+import threading
+
+import pytest
+
+# The modules of the parser are not installed as a package: they are imported from the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(params=range(5))
+def rng(request):
+    """
+    Random generator: tests comparing an implementation with its reference on random cases run with 5 seeds.
+    """
+    return random.Random(request.param)
+
+
+@pytest.fixture
+def random_tx(rng):
+    """
+    Factory of random transaction pages, as decoded from the WalletExplorer API.
+    Entries get addresses from a small set (a0...a40 for the inputs, a/b for the outputs), so that observed addresses
+    appear several times in a transaction.
+    """
+    def make_tx(amounts=None, is_coinbase=False):
+        """
+        :param amounts: Amounts (in BTC) the entries are drawn from (e.g. a few values, so that every rule of the
+        selectors gets used), any amount of at most 8 decimals and 10 000 BTC if None (like in real txs, which never
+        exceed the 21M BTC supply, the sums of the amounts of a tx in satoshis are then exact as floats)
+        :param is_coinbase: is_coinbase field of the page
+        :return: Decoded content of the page
+        """
+        nb_inputs = rng.choice([1, 2, 3, 5, 10, 31, 60, 120])
+        nb_outputs = rng.choice([1, 2, 3, 5, 10, 31, 60, 120, nb_inputs])
+
+        def entry(prefix, is_input):
+            amount = rng.choice(amounts) if amounts is not None else rng.randint(0, 10 ** 12) / 1e8
+            entry = {'address': f"{prefix}{rng.randint(0, 40)}", 'amount': amount, 'is_standard': rng.random() < 0.95}
+            if is_input or rng.random() < 0.5:  # Unspent outputs have no next tx
+                entry['next_tx'] = "%064x" % rng.getrandbits(256)
+            if rng.random() < 0.05:
+                entry['label'] = "Exchange.com-old"
+            return entry
+        return {'found': True, 'txid': "%064x" % rng.getrandbits(256), 'is_coinbase': is_coinbase,
+                'block_height': 700000, 'time': 1650000000, 'fee': 0.0001, 'updated_to_block': 800000,
+                'in': [entry("a", True) for _ in range(rng.randint(1, nb_inputs))],
+                'out': [entry(rng.choice("ab"), False) for _ in range(rng.randint(1, nb_outputs))]}
+    return make_tx
+
+
+STAND_IN_ADDRESS = "1StandInWa11etAddress"
+
+
+def make_archive(rng, nb_wallet_txs=150, backward_depth=3, forward_depth=2):
+    """
+    Builds the pages of a wallet and of the transactions around it, as recorded by walletexplorer_server.py: every tx
+    of the wallet is funded by 1 to 3 txs, themselves funded by 1 to 3 txs... (coinbase txs at the end), and spends
+    its outputs to 1 to 3 txs, and so on. Some txs are reached several times, so that layers merge.
+    :param rng: Random generator
+    :param nb_wallet_txs: Number of transactions of the wallet
+    :param backward_depth: Number of layers of funding transactions
+    :param forward_depth: Number of layers of spending transactions
+    :return: Archive (dict archive key -> page)
+    """
+    from walletexplorer_server import archive_key
+
+    pages = dict()
+
+    def new_tx():
+        txid = "%064x" % rng.getrandbits(256)
+        pages[txid] = {'found': True, 'txid': txid, 'is_coinbase': False, 'block_height': 700000,
+                       'time': 1650000000, 'fee': 0.0001, 'updated_to_block': 800000, 'in': [], 'out': []}
+        if rng.random() < 0.03:
+            pages[txid]['label'] = "Exchange.com"
+        return txid
+
+    def link(frontier, forward):
+        next_frontier = []
+        for txid in frontier:
+            for _ in range(rng.randint(1, 3)):
+                if next_frontier and rng.random() < 0.2:  # Already reached from another tx
+                    other_txid = rng.choice(next_frontier)
+                else:
+                    other_txid = new_tx()
+                    next_frontier.append(other_txid)
+                entry = {'address': f"{'b' if forward else 'a'}{rng.randint(0, 200)}",
+                         'amount': rng.randint(1, 10 ** 9) / 1e8, 'is_standard': True}
+                pages[txid]['out' if forward else 'in'].append(dict(entry, next_tx=other_txid))
+                pages[other_txid]['in' if forward else 'out'].append(dict(entry, next_tx=txid))
+        return next_frontier
+
+    wallet_txs = []
+    for _ in range(nb_wallet_txs):
+        txid = new_tx()
+        amount = rng.randint(1, 10 ** 9) / 1e8
+        received = rng.random() < 0.7
+        entry = {'address': STAND_IN_ADDRESS, 'amount': amount, 'is_standard': True}
+        if not received:  # Tx that funded the wallet (not part of the archive)
+            entry['next_tx'] = "%064x" % rng.getrandbits(256)
+        pages[txid]['out' if received else 'in'].append(entry)
+        wallet_txs.append({'txid': txid, 'amount_received': amount if received else 0,
+                           'amount_sent': 0 if received else amount})
+    frontier = [tx['txid'] for tx in wallet_txs if tx['amount_received'] > 0]
+    for _ in range(backward_depth):
+        frontier = link(frontier, forward=False)
+    for txid in frontier:
+        pages[txid]['is_coinbase'] = True
+    frontier = [tx['txid'] for tx in wallet_txs if tx['amount_sent'] > 0]
+    for _ in range(forward_depth):
+        frontier = link(frontier, forward=True)
+    for txid in frontier:  # Unspent outputs
+        pages[txid]['out'].append({'address': "c0", 'amount': 0.1, 'is_standard': True})
+
+    archive = {archive_key("/api/1/tx", f"txid={txid}"): page for txid, page in pages.items()}
+    for start in range(0, nb_wallet_txs, 100):
+        key = archive_key("/api/1/address", f"address={STAND_IN_ADDRESS}&from={start}&count=100")
+        archive[key] = {'found': True, 'address': STAND_IN_ADDRESS, 'txs_count': nb_wallet_txs,
+                        'txs': wallet_txs[start:start + 100]}
+    return archive
+
+
+@pytest.fixture
+def stand_in_archive(tmp_path):
+    """
+    :return: Path of an archive of the pages around the wallet of STAND_IN_ADDRESS (see make_archive)
+    """
+    from walletexplorer_server import save_archive
+
+    path = str(tmp_path / "archive.json.gz")
+    save_archive(make_archive(random.Random(0)), path)
+    return path
+
+
+@pytest.fixture
+def stand_in_server(stand_in_archive):
+    """
+    Starts local stand-ins of the WalletExplorer API serving stand_in_archive, stopped at the end of the test.
+    :return: Function taking the parameters of StandInServer (latency, p429...), returning a started StandInServer
+    """
+    from walletexplorer_server import StandInServer
+
+    servers = []
+
+    def start(**kwargs):
+        server = StandInServer(stand_in_archive, port=0, **kwargs)
+        server.base_url = f"http://localhost:{server.server_address[1]}"
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def isolated_caches(tmp_path, monkeypatch):
+    """
+    Makes the parsers of the test use caches of their own (in tmp_path), without the cache janitor.
+    """
+    import chain_parser
+    import fetch_engine
+    import tx_store
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(fetch_engine, '_session', None)
+    monkeypatch.setattr(tx_store, '_stores', dict())
+    monkeypatch.setattr(chain_parser, 'start_cache_janitor', lambda session, store: None)
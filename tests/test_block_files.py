@@ -0,0 +1,95 @@
+import struct
+
+import pytest
+
+from block_files import MAINNET_MAGIC, BlockFileBackend, BlockFileIndex, script_to_address, sha256d
+from tx_store import decode_tx, normalize_tx
+
+TX_URL = "https://www.walletexplorer.com/api/1/tx?txid={}&caller=paulo"
+
+
+def serialize_tx(inputs, outputs):
+    """
+    :param inputs: List of outpoints (prev txid (bytes, internal byte order), vout)
+    :param outputs: List of (value in satoshis, scriptPubKey)
+    :return: Legacy serialization of the transaction
+    """
+    data = struct.pack("<I", 1) + bytes([len(inputs)])
+    for prev_txid, vout in inputs:
+        data += prev_txid + struct.pack("<I", vout) + b"\x00" + b"\xff" * 4
+    data += bytes([len(outputs)])
+    for value, script in outputs:
+        data += struct.pack("<Q", value) + bytes([len(script)]) + script
+    return data + b"\x00" * 4
+
+
+def p2pkh(nb):
+    return b"\x76\xa9\x14" + bytes([nb]) * 20 + b"\x88\xac"
+
+
+@pytest.fixture
+def chain(tmp_path):
+    """
+    Block file holding a coinbase, a tx spending it and a tx spending the 2nd output of the latter.
+    :return: Tuple (BlockFileIndex, list of the txids as displayed)
+    """
+    coinbase = serialize_tx([(b"\x00" * 32, 0xffffffff)], [(50 * 10 ** 8, p2pkh(1))])
+    spend = serialize_tx([(sha256d(coinbase), 0)], [(10 ** 8, p2pkh(2)), (49 * 10 ** 8, p2pkh(3))])
+    spend_change = serialize_tx([(sha256d(spend), 1)], [(48 * 10 ** 8, p2pkh(4))])
+    txs = [coinbase, spend, spend_change]
+    block = b"\x00" * 80 + bytes([len(txs)]) + b"".join(txs)
+    (tmp_path / "blocks").mkdir()
+    (tmp_path / "blocks" / "blk00000.dat").write_bytes(MAINNET_MAGIC + struct.pack("<I", len(block)) + block)
+    block_index = BlockFileIndex(str(tmp_path / "blocks"), str(tmp_path / "block_index"))
+    return block_index, [sha256d(tx)[::-1].hex() for tx in txs]
+
+
+class Fallback:
+    def partition_cached(self, url_list):
+        return [], list(url_list)
+
+    def get_many_encoded(self, url_list):
+        return dict()
+
+
+def test_tx_page(chain):
+    block_index, txids = chain
+    page = block_index.tx_page(txids[1])
+    assert page['in'] == [{'address': script_to_address(p2pkh(1)), 'amount': 50.0, 'next_tx': txids[0],
+                           'is_standard': True}]
+    assert [output['address'] for output in page['out']] == [script_to_address(p2pkh(2)),
+                                                             script_to_address(p2pkh(3))]
+    assert 'next_tx' not in page['out'][0] and page['out'][1]['next_tx'] == txids[2]
+    assert block_index.tx_page("ab" * 32) is None
+
+
+def test_partition_cached_does_not_read_the_block_files(chain, monkeypatch):
+    block_index, txids = chain
+    parsed = []
+    parse_at = block_index._parse_at
+
+    def recording_parse_at(file_nb, pos):
+        parsed.append((file_nb, pos))
+        return parse_at(file_nb, pos)
+
+    monkeypatch.setattr(block_index, '_parse_at', recording_parse_at)
+    backend = BlockFileBackend(block_index, Fallback())
+    url_list = [TX_URL.format(txid) for txid in txids] + [TX_URL.format("ab" * 32), TX_URL.format("xyz")]
+
+    assert backend.partition_cached(url_list) == (url_list[:3], url_list[3:])
+    assert parsed == []
+    assert backend.local_page(url_list[2]) == block_index.tx_page(txids[2])
+
+
+def test_may_contain(chain):
+    block_index, txids = chain
+    assert all(block_index.may_contain(bytes.fromhex(txid)[::-1]) for txid in txids)
+    assert not block_index.may_contain(b"\xab" * 32)
+
+
+def test_get_many_encoded(chain):
+    block_index, txids = chain
+    backend = BlockFileBackend(block_index, Fallback())
+    encoded_txs = backend.get_many_encoded([TX_URL.format(txid) for txid in txids] + [TX_URL.format("ab" * 32)])
+    assert {txid: decode_tx(txid, data) for txid, data in encoded_txs.items()} == \
+        {txid: normalize_tx(block_index.tx_page(txid)) for txid in txids}
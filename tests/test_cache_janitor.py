@@ -0,0 +1,71 @@
+import os
+import sqlite3
+
+import pytest
+import requests_cache
+
+import fetch_engine
+from cache_janitor import CacheJanitor
+from tx_store import TxStore, create_database
+
+
+def auto_vacuum(path):
+    con = sqlite3.connect(path)
+    try:
+        return con.execute("PRAGMA auto_vacuum").fetchone()[0]
+    finally:
+        con.close()
+
+
+def test_new_databases_use_incremental_vacuum(tmp_path, monkeypatch):
+    TxStore(str(tmp_path / "tx_store.sqlite"))
+    assert auto_vacuum(tmp_path / "tx_store.sqlite") == 2
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(fetch_engine, '_session', None)
+    session = fetch_engine.get_session()
+    len(session.cache.responses)  # Makes requests_cache create its tables
+    assert auto_vacuum(tmp_path / "parser_cache.sqlite") == 2
+
+
+def test_existing_databases_are_left_as_they_are(tmp_path):
+    path = tmp_path / "old.sqlite"
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE t (x)")
+    con.commit()
+    con.close()
+    assert create_database(str(path)) is False
+    assert auto_vacuum(path) == 0
+
+
+def test_run_once_shrinks_the_files(tmp_path, random_tx):
+    create_database(str(tmp_path / "cache.sqlite"))
+    session = requests_cache.CachedSession(str(tmp_path / "cache"), backend='sqlite')
+    store = TxStore(str(tmp_path / "tx_store.sqlite"))
+    store.put_many({content['txid']: content for content in (random_tx() for _ in range(3000))})
+    store.connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    size = os.path.getsize(tmp_path / "tx_store.sqlite")
+
+    janitor = CacheJanitor(session, store, max_bytes=size // 2)
+    janitor.run_once()
+    assert len(store) < 3000
+    assert os.path.getsize(tmp_path / "tx_store.sqlite") < size * 0.6
+
+
+def test_connections_are_closed(tmp_path, monkeypatch):
+    session = requests_cache.CachedSession(str(tmp_path / "cache"), backend='sqlite')
+    janitor = CacheJanitor(session, None, max_bytes=1)
+    connections = []
+    connect = sqlite3.connect
+
+    def recording_connect(*args, **kwargs):
+        connections.append(connect(*args, **kwargs))
+        return connections[-1]
+
+    monkeypatch.setattr(sqlite3, 'connect', recording_connect)
+    janitor.run_once()
+    janitor.usage()
+    assert connections
+    for con in connections:
+        with pytest.raises(sqlite3.ProgrammingError):  # Closed
+            con.execute("SELECT 1")
@@ -0,0 +1,58 @@
+import requests
+
+import web_scraper
+from chain_parser import ChainParser
+from conftest import STAND_IN_ADDRESS
+from tx_store import get_tx_store
+
+
+def layers(parser):
+    """
+    :return: Content of every layer of the parser: list of (txid, prev_txid, output addresses, input addresses, amount,
+    rto, tag) per layer
+    """
+    return {layer: [(tx.txid, list(tx.prev_txid), list(tx.output_addresses), list(tx.input_addresses), tx.amount,
+                     tx.rto, tx.tag) for tx in tx_list]
+            for layer, tx_list in parser.transaction_lists.items()}
+
+
+def test_offline_analysis(isolated_caches, stand_in_server, monkeypatch):
+    def no_network(*args, **kwargs):
+        raise requests.ConnectionError("No network")
+
+    monkeypatch.setattr(web_scraper.requests, 'get', no_network)  # bitcoinabuse.com cannot be reached
+    server = stand_in_server()
+    parser = ChainParser(STAND_IN_ADDRESS, backward_layers=3, forward_layers=2, base_url=server.base_url,
+                         requests_per_second=1000, web_scraper=False)
+    assert parser.web_scraper is None
+    assert parser.start_analysis()
+    assert all(parser.transaction_lists[layer] for layer in range(5))
+    assert server.stats['missing'] == 0
+    nb_requests = server.stats['requests']
+
+    # Same analysis, served from the caches: the result is the same
+    replay = ChainParser(STAND_IN_ADDRESS, backward_layers=3, forward_layers=2, base_url=server.base_url,
+                         requests_per_second=1000)
+    assert replay.web_scraper.ba_on is False
+    assert replay.start_analysis()
+    assert server.stats['requests'] == nb_requests
+    assert layers(replay) == layers(parser)
+
+
+def test_layers_do_not_depend_on_the_order_of_the_pages(isolated_caches, stand_in_server):
+    def analysis(server):
+        parser = ChainParser(STAND_IN_ADDRESS, backward_layers=3, forward_layers=2, base_url=server.base_url,
+                             requests_per_second=1000, max_requests_in_flight=16, web_scraper=False)
+        assert parser.start_analysis()
+        return layers(parser)
+
+    cold = analysis(stand_in_server(jitter=0.02, seed=1))  # Responses come back in a random order
+
+    # Half of the transactions have to be requested again, and arrive in another order, mixed with cached pages
+    with get_tx_store().connection() as con:
+        assert con.execute("DELETE FROM txs WHERE hex(txid) < '8'").rowcount > 0
+    server = stand_in_server(jitter=0.02, seed=2)
+    assert analysis(server) == cold
+    assert server.stats['served'] > 0
+
+    assert analysis(server) == cold  # Everything cached
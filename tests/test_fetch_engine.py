@@ -0,0 +1,234 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+
+import fetch_engine
+from fetch_engine import FetchEngine, InvalidRequest, get_session, parse_retry_after
+from rate_limiter import TokenBucket
+from request_limit_reached import RequestLimitReached
+from walletexplorer_server import load_archive
+
+
+class ScriptedEngine(FetchEngine):
+    def __init__(self, outcomes=None, latency=0., **kwargs):
+        """
+        Engine whose requests get the outcomes given for their URL instead of going through the network.
+        :param outcomes: Dict URL -> list of the outcomes of the successive requests to that URL (exception to raise or
+        content to return), the content {'url': url} is returned once the list is exhausted
+        :param latency: Number of seconds taken by every request
+        """
+        super().__init__(None, TokenBucket(rate=1000, capacity=10), **kwargs)
+        self.outcomes = outcomes or dict()
+        self.latency = latency
+        self.calls = []  # (URL, time) of every request made
+
+    def _get(self, url):
+        self.calls.append((url, time.time()))
+        time.sleep(self.latency)
+        outcomes = self.outcomes.get(url)
+        outcome = outcomes.pop(0) if outcomes else {'url': url}
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    def is_cached(self, url):
+        return False
+
+    def fetch_url(self, url):
+        return asyncio.run_coroutine_threadsafe(self._fetch(url), self.loop).result()
+
+    def fetch_concurrently(self, url, nb_requesters):
+        """
+        :return: Results of nb_requesters concurrent calls to fetch(url) (content or exception)
+        """
+        async def fetch_all():
+            return await asyncio.gather(*[self.fetch(url) for _ in range(nb_requesters)], return_exceptions=True)
+        return asyncio.run_coroutine_threadsafe(fetch_all(), self.loop).result()
+
+    def gaps(self):
+        return [t_1 - t_0 for (_, t_0), (_, t_1) in zip(self.calls, self.calls[1:])]
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("12") == 12
+    assert parse_retry_after("0.5") == 0.5
+    assert parse_retry_after("-3") == 0
+    assert parse_retry_after("soon") is None
+    in_30_seconds = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 28 <= parse_retry_after(in_30_seconds) <= 30
+    assert parse_retry_after(format_datetime(datetime(2000, 1, 1, tzinfo=timezone.utc), usegmt=True)) == 0
+
+
+def test_backoff_bounds():
+    engine = ScriptedEngine()
+    for attempt in range(10):
+        bound = min(engine.backoff_cap, engine.backoff_base * 2 ** attempt)
+        delays = [engine._backoff(attempt) for _ in range(200)]
+        assert all(0 <= delay <= bound for delay in delays)
+        assert max(delays) > bound / 2  # Full jitter: the whole range is used
+
+
+def test_retries_with_exponential_backoff(monkeypatch):
+    monkeypatch.setattr(fetch_engine.random, 'uniform', lambda low, high: high)  # Longest backoffs
+    engine = ScriptedEngine({"u": [Exception("Connection reset")] * 3}, max_tries=4)
+    engine.backoff_base, engine.backoff_cap = 0.05, 0.15
+
+    content, _ = engine.fetch_url("u")
+    assert content == {'url': "u"}
+    assert len(engine.calls) == 4
+    for gap, backoff in zip(engine.gaps(), [0.05, 0.1, 0.15]):
+        assert backoff <= gap < backoff + 0.05
+
+
+def test_gives_up_after_max_tries():
+    engine = ScriptedEngine({"u": [Exception("Connection reset")] * 5}, max_tries=3)
+    engine.backoff_base = 0.01
+    with pytest.raises(Exception, match="Connection reset"):
+        engine.fetch_url("u")
+    assert len(engine.calls) == 3
+
+
+def test_invalid_request_is_not_retried():
+    engine = ScriptedEngine({"u": [InvalidRequest("404 Client Error")]})
+    with pytest.raises(InvalidRequest):
+        engine.fetch_url("u")
+    assert len(engine.calls) == 1
+
+
+def test_rate_limit_does_not_count_toward_max_tries():
+    limits = [RequestLimitReached("429", retry_after=0.05)] * 4 + [RequestLimitReached("429")]
+    engine = ScriptedEngine({"u": limits + [Exception("Connection reset")]}, max_tries=2)
+    engine.backoff_base = 0.01
+
+    content, _ = engine.fetch_url("u")
+    assert content == {'url': "u"}
+    assert len(engine.calls) == 7
+    gaps = engine.gaps()
+    assert all(0.05 <= gap < 0.15 for gap in gaps[:4])  # Pauses of Retry-After seconds
+    assert gaps[4] < 0.05 + 0.16  # No Retry-After: backoff (5th limit reached)
+    assert engine.paused_until > 0
+
+
+def test_concurrency_drops_after_rate_limit_and_recovers():
+    engine = ScriptedEngine({"u0": [RequestLimitReached("429", retry_after=0)]}, max_requests_in_flight=8)
+    engine.fetch_url("u0")
+    assert 4 <= engine.concurrency.limit < 5
+    for i in range(1, 40):
+        engine.fetch_url(f"u{i}")
+    assert engine.concurrency.limit == 8
+
+
+def tx_urls(server, archive_path, nb_urls):
+    """
+    :return: Tuple (txids of nb_urls transactions of the archive, URLs of their pages on server)
+    """
+    txids = [key.split("txid=")[1] for key in load_archive(archive_path) if key.startswith("/api/1/tx?")][:nb_urls]
+    return txids, [f"{server.base_url}/api/1/tx?txid={txid}&caller=paulo" for txid in txids]
+
+
+def test_rate_limited_server(isolated_caches, stand_in_server, stand_in_archive):
+    server = stand_in_server(p429=0.3, retry_after=0.01, seed=0)
+    txids, url_list = tx_urls(server, stand_in_archive, 40)
+    engine = FetchEngine(get_session(), TokenBucket(rate=1000, capacity=10), max_requests_in_flight=8, max_tries=1)
+    contents = dict()
+
+    failed_urls, err = engine.fetch_all(url_list, lambda url, content, request_time: contents.update({url: content}))
+    assert failed_urls == [] and err is None
+    assert [contents[url]['txid'] for url in url_list] == txids
+    assert server.stats['rate_limited'] > 0 and engine.paused_until > 0
+    assert server.stats['requests'] == server.stats['rate_limited'] + len(url_list)
+
+
+def test_single_flight():
+    engine = ScriptedEngine({"u": [{'url': "u", 'in': [{'address': "a0"}]}]}, latency=0.1)
+    other_engine = ScriptedEngine()
+    results = engine.fetch_concurrently("u", 10)
+    assert len(engine.calls) == 1
+    assert all(content == {'url': "u", 'in': [{'address': "a0"}]} for content, _ in results)
+    contents = [content for content, _ in results]
+    contents[0]['in'][0]['address'] = "a1"  # Parsers modify the pages they are given
+    assert all(content['in'][0]['address'] == "a0" for content in contents[1:])
+    assert "u" not in fetch_engine._in_flight
+
+    async def fetch_from_both_engines():
+        return await asyncio.gather(engine.fetch("v"), other_engine.fetch("v"))
+
+    asyncio.run_coroutine_threadsafe(fetch_from_both_engines(), engine.loop).result()
+    assert [url for url, _ in engine.calls + other_engine.calls].count("v") == 1
+
+
+def test_single_flight_failure():
+    engine = ScriptedEngine({"u": [InvalidRequest("404 Client Error")]}, latency=0.1)
+    results = engine.fetch_concurrently("u", 10)
+    assert len(engine.calls) == 1
+    assert all(isinstance(result, InvalidRequest) for result in results)
+    assert "u" not in fetch_engine._in_flight
+
+    assert engine.fetch_one("u") == {'url': "u"}  # The next request is made again
+    assert len(engine.calls) == 2
+
+
+def test_single_flight_cancelled_requester():
+    engine = ScriptedEngine(latency=0.2)
+
+    async def cancel_one():
+        requesters = [asyncio.ensure_future(engine.fetch("u")) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        requesters[0].cancel()
+        return await asyncio.gather(*requesters, return_exceptions=True)
+
+    results = asyncio.run_coroutine_threadsafe(cancel_one(), engine.loop).result()
+    assert isinstance(results[0], asyncio.CancelledError)
+    assert [content for content, _ in results[1:]] == [{'url': "u"}] * 2
+    assert len(engine.calls) == 1
+
+
+@pytest.mark.parametrize("wait_for_prefetches", [False, True])
+def test_prefetched_pages_are_not_requested_again(isolated_caches, stand_in_server, stand_in_archive,
+                                                  wait_for_prefetches):
+    server = stand_in_server(latency=0.05)
+    txids, url_list = tx_urls(server, stand_in_archive, 20)
+    engine = FetchEngine(get_session(), TokenBucket(rate=1000, capacity=10), max_requests_in_flight=8)
+    for url in url_list:
+        engine.prefetch(url)
+    engine.prefetch(url_list[0])  # Already being prefetched
+    if wait_for_prefetches:
+        for future in list(engine._prefetched.values()):
+            future.result()
+        assert engine.partition_cached(url_list) == (url_list, [])
+        assert engine._prefetched == dict()  # Discarded, their pages are read from the cache
+
+    contents = dict()
+    failed_urls, err = engine.fetch_all(url_list, lambda url, content, request_time: contents.update({url: content}))
+    assert failed_urls == [] and err is None
+    assert [contents[url]['txid'] for url in url_list] == txids
+    assert server.stats['requests'] == len(url_list)
+    assert engine._prefetched == dict()
+
+
+def test_discarded_prefetches_are_cancelled():
+    engine = ScriptedEngine(latency=0.2, max_requests_in_flight=2)
+
+    async def nb_tasks():
+        return len(asyncio.all_tasks()) - 1
+
+    nb_tasks_before = asyncio.run_coroutine_threadsafe(nb_tasks(), engine.loop).result()
+    url_list = [f"p{i}" for i in range(5)]
+    for url in url_list:
+        engine.prefetch(url)
+    futures = list(engine._prefetched.values())
+    while len(engine.calls) < 2:  # The other prefetches wait for a request slot
+        time.sleep(0.01)
+    engine._discard_prefetched(url_list)
+    assert engine._prefetched == dict()
+    assert all(future.cancelled() for future in futures)
+
+    time.sleep(0.3)  # The requests already made end (their content is not kept), the others are never made
+    assert asyncio.run_coroutine_threadsafe(nb_tasks(), engine.loop).result() == nb_tasks_before
+    assert not set(url_list) & set(fetch_engine._in_flight)
+    assert len(engine.calls) == 2
+    assert engine.concurrency.in_flight == 0
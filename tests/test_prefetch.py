@@ -0,0 +1,42 @@
+import gzip
+import json
+
+import prefetch
+from chain_parser import ChainParser
+from conftest import STAND_IN_ADDRESS
+from prefetch import PrefetchState, read_entries
+from test_chain_parser import layers
+
+
+def test_read_entries(tmp_path):
+    path = tmp_path / "case.txt"
+    path.write_text("# Case\n1B\n\n1A\n  1B  \nab\n1A\n")
+    assert read_entries(str(path)) == ["1B", "1A", "ab"]
+
+
+def test_prefetch_reuses_one_parser(isolated_caches, stand_in_server, stand_in_archive, monkeypatch):
+    server = stand_in_server()
+    with gzip.open(stand_in_archive, "rt") as f:
+        wallet_page = next(page for page in json.load(f).values() if 'txs' in page)
+    root_txid = next(tx['txid'] for tx in wallet_page['txs'] if tx['amount_received'] > 0)
+    parsers = []
+
+    class RecordedParser(ChainParser):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            parsers.append(self)
+
+    monkeypatch.setattr(prefetch, 'ChainParser', RecordedParser)
+    state = PrefetchState("state.json")
+    entries = [root_txid, STAND_IN_ADDRESS]
+    assert prefetch.prefetch(entries, state, backward_layers=2, forward_layers=1, base_url=server.base_url,
+                             requests_per_second=1000) == []
+    assert len(parsers) == 1 and parsers[0].web_scraper is None
+    assert all(state.is_done(entry, {'backward_layers': 2, 'forward_layers': 1, 'rto_threshold': 0.1})
+               for entry in entries)
+
+    # The reset parser built the same layers as a new one
+    parser = ChainParser(STAND_IN_ADDRESS, backward_layers=2, forward_layers=1, base_url=server.base_url,
+                         requests_per_second=1000, web_scraper=False)
+    assert parser.start_analysis()
+    assert layers(parsers[0]) == layers(parser)
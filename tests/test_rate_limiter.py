@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+from rate_limiter import AdaptiveConcurrency, TokenBucket
+
+
+def test_token_bucket_rate():
+    bucket = TokenBucket(rate=50, capacity=5)
+    t_0 = time.monotonic()
+    for _ in range(5):  # Burst of the tokens stored in the bucket
+        bucket.acquire()
+    assert time.monotonic() - t_0 < 0.05
+    for _ in range(25):
+        bucket.acquire()
+    assert 0.45 <= time.monotonic() - t_0 < 0.7
+
+
+def test_token_bucket_rate_async():
+    bucket = TokenBucket(rate=50, capacity=1)
+
+    async def acquire_all():
+        await asyncio.gather(*[bucket.acquire_async() for _ in range(26)])
+
+    t_0 = time.monotonic()
+    asyncio.run(acquire_all())
+    assert 0.45 <= time.monotonic() - t_0 < 0.7
+
+
+def test_adaptive_concurrency_decrease_and_recovery():
+    concurrency = AdaptiveConcurrency(8, min_limit=2)
+    request_start = time.time()
+    concurrency.on_limit_reached(request_start)
+    assert concurrency.limit == 4
+    concurrency.on_limit_reached(request_start)  # Already in flight at the last decrease
+    assert concurrency.limit == 4
+    for _ in range(3):
+        concurrency.on_limit_reached(time.time())
+    assert concurrency.limit == 2
+
+    nb_successes = 0
+    while concurrency.limit < 8:
+        concurrency.on_success()
+        nb_successes += 1
+    assert sum(range(2, 8)) <= nb_successes <= sum(range(3, 9))  # About +1 for every window of requests
+    concurrency.on_success()
+    assert concurrency.limit == 8
+
+
+def test_adaptive_concurrency_limits_requests_in_flight():
+    concurrency = AdaptiveConcurrency(4)
+    concurrency.limit = 3.7  # Only the integer part is used
+    max_in_flight = 0
+
+    async def request():
+        nonlocal max_in_flight
+        await concurrency.acquire()
+        max_in_flight = max(max_in_flight, concurrency.in_flight)
+        await asyncio.sleep(0.01)
+        await concurrency.release()
+
+    async def run():
+        await asyncio.gather(*[request() for _ in range(20)])
+
+    asyncio.run(run())
+    assert max_in_flight == 3
+    assert concurrency.in_flight == 0
@@ -0,0 +1,86 @@
+import random
+
+from transaction import RootCandidates, Transaction, TransactionLists
+
+
+def random_trace(rng, nb_layers=5):
+    """
+    :return: TransactionLists where every tx of a layer comes from 1 to 3 txs of the previous layer
+    """
+    tx_lists = TransactionLists({0: [Transaction(f"tx_0_{i}") for i in range(rng.randint(1, 6))]})
+    for layer in range(1, nb_layers):
+        tx_lists[layer] = []
+        for i in range(rng.randint(1, 12)):
+            parents = rng.sample(tx_lists[layer - 1], rng.randint(1, min(3, len(tx_lists[layer - 1]))))
+            txid = f"tx_{layer}_{i}"
+            tx_lists[layer].append(Transaction(txid, prev_txid=[(parent.txid, layer - 1) for parent in parents]))
+            for parent in parents:
+                tx_lists.add_link((parent.txid, layer - 1), (txid, layer))
+    return tx_lists
+
+
+def remove_links_reference(tx_lists, prev):
+    """
+    Scans every layer for the children of the unlinked txs, until no tx is left without a previous transaction.
+    """
+    orphans = set()
+    to_unlink = [prev]
+    while to_unlink:
+        parent = to_unlink.pop()
+        for layer, transactions in tx_lists.items():
+            for tx in transactions:
+                if parent in tx.prev_txid:
+                    tx.prev_txid = [elt for elt in tx.prev_txid if elt != parent]
+                    if not tx.prev_txid:
+                        orphans.add((tx.txid, layer))
+                        to_unlink.append((tx.txid, layer))
+    return orphans
+
+
+def test_remove_links_matches_reference():
+    rng = random.Random(0)
+    for _ in range(200):
+        seed = rng.getrandbits(32)
+        tx_lists, reference_lists = random_trace(random.Random(seed)), random_trace(random.Random(seed))
+        layer = rng.randint(0, len(tx_lists) - 2)
+        for tx in rng.sample(tx_lists[layer], rng.randint(1, len(tx_lists[layer]))):
+            assert tx_lists.remove_links((tx.txid, layer)) == remove_links_reference(reference_lists,
+                                                                                     (tx.txid, layer))
+        for layer, transactions in tx_lists.items():
+            assert [tx.prev_txid for tx in transactions] == [tx.prev_txid for tx in reference_lists[layer]]
+
+
+def test_remove_links_keeps_txs_with_another_parent():
+    tx_lists = TransactionLists({0: [Transaction("a"), Transaction("b")],
+                                 1: [Transaction("c", prev_txid=[("a", 0), ("b", 0)]),
+                                     Transaction("d", prev_txid=[("a", 0)])],
+                                 2: [Transaction("e", prev_txid=[("d", 1)])]})
+    tx_lists.add_link(("a", 0), ("c", 1))
+    tx_lists.add_link(("b", 0), ("c", 1))
+    tx_lists.add_link(("a", 0), ("d", 1))
+    tx_lists.add_link(("d", 1), ("e", 2))
+
+    assert tx_lists.remove_links(("a", 0)) == {("d", 1), ("e", 2)}
+    assert tx_lists[1][0].prev_txid == [("b", 0)]
+    assert tx_lists.remove_links(("a", 0)) == set()
+
+
+def test_root_candidates_match_full_layer():
+    rng = random.Random(0)
+    for _ in range(100):
+        rto_threshold = rng.choice([0.1, 1, 5, 20])
+        amounts = [rng.choice([rng.uniform(0, 1), rng.uniform(0, 100), 0.5]) for _ in range(rng.randint(0, 3000))]
+        candidates = RootCandidates(rto_threshold, compaction_size=rng.choice([1, 16, 1024]))
+        for i, amount in enumerate(amounts):
+            candidates.add(f"tx_{i}", amount)
+
+        root_value = 0
+        for amount in amounts:
+            root_value += amount
+        threshold = root_value * (rto_threshold / 100)
+        expected = sorted([(f"tx_{i}", amount) for i, amount in enumerate(amounts) if amount >= threshold],
+                          key=lambda x: x[1], reverse=True)
+        assert candidates.survivors() == expected
+        assert candidates.root_value == root_value
+        assert candidates.nb_added == len(amounts)
+        assert len(candidates.txids) <= max(16, 2 * 100 / rto_threshold)
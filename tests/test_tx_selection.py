@@ -0,0 +1,135 @@
+import copy
+import itertools
+
+import pytest
+
+from tx_selection import SUBSET_SUM_MAX_ENTRIES, fee_match, find_subset_sum, select_batch, select_inputs, \
+    select_layer, select_outputs
+from tx_store import encode_tx
+
+
+def fee_match_reference(values, targets, fee):
+    """
+    1st check of the selectors as it was first written: the fee is added to the smallest value, the values are sorted
+    again, and so on, comparing the sorted lists every time.
+    """
+    values = sorted(values)
+    targets = sorted(targets)
+    for i in range(len(values)):
+        values[i] += fee
+        values.sort()
+        if targets == values:
+            return True
+    return False
+
+
+# Amounts the entries of a page are drawn from, so that every rule of the selectors gets used
+AMOUNT_SETS = [[0.5, 0.25, 0.125, 1.0], [0.1, 0.2, 0.3, 0.00000001, 5.0, 0.0], [0.0], None]
+
+
+def random_layer(rng, random_tx, forward):
+    """
+    :return: Tuple (transaction pages, observations (observed addresses, observed rto) of each of them)
+    """
+    tx_contents, observations = [], []
+    for _ in range(rng.randint(1, 40)):
+        tx_content = random_tx(amounts=rng.choice(AMOUNT_SETS))
+        entries = tx_content['in'] if forward else tx_content['out']
+        observed_addresses = sorted({add['address'] for add in rng.sample(entries, rng.randint(1, len(entries)))})
+        tx_contents.append(tx_content)
+        observations.append((observed_addresses, rng.choice([1.0, 0.37, 0, 100.0])))
+    return tx_contents, observations
+
+
+def subset_sum_reference(values, low, high):
+    """
+    Exhaustive search: indexes of the only proper, non-empty subset of values whose sum is between low and high.
+    """
+    matches = [list(subset) for size in range(1, len(values))
+               for subset in itertools.combinations(range(len(values)), size)
+               if low <= sum(values[i] for i in subset) <= high]
+    return matches[0] if len(matches) == 1 else None
+
+
+def test_find_subset_sum_matches_exhaustive_search(rng):
+    for _ in range(300):
+        values = [rng.randint(0, 50) for _ in range(rng.randint(0, 10))]
+        low = rng.randint(0, sum(values) + 1)
+        high = low + rng.choice([0, 0, 1, 5])
+        assert find_subset_sum(values, low, high) == subset_sum_reference(values, low, high), (values, low, high)
+
+
+def test_find_subset_sum_unique_match():
+    values = [100_000, 2_500_000, 37_000, 880_000_000, 4_200]
+    assert find_subset_sum(values, 2_537_000, 2_537_000) == [1, 2]
+
+
+def test_find_subset_sum_ambiguous_or_whole():
+    assert find_subset_sum([5, 5, 7], 5, 5) is None  # Two subsets match
+    assert find_subset_sum([5, 6], 11, 11) is None  # Only the whole set matches
+    assert find_subset_sum([5, 6], 7, 6) is None
+
+
+def test_find_subset_sum_too_many_entries():
+    values = [2 ** i for i in range(SUBSET_SUM_MAX_ENTRIES + 1)]
+    assert find_subset_sum(values, 3, 3) is None
+    assert find_subset_sum(values[:-1], 3, 3) == [0, 1]
+
+
+def test_fee_match_matches_reference(rng):
+    for _ in range(2000):
+        values = sorted(rng.randint(0, 12) for _ in range(rng.randint(1, 6)))
+        fee = rng.randint(-6, 6)
+        if rng.random() < 0.5:  # Targets reached by adding the fee to some of the values
+            targets = list(values)
+            for i in range(rng.randint(1, len(values))):
+                targets[i] += fee
+                targets.sort()
+            rng.shuffle(targets)
+        else:
+            targets = [rng.randint(0, 12) for _ in range(rng.choice([len(values), rng.randint(1, 6)]))]
+        assert fee_match(values, targets, fee) == fee_match_reference(values, targets, fee), (values, targets, fee)
+
+
+def test_fee_match():
+    assert fee_match([10, 20, 30], [30, 20, 15], 5)
+    assert fee_match([10, 20, 30], [25, 15, 30], -5) is False  # The fee is added to the smallest values first
+    assert fee_match([10, 20], [15, 20, 0], 5) is False
+
+
+@pytest.mark.parametrize("forward", [False, True])
+def test_select_layer_matches_scalar_selectors(rng, random_tx, forward):
+    select = select_outputs if forward else select_inputs
+    for _ in range(20):
+        tx_contents, observations = random_layer(rng, random_tx, forward)
+        rto_threshold = rng.choice([0, 0.1, 1e-3])
+        expected = [select(tx_content, observed_addresses, observed_rto, rto_threshold)
+                    for tx_content, (observed_addresses, observed_rto) in zip(copy.deepcopy(tx_contents),
+                                                                              observations)]
+        assert select_layer(tx_contents, observations, forward, rto_threshold) == expected
+
+
+def test_select_layer_zero_sum():
+    tx_content = {'txid': "00" * 32, 'is_coinbase': False,
+                  'in': [{'address': "a", 'amount': 0.0, 'is_standard': True, 'next_tx': "ab" * 32}] * 2,
+                  'out': [{'address': "b", 'amount': 0.0, 'is_standard': True}]}
+    expected = select_inputs(copy.deepcopy(tx_content), ["b"], 1.0, 0)
+    assert expected[0] == []
+    assert select_layer([tx_content], [(["b"], 1.0)], False, 0) == [expected]
+
+
+@pytest.mark.parametrize("forward", [False, True])
+def test_select_batch(rng, random_tx, forward):
+    tx_contents, observations = random_layer(rng, random_tx, forward)
+    tx_contents[0]['label'] = "Exchange"
+    jobs = [(tx_content['txid'], encode_tx(tx_content), forward, observed_addresses, observed_rto, 0.1)
+            for tx_content, (observed_addresses, observed_rto) in zip(tx_contents, observations)]
+    results = select_batch(jobs)
+    assert [result['txid'] for result in results] == [tx_content['txid'] for tx_content in tx_contents]
+    assert results[0] == {'txid': tx_contents[0]['txid'], 'is_coinbase': False, 'label': "Exchange"}
+    select = select_outputs if forward else select_inputs
+    for tx_content, (observed_addresses, observed_rto), result in zip(tx_contents[1:], observations[1:], results[1:]):
+        selected, stats = select(tx_content, observed_addresses, observed_rto, 0.1)
+        assert result['selection'][0] == (observed_addresses, observed_rto)
+        assert [add['address'] for add in result['selection'][1]] == [add['address'] for add in selected]
+        assert result['selection'][2] == stats
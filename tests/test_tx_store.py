@@ -0,0 +1,45 @@
+from tx_store import TxStore, decode_tx, encode_tx, normalize_tx, txid_from_url
+
+
+def test_codec_round_trip(rng, random_tx):
+    for _ in range(100):
+        content = random_tx(is_coinbase=rng.random() < 0.05)
+        for entry in content['in'] + content['out']:
+            if rng.random() < 0.05:  # Non-standard entries may have no address
+                del entry['address']
+        if rng.random() < 0.2:
+            content['label'] = "Ĳsselmeer Wallet"
+        assert decode_tx(content['txid'], encode_tx(content)) == normalize_tx(content)
+
+
+def test_store(tmp_path, random_tx):
+    store = TxStore(str(tmp_path / "tx_store.sqlite"))
+    contents = {content['txid']: content for content in (random_tx() for _ in range(20))}
+    lossy = random_tx()
+    lossy['in'] = [{'address': "a0", 'amount': 0.123456789, 'is_standard': True}]
+
+    assert store.put_many(contents) == len(contents)
+    assert store.put(lossy['txid'], lossy) is False  # More than 8 decimals: cannot be stored as satoshis
+    assert len(store) == len(contents)
+    txids = list(contents) + [lossy['txid']]
+    assert store.contains_many(txids) == set(contents)
+    assert store.get_many(txids) == {txid: normalize_tx(content) for txid, content in contents.items()}
+
+
+def test_store_eviction(tmp_path, random_tx):
+    store = TxStore(str(tmp_path / "tx_store.sqlite"))
+    contents = [random_tx() for _ in range(4)]
+    store.put_many({content['txid']: content for content in contents})
+    with store.connection() as con:
+        con.execute("UPDATE txs SET last_access = 0")
+    store.get_many([contents[0]['txid'], contents[2]['txid']])  # Access times are only written at the next flush
+
+    assert store.evict(2) == 2
+    assert store.contains_many([content['txid'] for content in contents]) == {contents[0]['txid'],
+                                                                              contents[2]['txid']}
+
+
+def test_txid_from_url():
+    txid = "ab" * 32
+    assert txid_from_url(f"https://www.walletexplorer.com/api/1/tx?txid={txid}&caller=paulo") == txid
+    assert txid_from_url("https://www.walletexplorer.com/api/1/address?address=1Boat&from=0&count=100") is None
@@ -1,4 +1,88 @@
+import sys
+from array import array
+
+
+SATOSHIS_PER_BTC = 100_000_000
+
+
+def to_satoshis(amount):
+    """
+    :param amount: Amount in BTC (as given by the API)
+    :return: Amount in satoshis (int)
+    """
+    return round(amount * SATOSHIS_PER_BTC)
+
+
+def _intern_prev(prev):
+    """
+    :param prev: Tuple (txid, layer)
+    :return: Same tuple, with the txid interned
+    """
+    return sys.intern(prev[0]), prev[1]
+
+
+class _InterningList(list):
+    """
+    List whose items are interned whichever way they are added (by the _intern_item of the subclass), so that the
+    same txid or address is held once however many transactions it appears in.
+    """
+    __slots__ = ()  # As small as a list: a trace holds several of them per transaction
+
+    def __init__(self, items=()):
+        super().__init__([self._intern_item(item) for item in items])  # Exact size (no over-allocation)
+
+    def append(self, item):
+        super().append(self._intern_item(item))
+
+    def extend(self, items):
+        super().extend(self._intern_item(item) for item in items)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def insert(self, i, item):
+        super().insert(i, self._intern_item(item))
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            value = [self._intern_item(item) for item in value]
+        else:
+            value = self._intern_item(value)
+        super().__setitem__(key, value)
+
+
+class AddressList(_InterningList):
+    """
+    List of addresses, interned.
+    """
+    __slots__ = ()
+    _intern_item = staticmethod(sys.intern)
+
+
+class PrevTxidList(_InterningList):
+    """
+    List of tuples (txid, layer), with interned txids.
+    """
+    __slots__ = ()
+    _intern_item = staticmethod(_intern_prev)
+
+
+def _address_list(addresses):
+    """
+    :param addresses: List of addresses (or None)
+    :return: AddressList of the addresses (None if it is empty)
+    """
+    if not addresses:
+        return None
+    return AddressList(addresses)
+
+
 class Transaction:
+    # No __dict__ per transaction: traces can hold millions of them
+    __slots__ = ('txid', '_prev_txid', '_output_addresses', '_input_addresses', '_amount', 'rto', 'tag', 'is_pruned',
+                 'is_manually_deleted', 'colour')
+
     def __init__(self, txid, prev_txid=None, output_addresses=None, input_addresses=None,
                  amount=0, rto=0, is_pruned=None, tag=None):
         """
@@ -8,46 +92,211 @@ class Transaction:
         :param output_addresses: List of addresses.
         :param amount: amount of BTC output in this tx only according to output_addresses
         """
-        if output_addresses is None:
-            output_addresses = []
-        if input_addresses is None:
-            input_addresses = []
-        if prev_txid is None:
-            prev_txid = []
-        self.txid = txid
-        self.prev_txid = prev_txid
-        self.output_addresses = output_addresses    # Contains output addresses for the backward parsing (pointing to
-        # our output(s) of the transaction)
-        self.input_addresses = input_addresses   # Contains input addresses for the forward parsing (point to
-        # our input(s) of the transaction)
-        self.amount = amount
+        # Txids and addresses are interned, however they are added (see AddressList and PrevTxidList): a tx, the
+        # prev_txid of its children, the links of TransactionLists and the layer index share one string
+        self.txid = sys.intern(txid)
+        self.prev_txid = prev_txid if prev_txid is not None else []
+        self._output_addresses = _address_list(output_addresses)  # Contains output addresses for the backward parsing
+        # (pointing to our output(s) of the transaction)
+        self._input_addresses = _address_list(input_addresses)  # Contains input addresses for the forward parsing
+        # (point to our input(s) of the transaction)
+        self._amount = to_satoshis(amount)  # Stored in satoshis, so that adding amounts up is exact
         self.rto = rto  # Ratio To Original - contains the amount of original btc that the transaction is supposed to
-        # represent
+        # represent (share of the original amount, not a whole number of satoshis)
         self.tag = tag
         self.is_pruned = is_pruned     # Used to indicate if we pruned the tree based on that tx
         self.is_manually_deleted = False
         self.colour = None  # Only used to display the graph
 
+    @property
+    def prev_txid(self):
+        return self._prev_txid
+
+    @prev_txid.setter
+    def prev_txid(self, prev_txid):
+        self._prev_txid = PrevTxidList(prev_txid)
+
+    # A tx only uses one of its address lists (depending on the direction of the parsing): the other one is only
+    # created if it is accessed
+    @property
+    def output_addresses(self):
+        if self._output_addresses is None:
+            self._output_addresses = AddressList()
+        return self._output_addresses
+
+    @output_addresses.setter
+    def output_addresses(self, addresses):
+        self._output_addresses = _address_list(addresses)
+
+    @property
+    def input_addresses(self):
+        if self._input_addresses is None:
+            self._input_addresses = AddressList()
+        return self._input_addresses
+
+    @input_addresses.setter
+    def input_addresses(self, addresses):
+        self._input_addresses = _address_list(addresses)
+
+    @property
+    def amount(self):
+        """
+        :return: Amount of the transaction in BTC
+        """
+        return self._amount / SATOSHIS_PER_BTC
+
+    @amount.setter
+    def amount(self, amount):
+        self._amount = to_satoshis(amount)
+
     def __str__(self):
-        return str(self.__dict__)
+        return str({'txid': self.txid, 'prev_txid': self.prev_txid, 'output_addresses': self.output_addresses,
+                    'input_addresses': self.input_addresses, 'amount': self.amount, 'rto': self.rto, 'tag': self.tag,
+                    'is_pruned': self.is_pruned, 'is_manually_deleted': self.is_manually_deleted,
+                    'colour': self.colour})
+
+
+class TransactionLayer(list):
+    """
+    List of the transactions of a layer, with an index from txid to position kept up to date so that a transaction
+    can be found in O(1). Appending keeps the index valid, any other change (pop, sort...) makes it rebuilt on the
+    next lookup.
+    """
+    def __init__(self, transactions=()):
+        super().__init__(transactions)
+        self._index = None
+
+    def index_of(self, txid):
+        """
+        :param txid: Transaction ID
+        :return: Position of the first transaction of the layer with that txid, -1 if there is none
+        """
+        if self._index is None:
+            self._index = dict()
+            for i, tx in enumerate(self):
+                self._index.setdefault(tx.txid, i)
+        return self._index.get(txid, -1)
+
+    def append(self, tx):
+        if self._index is not None:
+            self._index.setdefault(tx.txid, len(self))
+        super().append(tx)
+
+    def extend(self, transactions):
+        for tx in transactions:
+            self.append(tx)
+
+    def __iadd__(self, transactions):
+        self.extend(transactions)
+        return self
+
+    # Any other change can move transactions around: the index is rebuilt on the next lookup
+    def pop(self, *args):
+        self._index = None
+        return super().pop(*args)
+
+    def remove(self, tx):
+        self._index = None
+        super().remove(tx)
+
+    def insert(self, i, tx):
+        self._index = None
+        super().insert(i, tx)
+
+    def sort(self, *args, **kwargs):
+        self._index = None
+        super().sort(*args, **kwargs)
+
+    def reverse(self):
+        self._index = None
+        super().reverse()
+
+    def clear(self):
+        self._index = None
+        super().clear()
+
+    def __setitem__(self, key, value):
+        self._index = None
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._index = None
+        super().__delitem__(key)
+
+
+class TransactionLists(dict):
+    """
+    Dict of the layers of an analysis (layer number -> TransactionLayer). Lists assigned to a layer are converted to
+    TransactionLayer, so that find_transaction is served from their index.
+    """
+    def __init__(self, layers=()):
+        super().__init__()
+        # (txid, layer) of a tx -> list of the (txid, layer) of the tx that have it in their prev_txid
+        self.children = dict()
+        for layer, transactions in dict(layers).items():
+            self[layer] = transactions
+
+    def add_link(self, prev, child):
+        """
+        Records that the tx child comes from the tx prev, i.e. that prev is in the prev_txid of child.
+        :param prev: Tuple (txid, layer) of the previous transaction
+        :param child: Tuple (txid, layer) of the next transaction
+        :return: None
+        """
+        self.children.setdefault(_intern_prev(prev), []).append(_intern_prev(child))
+
+    def remove_links(self, prev):
+        """
+        Unlinks the tx prev from all of its children, and does the same for every child that has no previous
+        transaction left, and so on. Takes a time proportional to the number of links removed.
+        :param prev: Tuple (txid, layer) of a transaction
+        :return: Set of the (txid, layer) of the transactions that have no previous transaction anymore
+        """
+        orphans = set()
+        to_unlink = [prev]
+        while to_unlink:
+            parent = to_unlink.pop()
+            for child_txid, child_layer in self.children.pop(parent, []):
+                i = find_transaction(self, child_txid, layer=child_layer)
+                if i == -1:
+                    continue
+                child = self[child_layer][i]
+                child.prev_txid = [elt for elt in child.prev_txid if (elt[0], elt[1]) != parent]
+                if not child.prev_txid and (child_txid, child_layer) not in orphans:
+                    orphans.add((child_txid, child_layer))
+                    to_unlink.append((child_txid, child_layer))
+        return orphans
+
+    def __setitem__(self, layer, transactions):
+        if not isinstance(transactions, TransactionLayer):
+            transactions = TransactionLayer(transactions)
+        super().__setitem__(layer, transactions)
+
+
+def _index_in_layer(tx_list, txid):
+    """
+    :return: Position of txid in tx_list, -1 if it is not there
+    """
+    if isinstance(tx_list, TransactionLayer):
+        return tx_list.index_of(txid)
+    for i, tx in enumerate(tx_list):
+        if tx.txid == txid:
+            return i
+    return -1
 
 
 def find_transaction(tx_lists, txid, layer=None, start_index=None, stop_index=None):
     if layer is not None:
-        for i, tx in enumerate(tx_lists[layer]):
-            if tx.txid == txid:
-                return i
-        return -1
+        return _index_in_layer(tx_lists[layer], txid)
     else:
         if start_index is None:
             start_index = 0
         if stop_index is None:
             stop_index = len(tx_lists)
         for layer in range(start_index, stop_index):
-            tx_list = tx_lists[layer]
-            for i, tx in enumerate(tx_list):
-                if tx.txid == txid:
-                    return layer, i
+            i = _index_in_layer(tx_lists[layer], txid)
+            if i != -1:
+                return layer, i
         return -1, -1
 
 
@@ -61,3 +310,61 @@ def get_prev_transaction_ids(tx_list):
     for tx in tx_list:
         id_list.update([elt[0] for elt in tx.prev_txid])
     return list(id_list)
+
+
+class RootCandidates:
+    def __init__(self, rto_threshold, compaction_size=1024):
+        """
+        Transactions of the wallet (layer 0) streamed in one at a time, of which we only keep the ones whose amount is
+        above the RTO threshold. As that threshold is a percentage of the sum of all the amounts, it can only increase
+        while transactions are added: a transaction below the current threshold is dropped straight away, and the
+        ones kept are regularly compacted, so that only O(100 / rto_threshold) transactions are held at any time.
+        :param rto_threshold: RTO threshold, in percentage of the root value
+        :param compaction_size: Number of transactions kept before the first compaction
+        """
+        self.rto_threshold = rto_threshold
+        self.root_value = 0
+        self.nb_added = 0
+        self.txids = []
+        self.amounts = array('d')
+        self._compaction_size = compaction_size
+        self._next_compaction = compaction_size
+
+    def threshold(self):
+        """
+        :return: Current RTO threshold (in BTC)
+        """
+        return self.root_value * (self.rto_threshold / 100)
+
+    def add(self, txid, amount):
+        """
+        :param txid: Transaction ID
+        :param amount: Amount of the transaction
+        :return: None
+        """
+        self.root_value += amount
+        self.nb_added += 1
+        if amount < self.threshold():
+            return
+        self.txids.append(txid)
+        self.amounts.append(amount)
+        if len(self.txids) >= self._next_compaction:
+            self._compact()
+            self._next_compaction = max(self._compaction_size, 2 * len(self.txids))
+
+    def _compact(self):
+        """
+        Drops the transactions that are now below the threshold.
+        :return: None
+        """
+        threshold = self.threshold()
+        kept = [i for i, amount in enumerate(self.amounts) if amount >= threshold]
+        self.txids = [self.txids[i] for i in kept]
+        self.amounts = array('d', [self.amounts[i] for i in kept])
+
+    def survivors(self):
+        """
+        :return: List of tuples (txid, amount) of the transactions above the final threshold, by decreasing amount
+        """
+        self._compact()
+        return sorted(zip(self.txids, self.amounts), key=lambda x: x[1], reverse=True)
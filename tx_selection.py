@@ -0,0 +1,557 @@
+import math
+import multiprocessing
+import threading
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from transaction import SATOSHIS_PER_BTC, to_satoshis
+from tx_store import decode_tx
+
+# Only the fields of the selected inputs/outputs used by ChainParser are sent back by the worker processes
+SELECTED_ENTRY_FIELDS = ('address', 'amount', 'rto', 'is_standard', 'next_tx', 'label')
+
+# Transactions with more inputs (resp. outputs) than that are not checked for a subset sum: the check is exponential
+# (about 10ms for 24 entries), and is bounded by a number of entries rather than a time budget so that the selections
+# are the same from one run (or machine) to another
+SUBSET_SUM_MAX_ENTRIES = 24
+
+_pools = dict()  # Number of workers -> ProcessPoolExecutor, shared by every parser of the process
+_pools_lock = threading.Lock()
+
+
+def get_process_pool(max_workers):
+    """
+    Returns the pool of worker processes used to decode and select the transactions of huge layers.
+    Workers are spawned rather than forked, as the parent process runs other threads (event loop, cache janitor).
+    :param max_workers: Number of worker processes
+    :return: ProcessPoolExecutor
+    """
+    with _pools_lock:
+        if max_workers not in _pools:
+            _pools[max_workers] = ProcessPoolExecutor(max_workers=max_workers,
+                                                      mp_context=multiprocessing.get_context("spawn"))
+    return _pools[max_workers]
+
+
+def set_rto(input_list, rto, rto_threshold):
+    """
+    Set rto to each of the tx that are in input_list according to their value, and removes the ones whose rto is
+    below rto_threshold
+    :param input_list: Dict of the inputs of a transaction (i.e. future transactions in the next layer)
+    :param rto: rto of the current transaction to share between the next transactions
+    :param rto_threshold: Minimum rto of the transactions we keep
+    :return: Number of transactions removed because of their low rto
+    """
+    # Shares are computed on satoshis, as select_layer does
+    sum_value = sum([to_satoshis(tx['amount']) for tx in input_list])
+    if sum_value == 0:  # Nothing to share (e.g. only 0-value outputs): nothing is selected
+        for tx in input_list:
+            tx['rto'] = 0
+        nb_low_rto = len(input_list)
+        input_list.clear()
+        return nb_low_rto
+
+    nb_low_rto = 0
+    for i in range(len(input_list) - 1, -1, -1):
+        input_list[i]['rto'] = min(input_list[i]['amount'], (to_satoshis(input_list[i]['amount']) / sum_value) * rto)
+
+        # We only keep transactions with RTOs > threshold
+        if input_list[i]['rto'] < rto_threshold:
+            nb_low_rto += 1
+            input_list.pop(i)
+    return nb_low_rto
+
+
+def fee_match(values, targets, fee):
+    """
+    1st check of the selectors: the fee is added to the smallest value, the values are sorted again, the fee is added
+    to the second smallest value, and so on, until values match targets. Gives the same answers as doing so, in O(n):
+    - if fee >= 0, a value the fee is added to can only move to the right. The values left to add the fee to are
+    then the original values not reached yet and the values the fee has been added to (each one in increasing order),
+    so the next one is the smallest of the heads of two queues.
+    - if fee < 0, a value the fee is added to can only move to the left, so the next value is always the next
+    original value.
+    Values are compared as multisets (hashed counts of their differences) instead of sorted lists.
+    :param values: Sorted amounts (in satoshis) the fee is added to
+    :param targets: Amounts (in satoshis) to match
+    :param fee: Amount (in satoshis) added to the values, one at a time
+    :return: True if values match targets after the fee has been added to some of them
+    """
+    if len(values) != len(targets):
+        return False
+    diff = dict()  # Value -> (number of times in values) - (number of times in targets), only non-zero counts
+    nb_different = 0
+
+    def update(value, count):
+        nonlocal nb_different
+        new_count = diff.get(value, 0) + count
+        if new_count == 0:
+            del diff[value]
+            nb_different -= 1
+        else:
+            if value not in diff:
+                nb_different += 1
+            diff[value] = new_count
+
+    for value in values:
+        update(value, 1)
+    for value in targets:
+        update(value, -1)
+
+    originals, added = deque(values), deque()
+    for i in range(len(values)):
+        if fee >= 0:
+            value = originals.popleft() if not added or (originals and originals[0] <= added[0]) else added.popleft()
+            added.append(value + fee)
+        else:
+            value = values[i]
+        update(value, -1)
+        update(value + fee, 1)
+        if nb_different == 0:
+            return True
+        if fee >= 0:  # The smallest value left is now in position i: the fee won't be added to it
+            if not added or (originals and originals[0] <= added[0]):
+                originals.popleft()
+            else:
+                added.popleft()
+    return False
+
+
+def _first_indexes(values):
+    """
+    :param values: List of values
+    :return: Dict value -> index of its first occurrence in values
+    """
+    indexes = dict()
+    for i, value in enumerate(values):
+        indexes.setdefault(value, i)
+    return indexes
+
+
+def _subset_sums(values):
+    """
+    :param values: List of amounts (in satoshis)
+    :return: List of tuples (sum, bit mask of the values summed) of every subset of values, sorted by sum
+    """
+    sums = [(0, 0)]
+    for k, value in enumerate(values):
+        sums += [(total + value, mask | 1 << k) for total, mask in sums]
+    sums.sort()
+    return sums
+
+
+def find_subset_sum(values, low, high, max_entries=SUBSET_SUM_MAX_ENTRIES):
+    """
+    Looks for the subset of values whose sum is between low and high (meet in the middle: O(n * 2^(n/2))).
+    Only proper, non-empty subsets are considered, and the subset must be the only one matching: if several subsets
+    match, we cannot tell which entries the amount comes from. The cost only depends on the number of values (the
+    search stops at the second match), so the answer never depends on the load of the machine.
+    :param values: List of amounts (in satoshis)
+    :param low: Minimum sum (in satoshis)
+    :param high: Maximum sum (in satoshis)
+    :param max_entries: Maximum number of values we try to match (the search is exponential)
+    :return: Sorted list of the indexes of the matching subset, None if there is no such subset (or several of them,
+    or too many values)
+    """
+    if len(values) < 2 or len(values) > max_entries or high < low:
+        return None
+    half = len(values) // 2
+    left_sums = _subset_sums(values[:half])
+    right_sums = _subset_sums(values[half:])
+    right_totals = [total for total, _ in right_sums]
+    full_mask = (1 << len(values)) - 1
+
+    found = None
+    for total, mask in left_sums:
+        for j in range(bisect_left(right_totals, low - total), bisect_right(right_totals, high - total)):
+            subset_mask = mask | right_sums[j][1] << half
+            if subset_mask == 0 or subset_mask == full_mask:
+                continue
+            if found is not None:  # Several subsets match
+                return None
+            found = subset_mask
+    if found is None:
+        return None
+    return [k for k in range(len(values)) if found >> k & 1]
+
+
+def select_inputs(tx_content, observed_addresses, observed_rto, rto_threshold):
+    """
+    Selects inputs that we will continue to investigate. Refer to the decision tree to have a better understanding
+    on how we decided to handle the different cases
+    :param tx_content: Content of the transaction that we are currently looking.
+    :param observed_addresses: Output addresses of the transaction that we are following
+    :param observed_rto: RTO of the transaction that we are following
+    :param rto_threshold: Minimum rto of the inputs we keep
+    :return: Tuple (selected input addresses, dict of stats: nb_inputs, nb_removed, nb_low_rto and is_pruned)
+    """
+    stats = {'nb_inputs': len(tx_content['in']), 'nb_removed': 0, 'nb_low_rto': 0, 'is_pruned': False}
+
+    # We sort in and out lists as it will be necessary in a further step
+    tx_content['in'].sort(key=lambda x: x['amount'])
+    tx_content['out'].sort(key=lambda x: x['amount'])
+    input_values = [add['amount'] for add in tx_content['in']]
+    output_values = [add['amount'] for add in tx_content['out']]
+    observed = set(observed_addresses)
+    observed_outputs = [add for add in tx_content['out'] if add['address'] in observed]
+
+    if len(input_values) > 1:
+        # First, we calculate the tx fee by adding all the input values and subtracting the output values
+        input_satoshis = [to_satoshis(value) for value in input_values]
+        fee = sum(input_satoshis) - sum(to_satoshis(value) for value in output_values)
+        # Then, 1st check: input_values match with output_values AND that we have the same number of input/outputs
+        if fee_match([to_satoshis(value) for value in output_values], input_satoshis, fee):
+            # Only ONE input value matches our output value(s) (two by two)
+            # - there can be multiple output addresses to look at
+            input_indexes = _first_indexes(input_satoshis)
+            used_indexes = set()
+            for add in observed_outputs:
+                if to_satoshis(add['amount']) in input_indexes:
+                    used_indexes.add(input_indexes[to_satoshis(add['amount'])])
+            if len(used_indexes) == len(observed_addresses):  # If it's the case:
+                selected_inputs = [tx_content['in'][i] for i in used_indexes]
+            else:
+                selected_inputs = tx_content['in']
+
+            stats['nb_removed'] = len(tx_content['in']) - len(selected_inputs)
+            # We set the RTO to all the selected transactions
+            stats['nb_low_rto'] = set_rto(selected_inputs, observed_rto, rto_threshold)
+            return selected_inputs, stats
+
+        # Second check: there is a sublist of input values whose sum equals our output values (two by two)
+        # - Again, there can be multiple output values to look at
+        # The inputs of that sublist pay our outputs, plus (part of) the tx fee
+        observed_value = sum(to_satoshis(add['amount']) for add in observed_outputs)
+        subset = find_subset_sum(input_satoshis, observed_value,
+                                 observed_value + fee) if observed_value > 0 else None
+
+        if subset is not None:
+            selected_inputs = [tx_content['in'][i] for i in subset]
+
+        # If one input value represents more than 95% of the tot. Ratios are compared on satoshis
+        # (20 * value > 19 * total <=> value / total > 0.95), as select_layer does
+        elif 20 * input_satoshis[-1] > 19 * sum(input_satoshis):
+            selected_inputs = [tx_content['in'][-1]]
+
+        else:
+            # We also want to prune tx if a number -let's say 20%- of tx represents more than 80% of the total
+            nb_tx = math.ceil(len(input_values) * 0.2)
+            if 5 * sum(input_satoshis[-1 - nb_tx:]) > 4 * sum(input_satoshis):
+                selected_inputs = tx_content['in'][-1 - nb_tx:]
+
+            elif len(input_values) > 50:  # If too many transactions, we prune them and only take the 10 biggest
+                selected_inputs = tx_content['in'][-1 - 10:]
+            else:
+                selected_inputs = tx_content['in']
+
+    else:
+        # Need to add the rto to the only input transaction (= to previous rto)
+        selected_inputs = tx_content['in']
+
+    stats['is_pruned'] = len(selected_inputs) != len(tx_content['in'])
+    stats['nb_removed'] = len(tx_content['in']) - len(selected_inputs)
+    # We set the RTO to all the selected transactions and remove low ones
+    stats['nb_low_rto'] = set_rto(selected_inputs, observed_rto, rto_threshold)
+    return selected_inputs, stats
+
+
+def select_outputs(tx_content, observed_addresses, observed_rto, rto_threshold):
+    """
+    Selects outputs that we will continue to investigate. Refer to the decision tree to have a better understanding
+    on how we decided to handle the different cases
+    :param tx_content: Content of the transaction that we are currently looking.
+    :param observed_addresses: Input addresses of the transaction that we are following
+    :param observed_rto: RTO of the transaction that we are following
+    :param rto_threshold: Minimum rto of the outputs we keep
+    :return: Tuple (selected output addresses, dict of stats: is_pruned)
+    """
+    stats = {'is_pruned': False}
+
+    # We sort in and out lists as it will be necessary in a further step
+    tx_content['in'].sort(key=lambda x: x['amount'])
+    tx_content['out'].sort(key=lambda x: x['amount'])
+    observed = set(observed_addresses)
+    observed_inputs = [add for add in tx_content['in'] if add['address'] in observed]
+    # Amounts used by the subset sum check, before the change outputs are removed
+    fee = sum(to_satoshis(add['amount']) for add in tx_content['in']) \
+        - sum(to_satoshis(add['amount']) for add in tx_content['out'])
+    observed_value = sum(to_satoshis(add['amount']) for add in observed_inputs) \
+        - sum(to_satoshis(add['amount']) for add in tx_content['out'] if add['address'] in observed)
+
+    # Remove "out" transactions that go to a change address
+    for i in range(len(tx_content['out']) - 1, -1, -1):
+        if tx_content['out'][i]['address'] in observed \
+                or tx_content['out'][i]['is_standard'] is False:  # or \
+            # tx_content['wallet_id'] == tx_content['out'][i]['wallet_id']:
+            tx_content['out'].pop(i)
+
+    input_values = [add['amount'] for add in tx_content['in']]
+    output_values = [add['amount'] for add in tx_content['out']]
+
+    if len(output_values) > 1:
+        # First, we calculate the tx fee by adding all the input values and subtracting the output values
+        output_satoshis = [to_satoshis(value) for value in output_values]
+        tx_fee = sum(to_satoshis(value) for value in input_values) - sum(output_satoshis)
+
+        # Then, 1st check: output_values match with input_values AND that we have the same number of input/outputs
+        # (the fee is subtracted from the input values, one at a time)
+        if fee_match([to_satoshis(value) for value in input_values], output_satoshis, -tx_fee):
+            # Only ONE input value matches our output value(s) (two by two)
+            # - there can be multiple output addresses to look at
+            output_indexes = _first_indexes(output_satoshis)
+            used_indexes = set()
+            for add in observed_inputs:
+                if to_satoshis(add['amount']) in output_indexes:
+                    used_indexes.add(output_indexes[to_satoshis(add['amount'])])
+            if len(used_indexes) == len(observed_addresses):  # If it's the case:
+                selected_outputs = [tx_content['out'][i] for i in used_indexes]
+                print(f"FINALLY")
+            else:
+                selected_outputs = tx_content['out']
+
+            # We set the RTO to all the selected transactions
+            set_rto(selected_outputs, observed_rto, rto_threshold)
+            return selected_outputs, stats
+
+        # Second check: there is a sublist of output values whose sum equals our input values (two by two)
+        # - Again, there can be multiple output values to look at
+        # Our inputs (minus our change) pay the outputs of that sublist, plus (part of) the tx fee
+        subset = find_subset_sum(output_satoshis, observed_value - fee,
+                                 observed_value) if observed_value > 0 else None
+
+        if subset is not None:
+            selected_outputs = [tx_content['out'][i] for i in subset]
+
+        # Third check: if one output value represents more than 95% of the tot. (on satoshis, see select_inputs)
+        elif 20 * output_satoshis[-1] > 19 * sum(output_satoshis):
+            selected_outputs = [tx_content['out'][-1]]
+
+        else:
+            # We also want to prune tx if a number -let's say 20%- of tx represents more than 80% of the total
+            nb_tx = math.ceil(len(output_values) * 0.2)
+            if 5 * sum(output_satoshis[-1 - nb_tx:]) > 4 * sum(output_satoshis):
+                selected_outputs = tx_content['out'][-1 - nb_tx:]
+
+            elif len(output_values) > 50:  # If too many transactions, we prune them and only take the 10 biggest
+                selected_outputs = tx_content['out'][-1 - 10:]
+            else:  # If none of the above conditions hold, we take all the outputs
+                selected_outputs = tx_content['out']
+
+    else:
+        # Need to add the rto to the only input transaction (= to previous rto)
+        selected_outputs = tx_content['out']
+
+    stats['is_pruned'] = len(selected_outputs) != len(tx_content['out'])
+
+    # We set the RTO to all the selected transactions and remove low ones
+    set_rto(selected_outputs, observed_rto, rto_threshold)
+    return selected_outputs, stats
+
+
+def _largest(values, nb):
+    """
+    :param values: NumPy array of amounts
+    :param nb: Number of values to take
+    :return: Positions of the nb largest values, in the order of a stable sort (ties are broken as a stable sort
+    does: the last ones are the largest). Found by partial selection, only the nb values taken are sorted
+    """
+    nb_values = len(values)
+    threshold = np.partition(values, nb_values - nb)[nb_values - nb]
+    above = np.flatnonzero(values > threshold)
+    equal = np.flatnonzero(values == threshold)
+    positions = np.concatenate((equal[len(equal) - (nb - len(above)):], above))
+    return positions[np.lexsort((positions, values[positions]))]
+
+
+def _satoshis_per_tx(tx_contents, direction, observed_sets):
+    """
+    :param tx_contents: List of the contents of transactions
+    :param direction: 'in' or 'out'
+    :param observed_sets: List of the sets of observed addresses, one per transaction
+    :return: Tuple of NumPy arrays (sum of the amounts, sum of the amounts of the observed addresses) of the entries
+    of each transaction in that direction, in satoshis
+    """
+    tx_ids = np.repeat(np.arange(len(tx_contents)), [len(tx_content[direction]) for tx_content in tx_contents])
+    satoshis = np.rint(np.array([add['amount'] for tx_content in tx_contents for add in tx_content[direction]],
+                                dtype=np.float64) * SATOSHIS_PER_BTC)
+    is_observed = np.array([add['address'] in observed for tx_content, observed in zip(tx_contents, observed_sets)
+                            for add in tx_content[direction]], dtype=bool)
+    # Sums of satoshis are exact in float64 (they are below 2^53)
+    totals = np.bincount(tx_ids, weights=satoshis, minlength=len(tx_contents))
+    observed_totals = np.bincount(tx_ids, weights=satoshis * is_observed, minlength=len(tx_contents))
+    return totals.astype(np.int64), observed_totals.astype(np.int64)
+
+
+def select_layer(tx_contents, observations, forward, rto_threshold):
+    """
+    Selects the inputs (backward parsing) or outputs (forward parsing) of all the transactions of a layer at once,
+    with the same selections as select_inputs/select_outputs. The amounts of the whole layer are put in NumPy arrays,
+    on which the pruning rules and the RTOs are computed in one pass: the entries of the small transactions are sorted
+    all together, the largest entries of the big ones are found by partial selection, and the observed addresses are
+    looked up in sets.
+    Transactions with as many inputs as outputs (which the 1st check may match) are left to select_inputs or
+    select_outputs.
+    :param tx_contents: List of the contents of the transactions
+    :param observations: List of tuples (observed addresses, observed rto), one per transaction
+    :param forward: True to select outputs, False to select inputs
+    :param rto_threshold: Minimum rto of the entries we keep
+    :return: List of tuples (selected entries, stats) as returned by select_inputs/select_outputs, one per transaction
+    """
+    select = select_outputs if forward else select_inputs
+    results = [None] * len(tx_contents)
+    batch = []  # Tuples (position, tx content, set of observed addresses, entries to select from) of the batch
+    for position, (tx_content, (observed_addresses, observed_rto)) in enumerate(zip(tx_contents, observations)):
+        observed = set(observed_addresses)
+        if forward:  # Change outputs are never selected
+            entries = [add for add in tx_content['out']
+                       if add['address'] not in observed and add['is_standard'] is not False]
+            others = tx_content['in']
+        else:
+            entries, others = tx_content['in'], tx_content['out']
+        if 1 < len(entries) == len(others):
+            results[position] = select(tx_content, observed_addresses, observed_rto, rto_threshold)
+        elif not entries:
+            results[position] = [], ({'is_pruned': False} if forward else
+                                     {'nb_inputs': 0, 'nb_removed': 0, 'nb_low_rto': 0, 'is_pruned': False})
+        else:
+            batch.append((position, tx_content, observed, entries))
+    if not batch:
+        return results
+
+    # Entries of the whole batch, one segment per transaction. They are ordered by their amount as a float (as
+    # select_inputs/select_outputs sort them, ties in the order of the page) and summed as satoshis
+    counts = np.array([len(entries) for _, _, _, entries in batch], dtype=np.int64)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    tx_ids = np.repeat(np.arange(len(batch)), counts)
+    values = np.array([add['amount'] for _, _, _, entries in batch for add in entries], dtype=np.float64)
+    satoshis = np.rint(values * SATOSHIS_PER_BTC).astype(np.int64)  # Same rounding as to_satoshis
+    totals = np.add.reduceat(satoshis, starts)
+
+    # Every selection ends up as the last entries of its segment in ranked: the entries of the small transactions are
+    # sorted all at once, the selections of the big ones are written there by partial selection
+    is_small = counts <= 50
+    small = np.flatnonzero(is_small[tx_ids])
+    ranked = np.arange(len(values))
+    ranked[small] = small[np.lexsort((small, values[small], tx_ids[small]))]
+
+    nb_top = np.minimum(np.ceil(counts * 0.2).astype(np.int64) + 1, counts)  # Size of the slice [-1 - nb_tx:]
+    prefix_sums = np.concatenate(([0], np.cumsum(satoshis[ranked])))
+    top_sums = prefix_sums[ends] - prefix_sums[ends - nb_top]  # Only right for the small transactions
+    for j in np.flatnonzero(~is_small).tolist():
+        nb_entries, start = int(counts[j]), int(starts[j])
+        top_sums[j] = np.partition(satoshis[start:start + nb_entries], nb_entries - nb_top[j])[-nb_top[j]:].sum()
+
+    # Rules of select_inputs/select_outputs, compared on satoshis
+    is_dominant = 20 * np.maximum.reduceat(satoshis, starts) > 19 * totals  # One entry represents more than 95%
+    nb_chosen = np.where(counts == 1, 1,
+                         np.where(is_dominant, 1,
+                                  np.where(5 * top_sums > 4 * totals, nb_top,  # 20% of the entries represent > 80%
+                                           np.where(counts > 50, 11, counts))))  # Too many entries: the 11 biggest
+
+    # Second check, before the rules: a sublist of the entries matches the observed amount
+    out_totals, observed_out_totals = _satoshis_per_tx([tx_content for _, tx_content, _, _ in batch], 'out',
+                                                       [observed for _, _, observed, _ in batch])
+    if forward:  # Our inputs, minus our change, pay the outputs of the sublist plus (part of) the fee
+        in_totals, observed_in_totals = _satoshis_per_tx([tx_content for _, tx_content, _, _ in batch], 'in',
+                                                         [observed for _, _, observed, _ in batch])
+        highs = observed_in_totals - observed_out_totals
+        lows = highs - (in_totals - out_totals)
+        observed_values = highs
+    else:  # The inputs of the sublist (the entries) pay our outputs, plus (part of) the fee
+        lows = observed_out_totals
+        highs = lows + (totals - out_totals)
+        observed_values = lows
+    for j in np.flatnonzero((counts > 1) & (counts <= SUBSET_SUM_MAX_ENTRIES) & (observed_values > 0)).tolist():
+        start, end = int(starts[j]), int(ends[j])
+        subset = find_subset_sum(satoshis[ranked[start:end]].tolist(), int(lows[j]), int(highs[j]))
+        if subset is not None:
+            ranked[end - len(subset):end] = ranked[start:end][subset]
+            nb_chosen[j] = len(subset)
+
+    for j in np.flatnonzero(~is_small).tolist():
+        start, end = int(starts[j]), int(ends[j])
+        ranked[end - nb_chosen[j]:end] = _largest(values[start:end], nb_chosen[j]) + start
+
+    # RTOs of all the selected entries (see set_rto)
+    chosen_starts = np.cumsum(nb_chosen) - nb_chosen
+    selected = ranked[np.repeat(ends - nb_chosen - chosen_starts, nb_chosen) + np.arange(nb_chosen.sum())]
+    sums = np.add.reduceat(satoshis[selected], chosen_starts)
+    observed_rtos = np.array([observations[position][1] for position, _, _, _ in batch], dtype=np.float64)
+    selected_sums = np.repeat(sums, nb_chosen)
+    # Nothing is shared (and selected) when the selected entries sum to 0, as set_rto does
+    shares = np.divide(satoshis[selected], selected_sums, out=np.zeros(len(selected)), where=selected_sums != 0)
+    rtos = np.where(selected_sums != 0, np.minimum(values[selected], shares * np.repeat(observed_rtos, nb_chosen)), 0)
+    is_kept = (selected_sums != 0) & (rtos >= rto_threshold)
+    rtos, is_kept, selected = rtos.tolist(), is_kept.tolist(), selected.tolist()
+
+    all_entries = [add for _, _, _, entries in batch for add in entries]
+    k = 0
+    for j, (position, tx_content, _, entries) in enumerate(batch):
+        nb_selected = int(nb_chosen[j])
+        selected_entries = []
+        for _ in range(nb_selected):
+            all_entries[selected[k]]['rto'] = rtos[k]
+            if is_kept[k]:
+                selected_entries.append(all_entries[selected[k]])
+            k += 1
+        is_pruned = nb_selected != len(entries)
+        if forward:
+            stats = {'is_pruned': is_pruned}
+        else:
+            stats = {'nb_inputs': len(entries), 'nb_removed': len(entries) - nb_selected,
+                     'nb_low_rto': nb_selected - len(selected_entries), 'is_pruned': is_pruned}
+        results[position] = selected_entries, stats
+    return results
+
+
+def _decode(txid, data):
+    """
+    :param txid: Transaction ID
+    :param data: Transaction stored in the TxStore
+    :return: Tuple (content of the transaction, compact content returned by select_batch without the selection)
+    """
+    tx_content = decode_tx(txid, data)
+    result = {'txid': txid, 'is_coinbase': tx_content['is_coinbase']}
+    if 'label' in tx_content:
+        result['label'] = tx_content['label']
+    return tx_content, result
+
+
+def _compact_selection(observed_addresses, observed_rto, selected, stats):
+    """
+    :return: Selection returned by select_batch: ((observed addresses, observed rto), selected entries, stats)
+    """
+    selected = [{key: add[key] for key in SELECTED_ENTRY_FIELDS if key in add} for add in selected]
+    return (observed_addresses, observed_rto), selected, stats
+
+
+def select_batch(jobs):
+    """
+    Run by ChainParser.replay_selected, in the process or in its worker processes: decodes a batch of transactions
+    stored in the TxStore and selects their inputs (backward parsing) or outputs (forward parsing), all at once
+    (see select_layer).
+    :param jobs: List of jobs of the same layer, i.e. with the same direction and rto threshold:
+    tuples (txid, encoded transaction, forward, observed addresses, observed rto, rto threshold)
+    :return: List of the compact contents of the pages, in the order of jobs: txid, is_coinbase and label (if any),
+    plus the selection made with the observed transaction given in the job, unless the tx is tagged:
+    ((observed addresses, observed rto), selected entries, stats)
+    """
+    results, tx_contents, observations, to_select = [], [], [], []
+    for txid, data, forward, observed_addresses, observed_rto, rto_threshold in jobs:
+        tx_content, result = _decode(txid, data)
+        results.append(result)
+        if not tx_content['is_coinbase'] and 'label' not in tx_content:  # Otherwise, the tx is tagged
+            tx_contents.append(tx_content)
+            observations.append((observed_addresses, observed_rto))
+            to_select.append(result)
+    if to_select:
+        forward, rto_threshold = jobs[0][2], jobs[0][5]
+        for result, observation, (selected, stats) in zip(to_select, observations,
+                                                          select_layer(tx_contents, observations, forward,
+                                                                       rto_threshold)):
+            result['selection'] = _compact_selection(*observation, selected, stats)
+    return results
@@ -0,0 +1,323 @@
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from urllib.parse import parse_qs, urlsplit
+
+FORMAT_VERSION = 1
+
+# Flags of a transaction
+IS_COINBASE = 1
+HAS_LABEL = 2
+
+# Flags of an input/output
+ENTRY_IS_STANDARD = 1
+ENTRY_HAS_ADDRESS = 2
+ENTRY_HAS_NEXT_TX = 4
+ENTRY_HAS_LABEL = 8
+
+ACCESS_FLUSH_SIZE = 10000  # Number of pending last access times written at once (see TxStore.flush_accesses)
+
+_stores = dict()  # Path -> TxStore, shared by every parser of the process (see get_tx_store)
+_stores_lock = threading.Lock()
+
+
+def create_database(path):
+    """
+    Creates an empty SQLite database using incremental vacuum, so that its free pages can be given back to the file
+    system while it is used (see cache_janitor.compact_database). auto_vacuum can only be changed before anything
+    else is written to the file (tables, journal mode): existing databases are left as they are.
+    :param path: Path of the database
+    :return: True if the database has been created, False if it already existed
+    """
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        return False
+    con = sqlite3.connect(path)
+    try:
+        con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        con.execute("VACUUM")  # Writes the header of the file, which holds the setting
+    finally:
+        con.close()
+    return True
+
+
+def txid_from_url(url):
+    """
+    :param url: URL of a WalletExplorer API page
+    :return: txid of the page if it is a transaction page, None otherwise
+    """
+    url_parts = urlsplit(url)
+    if not url_parts.path.endswith("/api/1/tx"):
+        return None
+    return parse_qs(url_parts.query).get('txid', [None])[0]
+
+
+def _write_varint(buffer, number):
+    if number < 0:
+        raise ValueError(f"Cannot encode negative number {number}")
+    while number >= 0x80:
+        buffer.append((number & 0x7f) | 0x80)
+        number >>= 7
+    buffer.append(number)
+
+
+def _read_varint(data, pos):
+    number, shift = 0, 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        number |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return number, pos
+        shift += 7
+
+
+def _write_str(buffer, string):
+    encoded = string.encode()
+    _write_varint(buffer, len(encoded))
+    buffer.extend(encoded)
+
+
+def _read_str(data, pos):
+    length, pos = _read_varint(data, pos)
+    return data[pos:pos + length].decode(), pos + length
+
+
+def _write_entry(buffer, entry):
+    flags = ENTRY_IS_STANDARD if entry['is_standard'] else 0
+    if entry.get('address') is not None:
+        flags |= ENTRY_HAS_ADDRESS
+    if 'next_tx' in entry:
+        flags |= ENTRY_HAS_NEXT_TX
+    if 'label' in entry:
+        flags |= ENTRY_HAS_LABEL
+    buffer.append(flags)
+    if flags & ENTRY_HAS_ADDRESS:
+        _write_str(buffer, entry['address'])
+    _write_varint(buffer, round(entry['amount'] * 1e8))  # Amounts are stored in satoshis
+    if flags & ENTRY_HAS_NEXT_TX:
+        buffer.extend(bytes.fromhex(entry['next_tx']))
+    if flags & ENTRY_HAS_LABEL:
+        _write_str(buffer, entry['label'])
+
+
+def _read_entry(data, pos):
+    flags = data[pos]
+    pos += 1
+    entry = {'address': None}
+    if flags & ENTRY_HAS_ADDRESS:
+        entry['address'], pos = _read_str(data, pos)
+    amount, pos = _read_varint(data, pos)
+    entry['amount'] = amount / 1e8  # Same float as the one decoded from the JSON page (8 decimals at most)
+    entry['is_standard'] = bool(flags & ENTRY_IS_STANDARD)
+    if flags & ENTRY_HAS_NEXT_TX:
+        entry['next_tx'] = data[pos:pos + 32].hex()
+        pos += 32
+    if flags & ENTRY_HAS_LABEL:
+        entry['label'], pos = _read_str(data, pos)
+    return entry, pos
+
+
+def normalize_tx(content):
+    """
+    :param content: Decoded content of a transaction page of the WalletExplorer API
+    :return: Same content, with only the fields used by ChainParser
+    """
+    tx = {'found': True, 'txid': content['txid'], 'is_coinbase': bool(content['is_coinbase'])}
+    if 'label' in content:
+        tx['label'] = content['label']
+    for direction in ('in', 'out'):
+        tx[direction] = []
+        for entry in content[direction]:
+            normalized_entry = {'address': entry.get('address'), 'amount': entry['amount'],
+                                'is_standard': entry['is_standard']}
+            for key in ('next_tx', 'label'):
+                if key in entry:
+                    normalized_entry[key] = entry[key]
+            tx[direction].append(normalized_entry)
+    return tx
+
+
+def encode_tx(content):
+    """
+    Encodes the fields of a transaction page used by ChainParser (amounts in satoshis, binary txids), compressed.
+    :param content: Decoded content of a transaction page of the WalletExplorer API
+    :return: Encoded transaction (bytes)
+    """
+    buffer = bytearray([FORMAT_VERSION])
+    flags = IS_COINBASE if content['is_coinbase'] else 0
+    if 'label' in content:
+        flags |= HAS_LABEL
+    buffer.append(flags)
+    if flags & HAS_LABEL:
+        _write_str(buffer, content['label'])
+    for direction in ('in', 'out'):
+        _write_varint(buffer, len(content[direction]))
+        for entry in content[direction]:
+            _write_entry(buffer, entry)
+    return zlib.compress(bytes(buffer))
+
+
+def decode_tx(txid, data):
+    """
+    :param txid: Transaction id (hex string)
+    :param data: Encoded transaction, as returned by encode_tx
+    :return: Content of the transaction page, with the fields used by ChainParser (see normalize_tx)
+    """
+    data = zlib.decompress(data)
+    if data[0] != FORMAT_VERSION:
+        raise ValueError(f"Unknown format version: {data[0]}")
+    flags = data[1]
+    pos = 2
+    tx = {'found': True, 'txid': txid, 'is_coinbase': bool(flags & IS_COINBASE)}
+    if flags & HAS_LABEL:
+        tx['label'], pos = _read_str(data, pos)
+    for direction in ('in', 'out'):
+        nb_entries, pos = _read_varint(data, pos)
+        tx[direction] = []
+        for _ in range(nb_entries):
+            entry, pos = _read_entry(data, pos)
+            tx[direction].append(entry)
+    return tx
+
+
+class TxStore:
+    def __init__(self, path="tx_store.sqlite"):
+        """
+        Compact store of the transaction pages of the WalletExplorer API, used instead of caching the whole HTTP
+        responses. Only the fields used by ChainParser are kept (see encode_tx), under the binary txid.
+        Thread-safe: every thread uses its own connection to the SQLite database.
+        The last access time of every transaction is kept, so that the least recently used ones can be evicted
+        (see CacheJanitor). Reads don't write to the database: their access times are kept in memory and written by
+        batches (see flush_accesses).
+        :param path: Path of the SQLite database
+        """
+        self.path = path
+        create_database(path)
+        self._local = threading.local()
+        self._accesses = dict()  # Binary txid -> time of the last access, not written yet
+        self._accesses_lock = threading.Lock()
+        with self.connection() as con:
+            con.execute("CREATE TABLE IF NOT EXISTS txs (txid BLOB PRIMARY KEY, data BLOB NOT NULL, "
+                        "last_access INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID")
+            columns = [row[1] for row in con.execute("PRAGMA table_info(txs)")]
+            if 'last_access' not in columns:  # Store created before eviction was added
+                con.execute("ALTER TABLE txs ADD COLUMN last_access INTEGER NOT NULL DEFAULT 0")
+            con.execute("CREATE INDEX IF NOT EXISTS txs_last_access ON txs (last_access)")
+
+    def connection(self):
+        """
+        :return: Connection to the database of the current thread
+        """
+        if not hasattr(self._local, 'connection'):
+            self._local.connection = sqlite3.connect(self.path, timeout=30)
+            self._local.connection.execute("PRAGMA journal_mode=WAL")  # Readers don't wait for writers
+        return self._local.connection
+
+    def _select(self, columns, txids):
+        """
+        Generator going through the rows of the txs whose txid (hex string) is in txids, by batches of txids.
+        """
+        batch_size = 500  # SQLite limits the number of variables in a query
+        con = self.connection()
+        for i in range(0, len(txids), batch_size):
+            batch = [bytes.fromhex(txid) for txid in txids[i:i + batch_size]]
+            yield from con.execute(f"SELECT {columns} FROM txs WHERE txid IN ({','.join(['?'] * len(batch))})",
+                                   batch)
+
+    def contains_many(self, txids):
+        """
+        :param txids: List of txids (hex strings)
+        :return: Set of the txids that are stored
+        """
+        return {row[0].hex() for row in self._select("txid", list(txids))}
+
+    def get_many(self, txids):
+        """
+        :param txids: List of txids (hex strings)
+        :return: Dict txid -> content of the transaction page, for the txids that are stored
+        """
+        return {txid: decode_tx(txid, data) for txid, data in self.get_many_encoded(txids).items()}
+
+    def get_many_encoded(self, txids):
+        """
+        Same as get_many, without decoding the transactions (see decode_tx).
+        :param txids: List of txids (hex strings)
+        :return: Dict txid -> encoded transaction, for the txids that are stored
+        """
+        rows = list(self._select("txid, data", list(txids)))
+        now = int(time.time())
+        with self._accesses_lock:
+            for row in rows:
+                self._accesses[row[0]] = now
+            is_full = len(self._accesses) >= ACCESS_FLUSH_SIZE
+        if is_full:
+            self.flush_accesses()
+        return {row[0].hex(): row[1] for row in rows}
+
+    def flush_accesses(self):
+        """
+        Writes the last access times of the transactions read since the last flush.
+        :return: None
+        """
+        with self._accesses_lock:
+            accesses, self._accesses = self._accesses, dict()
+        if accesses:
+            with self.connection() as con:
+                con.executemany("UPDATE txs SET last_access = ? WHERE txid = ?",
+                                [(last_access, txid) for txid, last_access in accesses.items()])
+
+    def put_many(self, contents):
+        """
+        Stores transaction pages. Pages that cannot be encoded without losing information are not stored.
+        :param contents: Dict txid (hex string) -> decoded content of the transaction page
+        :return: Number of pages stored
+        """
+        rows = []
+        for txid, content in contents.items():
+            try:
+                encoded = encode_tx(content)
+                if decode_tx(txid, encoded) != normalize_tx(content):
+                    continue
+                rows.append((bytes.fromhex(txid), encoded, int(time.time())))
+            except (KeyError, TypeError, ValueError, AttributeError):  # Not a valid transaction page
+                continue
+        if rows:
+            with self.connection() as con:
+                con.executemany("INSERT OR REPLACE INTO txs (txid, data, last_access) VALUES (?, ?, ?)", rows)
+        return len(rows)
+
+    def __len__(self):
+        return self.connection().execute("SELECT COUNT(*) FROM txs").fetchone()[0]
+
+    def evict(self, nb_txs):
+        """
+        Deletes the nb_txs least recently used transactions.
+        :param nb_txs: Number of transactions to delete
+        :return: Number of transactions deleted
+        """
+        self.flush_accesses()
+        with self.connection() as con:
+            rows = con.execute("SELECT txid FROM txs ORDER BY last_access LIMIT ?", (nb_txs,)).fetchall()
+            con.executemany("DELETE FROM txs WHERE txid = ?", rows)
+        return len(rows)
+
+    def put(self, txid, content):
+        """
+        Same as put_many, for a single page.
+        :return: True if the page has been stored, False if it cannot be (it then has to be cached another way)
+        """
+        return self.put_many({txid: content}) == 1
+
+
+def get_tx_store(path="tx_store.sqlite"):
+    """
+    Returns the TxStore stored at path, shared by every parser of the process.
+    :param path: Path of the SQLite database
+    :return: TxStore
+    """
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = TxStore(path)
+    return _stores[path]
@@ -0,0 +1,209 @@
+import argparse
+import gzip
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+
+from rate_limiter import TokenBucket
+
+ENDPOINTS = ("/api/1/address", "/api/1/tx")  # Endpoints of the WalletExplorer API used by ChainParser
+
+
+def archive_key(path, query):
+    """
+    Key under which the response to a request is stored in the archive. The 'caller' parameter is ignored, as it does
+    not change the content of the page.
+    :param path: Path of the request (e.g. /api/1/tx)
+    :param query: Query string of the request
+    :return: Key (str)
+    """
+    params = sorted((key, value) for key, value in parse_qsl(query) if key != "caller")
+    return f"{path}?{urlencode(params)}"
+
+
+def load_archive(archive_path):
+    """
+    :param archive_path: Path of the archive (gzipped JSON file)
+    :return: Dict where keys are archive keys and values are the decoded pages, empty if the archive does not exist
+    """
+    if not os.path.exists(archive_path):
+        return dict()
+    with gzip.open(archive_path, "rt") as f:
+        return json.load(f)
+
+
+def save_archive(archive, archive_path):
+    """
+    Writes the archive to archive_path (through a temporary file, so that an interrupted save cannot corrupt it).
+    :param archive: Dict where keys are archive keys and values are the decoded pages
+    :param archive_path: Path of the archive (gzipped JSON file)
+    :return: None
+    """
+    tmp_path = f"{archive_path}.tmp"
+    with gzip.open(tmp_path, "wt") as f:
+        json.dump(archive, f)
+    os.replace(tmp_path, archive_path)
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, archive_path, host="localhost", port=8080, latency=0., jitter=0., p429=0., retry_after=1,
+                 record_from=None, seed=None):
+        """
+        Local stand-in for the WalletExplorer API, serving the pages of a recorded archive.
+        Used to benchmark and compare runs of ChainParser (see its base_url parameter) without the live API.
+        :param archive_path: Path of the archive to serve (and to write to, when recording)
+        :param host: Host to listen on
+        :param port: Port to listen on
+        :param latency: Number of seconds added to every response
+        :param jitter: Maximum number of seconds randomly added to the latency of every response, so that responses
+        come back in another order than the requests
+        :param p429: Probability of answering a request with a 429 error
+        :param retry_after: Value of the Retry-After header of the 429 errors
+        :param record_from: If set (e.g. "https://www.walletexplorer.com"), pages missing from the archive are
+        requested there (at 2 req/sec) and added to the archive.
+        :param seed: Seed of the random generator used to inject 429 errors, to make runs reproducible
+        """
+        super().__init__((host, port), StandInRequestHandler)
+        self.archive_path = archive_path
+        self.archive = load_archive(archive_path)
+        self.latency = latency
+        self.jitter = jitter
+        self.p429 = p429
+        self.retry_after = retry_after
+        self.record_from = record_from.rstrip("/") if record_from else None
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.rate_limiter = TokenBucket()  # Only used to record pages from the live API
+        self.nb_recorded = 0
+        self.stats = {'requests': 0, 'served': 0, 'missing': 0, 'rate_limited': 0}
+
+    def get_page(self, path, query):
+        """
+        Looks for the page in the archive, or records it from the live API when recording.
+        :param path: Path of the request
+        :param query: Query string of the request
+        :return: Tuple (HTTP status, decoded content of the page or None, Retry-After value or None)
+        """
+        key = archive_key(path, query)
+        with self.lock:
+            content = self.archive.get(key)
+        if content is not None or self.record_from is None:
+            return (200, content, None) if content is not None else (404, None, None)
+
+        self.rate_limiter.acquire()
+        resp = requests.get(f"{self.record_from}{path}?{query}")
+        if resp.status_code != 200:
+            return resp.status_code, None, resp.headers.get("Retry-After")
+        content = resp.json()
+        with self.lock:
+            self.archive[key] = content
+            self.nb_recorded += 1
+            save_needed = self.nb_recorded >= 500
+        if save_needed:  # Saves regularly, not to lose a whole recording if the server is killed
+            self.save()
+        return 200, content, None
+
+    def save(self):
+        """
+        Writes the pages recorded so far to the archive.
+        :return: None
+        """
+        with self.lock:
+            if self.nb_recorded:
+                save_archive(self.archive, self.archive_path)
+                print(f"{self.nb_recorded} page(s) recorded to {self.archive_path} ({len(self.archive)} in total).")
+                self.nb_recorded = 0
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # To keep connections alive, as the live API does
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        server = self.server
+        with server.lock:
+            server.stats['requests'] += 1
+            rate_limited = server.random.random() < server.p429
+            latency = server.latency + server.random.random() * server.jitter
+        if latency:
+            time.sleep(latency)
+
+        if url.path not in ENDPOINTS:
+            self.send_json(404, {"found": False})
+            return
+        if rate_limited:
+            with server.lock:
+                server.stats['rate_limited'] += 1
+            self.send_json(429, {"error": "Too Many Requests"}, retry_after=server.retry_after)
+            return
+
+        status, content, retry_after = server.get_page(url.path, url.query)
+        with server.lock:
+            server.stats['served' if status == 200 else 'missing'] += 1
+        if status == 200:
+            self.send_json(200, content)
+        else:
+            self.send_json(status, {"found": False}, retry_after=retry_after)
+
+    def send_json(self, status, content, retry_after=None):
+        """
+        Sends content as a JSON response.
+        :param status: HTTP status of the response
+        :param content: Content to send
+        :param retry_after: Value of the Retry-After header (not sent if None)
+        :return: None
+        """
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if retry_after is not None:
+            self.send_header("Retry-After", str(retry_after))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # One line per request would flood the output
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the WalletExplorer API. Start ChainParser with "
+                                                 "base_url='http://HOST:PORT' to use it.")
+    parser.add_argument("archive", help="Archive of recorded pages (gzipped JSON file)")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0., help="Seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0., help="Maximum number of seconds randomly added to the "
+                                                                 "latency of every response")
+    parser.add_argument("--p429", type=float, default=0., help="Probability of answering with a 429 error")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After header of the 429 errors")
+    parser.add_argument("--seed", type=int, default=None, help="Seed used to inject the 429 errors")
+    parser.add_argument("--record", nargs="?", const="https://www.walletexplorer.com", default=None,
+                        metavar="API_URL", help="Request the pages missing from the archive to the live API "
+                                                "(default: %(const)s) and add them to the archive")
+    args = parser.parse_args()
+
+    server = StandInServer(args.archive, host=args.host, port=args.port, latency=args.latency, jitter=args.jitter,
+                           p429=args.p429, retry_after=args.retry_after, record_from=args.record, seed=args.seed)
+    print(f"Serving {len(server.archive)} page(s) on http://{args.host}:{args.port} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.save()
+        print(f"Stats: {server.stats}")
+
+
+if __name__ == "__main__":
+    main()
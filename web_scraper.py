@@ -62,7 +62,7 @@ class Scraper:
     def setup(self) -> dict:
         """
         Get the abuse types from bitcoinabuse.com and retrieves the bitcoinabuse API token from credentials.json
-        :return: bitcoinabuse API token
+        :return: Credentials of the APIs (empty if bitcoinabuse.com could not be reached)
         """
         if self.send_fct is not None:
             self.send_fct(message="Setting up the web scraper...")
@@ -81,6 +81,7 @@ class Scraper:
             with open(f"{FILE_DIR}/credentials.json", "r") as f:
                 dic = json.load(f)
             return dic
+        return dict()  # No API can be used without network
 
     def start_scraping(self):
         """